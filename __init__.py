@@ -1,7 +1,7 @@
 # Import required modules
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from os import path
+from os import environ
 from flask_login import LoginManager
 
 # Initialize the SQLAlchemy instance
@@ -11,19 +11,26 @@ db = SQLAlchemy()
 DB_NAME = "database.db"
 
 
-def create_app():
+# 'preload' set to False skips the warm-up of MATCH_PRELOAD, e.g. in the matching job workers, which load the
+# databases their jobs need themselves
+def create_app(preload: bool = True):
     # Create a Flask application
     app = Flask(__name__)
 
     # Set a secret key for the application (for security purposes)
     app.config['SECRET_KEY'] = 'my_super_secret_key'
 
-    # Configure the database URI for SQLite
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
+    # Configure the database URI for SQLite (another database can be given through the environment, e.g. the
+    # throwaway database of the load tests; the matching job workers read the same variable)
+    app.config['SQLALCHEMY_DATABASE_URI'] = environ.get('SQLALCHEMY_DATABASE_URI', f'sqlite:///{DB_NAME}')
 
     # Initialize the database with the app context
     db.init_app(app)
 
+    # Time every request and log one structured line per request
+    from . import metrics
+    metrics.init_app(app)
+
     # Import views and authentication blueprints
     from .views import views
     from .auth import auth
@@ -52,13 +59,16 @@ def create_app():
     def load_user(id):
         return User.query.get(int(id))
 
+    # Load the matching engine and the reference databases before serving when preloading is enabled
+    from . import warmup
+    if preload and warmup.PRELOAD:
+        warmup.warm_up()
+
     # Return the app instance
     return app
 
 
 def create_database(app):
-    # Check if the database file exists in the 'website' directory
-    if not path.exists('website/' + DB_NAME):
-        # If the database does not exist, create it along with the tables defined in the models
-        db.create_all(app=app)
-        print('Created Database!')
+    # Create the tables defined in the models; tables that already exist are left as they are, so this creates the
+    # database the first time and the tables added since on later starts
+    db.create_all(app=app)
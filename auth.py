@@ -1,25 +1,48 @@
 # Import required modules and classes
-import pandas as pd
-from openpyxl.drawing.image import Image
-from matplotlib import pyplot as plt
-from openpyxl.workbook import Workbook
-from rapidfuzz import fuzz as rapidfuzz
-from rapidfuzz import process as rapidfuzz_process
-from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, jsonify
-from .models import User
+from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, jsonify, Response
+from .models import User, MatchJob
+from .database_store import list_databases
+from . import database_store
+from . import match_results
+from . import metrics
+from . import normalization
 from . import db
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user, login_required, logout_user, current_user
+from datetime import datetime, timedelta
+import json
 import os
-import swifter
+import time
+import uuid
 
-# Read the admin key from 'static/admin_key.txt'
-with open('static/admin_key.txt', 'r') as f:
-    adminKeyValid = f.read()
+# The matching engine (pandas, openpyxl, rapidfuzz and the modules built on them) is imported by the routes that
+# use it, so that workers only load it when they first match (or up front when preloading, see warmup.py)
 
 # Create the 'auth' Blueprint
 auth = Blueprint('auth', __name__)
 
+# Largest number of matches the JSON API returns for one query, by rank and by minimum score
+MAX_API_MATCHES = 100
+MAX_THRESHOLD_MATCHES = 1000
+
+# Largest number of record names accepted by the batch API, and how many are matched before results are streamed
+MAX_BATCH_NAMES = 10000
+BATCH_STREAM_CHUNK = 500
+
+# Addresses allowed to scrape /metrics without signing in (comma-separated); signed-in admins can always read it
+METRICS_ALLOW = [address.strip() for address in os.environ.get('MATCH_METRICS_ALLOW', '127.0.0.1,::1').split(',')
+                 if address.strip()]
+
+# Number of seconds the upload and result files of a finished job are kept when its user leaves the site, so the
+# result can still be downloaded from the link of the job
+DOWNLOAD_TTL = float(os.environ.get('MATCH_DOWNLOAD_TTL', 86400))
+
+
+# Read the admin key from 'static/admin_key.txt' when an account is created
+def _admin_key() -> str:
+    with open('static/admin_key.txt', 'r') as f:
+        return f.read()
+
 
 # Authentication - Login
 @auth.route('/login', methods=['GET', 'POST'])
@@ -86,6 +109,7 @@ def sign_up():
             flash('Passwords don\'t match.', category='error')
         else:
             # Check if the provided admin key matches the valid admin key
+            adminKeyValid = _admin_key()
             if adminKey != adminKeyValid and adminKey != '':
                 flash('Admin key is invalid.', category='error')
             else:
@@ -114,14 +138,83 @@ def sign_up():
 # Upload Records - Route for uploading and processing records
 @auth.route('/uploadRecords', methods=['GET', 'POST'])
 def upload_records():
+    from . import candidate_index, field_matching, ingest, jobs, matching, reports, scorers, threshold_matching
+
     # Get the list of database files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
 
     if request.method == 'POST':
         # Get the file and database name from the form submitted via POST request
         file = request.files['record_file']
         database_name = request.form.get('database_name')
 
+        # Get the matching mode: 'full' scores every database name, 'indexed' scores only the candidates from the index,
+        # 'threshold' returns every match scoring at least the minimum score and 'tfidf' matches by TF-IDF n-gram
+        # vectors (re-ranking the candidates with the scorer when asked); without one, the database's default is used
+        match_mode = request.form.get('match_mode') or matching.default_mode(database_name)
+        if match_mode not in matching.MATCH_MODES:
+            flash(f'Unknown matching mode: {match_mode}', category='error')
+            return redirect(url_for('views.uploadRecords'))
+        try:
+            candidate_limit = int(request.form.get('candidate_limit') or candidate_index.DEFAULT_CANDIDATE_LIMIT)
+        except ValueError:
+            candidate_limit = 0
+        if not 1 <= candidate_limit <= candidate_index.MAX_CANDIDATE_LIMIT:
+            flash(f'Candidate limit must be a whole number between 1 and {candidate_index.MAX_CANDIDATE_LIMIT}',
+                  category='error')
+            return redirect(url_for('views.uploadRecords'))
+        rerank = request.form.get('rerank') == 'on'
+        try:
+            min_score = float(request.form.get('min_score') or reports.SCORE_THRESHOLD)
+        except ValueError:
+            min_score = -1
+        if not 0 <= min_score <= 100:
+            flash('Minimum score must be a number between 0 and 100', category='error')
+            return redirect(url_for('views.uploadRecords'))
+        if match_mode == 'threshold' and min_score < threshold_matching.MIN_SCORE:
+            flash(f'Minimum score must be at least {threshold_matching.MIN_SCORE} to return every match above it',
+                  category='error')
+            return redirect(url_for('views.uploadRecords'))
+
+        # Get the normalization pipeline and the scorer
+        normalizer = request.form.get('normalizer') or normalization.DEFAULT_PIPELINE
+        scorer_name = request.form.get('scorer') or scorers.DEFAULT_SCORER
+        try:
+            normalizer = normalization.pipeline_key(normalizer)
+            scorers.get_scorer(scorer_name)
+        except ValueError as e:
+            flash(str(e), category='error')
+            return redirect(url_for('views.uploadRecords'))
+
+        # Get the field mapping of multi-field matching (other columns of the file matched against other columns of
+        # the database, see field_matching.parse_fields) and the weight of the name score among the field scores
+        try:
+            fields = field_matching.parse_fields(request.form.get('fields'), scorer_name)
+        except ValueError as e:
+            flash(str(e), category='error')
+            return redirect(url_for('views.uploadRecords'))
+        try:
+            name_weight = float(request.form.get('name_weight') or 1)
+        except ValueError:
+            name_weight = -1
+        if not name_weight > 0:
+            flash('Name weight must be a positive number', category='error')
+            return redirect(url_for('views.uploadRecords'))
+
+        # Mapped fields are scored against every database row of the record's block, which is the full mode
+        if fields:
+            if request.form.get('match_mode') not in (None, '', 'full'):
+                flash('Mapped fields can only be matched in the full scan mode', category='error')
+                return redirect(url_for('views.uploadRecords'))
+            match_mode = 'full'
+
+        # Get the output options: xlsx (results and summary sheets) or csv, and whether to render the charts
+        output_format = 'csv' if request.form.get('output_format') == 'csv' else 'xlsx'
+        charts = request.form.get('charts') == 'on'
+
+        # Get whether the job should write a cProfile profile of itself
+        profile = request.form.get('profile') == 'on'
+
         # Check if a file was selected for upload
         if file.filename == '':
             flash('No selected file', category='error')
@@ -134,200 +227,132 @@ def upload_records():
 
         # If a file is uploaded and the database name is valid, proceed with file processing
         if file:
-            file_path = 'static/records/' + current_user.email + '_' + file.filename
-            database_path = 'static/databases/' + database_name
-            file.save(file_path)
+            # Save the upload under a unique name until the job exists; the job then takes it over under its own id,
+            # so uploads of files with the same name never replace the records of a queued job
+            file_path = f'static/records/upload-{uuid.uuid4().hex}_{file.filename}'
+            with metrics.stage('save_upload'):
+                file.save(file_path)
 
             try:
-                df1 = pd.read_excel(file_path, nrows=100)
+                # Read only the header row; the records themselves are streamed by the background job
+                with metrics.stage('read_header'):
+                    header = ingest.read_header(file_path)
             except Exception as e:
+                os.remove(file_path)
                 flash(f'Cannot read file: {e}', category='error')
                 return redirect(url_for('views.uploadRecords'))
 
-            # Check if the file has only one column
-            if len(df1.columns) != 1:
-                flash('File must have only one column.', category='error')
+            # Find the mapped columns among the other columns of the file (ignoring case when no header matches
+            # exactly); without a mapping, the file must have only the name column
+            columns = [str(column).strip() for column in header]
+            for field in fields:
+                matching_columns = [position for position, column in enumerate(columns)
+                                    if column == field['column']] or \
+                                   [position for position, column in enumerate(columns)
+                                    if column.lower() == field['column'].lower()]
+                if not matching_columns or matching_columns[0] == 0:
+                    os.remove(file_path)
+                    flash(f'File has no column {field["column"]} besides the name column.', category='error')
+                    return redirect(url_for('views.uploadRecords'))
+                field['position'] = matching_columns[0]
+            if len(header) != 1 and not fields:
+                os.remove(file_path)
+                flash('File must have only one column, or a field mapping for its other columns.', category='error')
                 return redirect(url_for('views.uploadRecords'))
             else:
                 flash('File uploaded successfully!', category='success')
 
-            # Load the database file into a DataFrame 'df2'
-            df2 = pd.read_excel(database_path)
-
-            # Convert the database names to lowercase for case-insensitive matching
-            df2[df2.columns[0]] = df2[df2.columns[0]].str.lower()
-
-            # Create a DataFrame 'result_df' to store the results of the fuzzy string matching
-            result_df = pd.DataFrame()
-            result_df['name'] = df1[df1.columns[0]].str.lower()
-            result_df.dropna(inplace=True)
-
-            # Configure the fuzzy string matching settings
-            score_method = rapidfuzz.ratio
-            n_matches = 3
-
-            # Define a function to find the closest matches for each name in 'result_df'
-            def get_closest_match(curr_row: pd.Series) -> pd.Series:
-                closest_matches = rapidfuzz_process.extract(curr_row['name'], df2[df2.columns[0]], scorer=score_method,
-                                                            limit=n_matches)
-                for i, match in enumerate(closest_matches):
-                    curr_row[f'match{i + 1}'] = match[0]
-                    curr_row[f'match_score{i + 1}'] = match[1]
-
-                return curr_row
-
-            # Apply the matching function to 'result_df' rows in parallel using 'swifter'
-            result_df = result_df.swifter.apply(get_closest_match, axis=1)
-            result_df = result_df.dropna()
-
-            # Create a figure for the visualizations with a large size
-            fig = plt.figure(figsize=(40, 50))
-
-            # Adjust the vertical space between subplots
-            plt.subplots_adjust(hspace=.5)
-
-            # Set the font size for subplot titles
-            plt.rcParams['axes.titlesize'] = 13
-
-            # Set the background color of the figure to white
-            fig.patch.set_facecolor('white')
-
-            # Function to format the text for displaying statistics
-            def get_text_str(mu, minimum, maximum):
-                return '\n'.join((
-                    r'$\mu=%.2f$' % (mu,),
-                    r'min=%.2f' % (minimum,),
-                    r'max=%.2f' % (maximum,)))
-
-            # Function to create a histogram with a threshold
-            def hist_threshold(hist_ax, column_name: str, title: str, greater=False):
-                if greater:
-                    hist_data = result_df[result_df[column_name] >= 90][column_name]
-                else:
-                    hist_data = result_df[result_df[column_name] < 90][column_name]
-
-                mu = hist_data.mean()
-                minimum = hist_data.min()
-                maximum = hist_data.max()
-                hist_ax.hist(hist_data, int(90 / 10))
-                hist_ax.set_xlabel('Score')
-                hist_ax.set_ylabel('Count')
-                hist_ax.set_title(title)
-                props = dict(boxstyle='round', facecolor='wheat', alpha=0.5)
-                hist_ax.text(0.03, 0.9, get_text_str(mu, minimum, maximum), transform=hist_ax.transAxes, fontsize=11,
-                             verticalalignment='top', bbox=props)
-
-            # Function to create a pie chart with a threshold
-            def pie_threshold(pie_ax, column_name: str, title: str, thresh: int):
-                pie_data = result_df[column_name]
-                pie_data = pie_data.apply(lambda x: 1 if x >= thresh else 0)
-                try:
-                    pie_ax.pie(pie_data.value_counts(), labels=[f'<{thresh}%', f'{thresh}%'], autopct='%1.1f%%')
-                except:
-                    pie_ax.pie(pie_data.value_counts(), labels=[f'{thresh}%'], autopct='%1.1f%%')
-                pie_ax.set_title(title)
-
-            # Define the number of columns and rows for the subplots grid
-            n_cols = 3
-            n_rows = 6
-
-            # Define the threshold value for pie charts
-            threshold = 95
-
-            # Loop over the number of matches and create subplots with histograms and pie charts
-            for n in range(1, n_matches + 1):
-                ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 1)
-                hist_threshold(ax, f'match_score{n}', f'Distribution of scores below the threshold for match {n}')
-                ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 2)
-                hist_threshold(ax, f'match_score{n}', f'Distribution of scores above the threshold for match {n}',
-                               greater=True)
-                ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 3)
-                if n == 1:
-                    pie_threshold(ax, f'match_score{n}', f'Distribution of scores that are 100% for match {n}',
-                                  threshold)
-                else:
-                    pie_threshold(ax, f'match_score{n}', f'Distribution of scores that are {threshold}% for match {n}',
-                                  threshold)
-
-            # Create subplots for displaying the average scores
-            ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 1)
-            data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]].mean()
-            ax.bar(data.index, data.values)
-            ax.set_xlabel('Match')
-            ax.set_ylabel('Score')
-            ax.set_title('Average score for each match')
-            plt.setp(ax.get_xticklabels(), rotation=30, horizontalalignment='right')
-
-            ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 2)
-            data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]].mean(axis=1)
-            ax.plot(data.index, data.values)
-            ax.set_xlabel('Insurer name')
-            ax.set_ylabel('Score')
-            ax.set_title('Average score for each insurer name')
-
-            ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 3)
-            data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]]
-            ax.boxplot(data.values)
-            ax.set_xlabel('Match #')
-            ax.set_ylabel('Score')
-            ax.set_title('Box and whisker chart for each match')
-
-            # Set the file path for saving the generated visualization image
-            img_path = f'static/matches/{current_user.email}_match.png'
-
-            # Save the figure with all the subplots to the specified image path
-            plt.savefig(img_path)
-
-            # Create a new Excel workbook
-            wb = Workbook()
-
-            # Remove the default 'Sheet' created by the workbook
-            wb.remove(wb['Sheet'])
-
-            # Create a new worksheet for storing the data from the result DataFrame
-            dataframe_sheet = wb.create_sheet('Results')
-
-            # Create a new worksheet for storing the visualization image
-            image_sheet = wb.create_sheet('Report')
-
-            # Append the column headers of the result DataFrame to the 'Results' worksheet
-            dataframe_sheet.append(result_df.columns.tolist())
-
-            # Append each row of the result DataFrame to the 'Results' worksheet
-            for row in result_df.values.tolist():
-                dataframe_sheet.append(row)
-
-            # Adjust the column widths in the 'Results' worksheet to fit the data
-            for column_cells in dataframe_sheet.columns:
-                length = max(len(str(cell.value)) for cell in column_cells)
-                dataframe_sheet.column_dimensions[column_cells[0].column_letter].width = length
-
-            # Make the first row (header) bold in the 'Results' worksheet
-            for cell in dataframe_sheet['1:1']:
-                cell.font = cell.font.copy(bold=True)
-
-            # Load the previously saved image into an Image object
-            img = Image(img_path)
-
-            # Set the width and height of the image in the Excel sheet
-            img.width = 2000
-            img.height = 2500
-
-            # Add the image to the 'Report' worksheet at cell A1
-            image_sheet.add_image(img, 'A1')
-
-            # Set the download path for the Excel file
-            download_path = f'static/matches/{current_user.email}_match.xlsx'
-
-            # Save the workbook to the download path
-            wb.save(download_path)
-
-            # Display a success flash message to the user
-            flash('File processed successfully!', category='success')
-
-            # Render the 'uploadRecords.html' template with the updated variables
-            return render_template('uploadRecords.html', user=current_user, database_files=db_files,
-                                   download_ready=True, download_path=download_path)
+            # Record the job, then hand the matching and report generation to the worker pool
+            with metrics.stage('enqueue'):
+                job = MatchJob(user_id=current_user.id, database_name=database_name)
+                db.session.add(job)
+                db.session.commit()
+                job_path = f'static/records/{current_user.email}_{job.id}_{file.filename}'
+                os.replace(file_path, job_path)
+                jobs.submit_match_job(job, job_path, current_user.email,
+                                      {'database_name': database_name, 'match_mode': match_mode,
+                                       'candidate_limit': candidate_limit, 'rerank': rerank, 'min_score': min_score,
+                                       'normalizer': normalizer,
+                                       'scorer': scorer_name, 'output_format': output_format, 'charts': charts,
+                                       'profile': profile, 'fields': fields, 'name_weight': name_weight})
+
+            # API clients get the job id straight away and poll the progress endpoint
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify(jobs.job_progress(job)), 202
+
+            # Render the 'uploadRecords.html' template, which polls the job until the workbook is ready
+            return render_template('uploadRecords.html', user=current_user, database_files=db_files, job_id=job.id)
+
+
+# Define a new Flask route for polling the progress of a matching job
+@auth.route('/jobs/<int:job_id>')
+@login_required
+def job_status(job_id):
+    # Only the owner of a job can see its progress
+    job = MatchJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+
+    from . import jobs
+    return jsonify(jobs.job_progress(job))
+
+
+# Read a number from the query parameters, None when it is not given
+def _query_number(name: str, cast=float):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return cast(value)
+    except ValueError:
+        raise ValueError(f'{name} must be a number')
+
+
+# Read the page of results of a job asked for by the query parameters
+# Returns the filters given (for the links to the next page), the results and the cursor of the next page
+# Raises ValueError for invalid parameters
+def _results_page(job_id: int) -> tuple:
+    filters = {name: request.args[name] for name in ('sort', 'min_score', 'below', 'rank', 'q', 'limit')
+               if request.args.get(name)}
+    limit = _query_number('limit', int)
+    limit = match_results.PAGE_SIZE if limit is None else max(1, min(limit, match_results.MAX_PAGE_SIZE))
+    results, next_cursor = match_results.page(job_id, filters.get('sort', 'row'), request.args.get('cursor'), limit,
+                                              min_score=_query_number('min_score'), below=_query_number('below'),
+                                              rank=_query_number('rank', int), query=filters.get('q'))
+    return filters, results, next_cursor
+
+
+# Define a new Flask route for browsing the results of a finished matching job a page at a time
+# Query parameters: sort (row, score or score_asc), cursor (given by the previous page), limit, min_score (scores
+# at least), below (scores below), rank and q (record name contains)
+@auth.route('/jobs/<int:job_id>/results')
+@login_required
+def job_results(job_id):
+    job = MatchJob.query.filter_by(id=job_id, user_id=current_user.id, status='done').first()
+    if job is None:
+        flash('Result not found', category='error')
+        return redirect(url_for('views.uploadRecords'))
+    try:
+        filters, results, next_cursor = _results_page(job_id)
+    except ValueError as e:
+        flash(str(e), category='error')
+        return redirect(url_for('auth.job_results', job_id=job_id))
+    return render_template('results.html', user=current_user, job=job, filters=filters, results=results,
+                           next_cursor=next_cursor, sorts=match_results.SORTS)
+
+
+# Define a JSON API route serving the same pages of results as the results view
+@auth.route('/api/jobs/<int:job_id>/results')
+@login_required
+def api_job_results(job_id):
+    job = MatchJob.query.filter_by(id=job_id, user_id=current_user.id, status='done').first()
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    try:
+        filters, results, next_cursor = _results_page(job_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'job_id': job_id, 'filters': filters, 'results': results, 'next_cursor': next_cursor})
 
 
 # Define a new Flask route for downloading files
@@ -336,25 +361,53 @@ def upload_records():
 def download_file():
     # Get the file path from the request arguments sent by the client
     file_path = request.args.get('file_path')
+
+    # Finished matching jobs are downloaded by job id
+    job_id = request.args.get('job_id', type=int)
+    if job_id is not None:
+        job = MatchJob.query.filter_by(id=job_id, user_id=current_user.id, status='done').first()
+        if job is None:
+            flash('Result not found', category='error')
+            return redirect(url_for('views.uploadRecords'))
+        file_path = job.result_path
+
     # Use the Flask send_file function to send the file as an attachment for download
-    return send_file(file_path, as_attachment=True)
+    # Files are written relative to the working directory, while send_file resolves relative paths from the package
+    return send_file(os.path.abspath(file_path), as_attachment=True)
 
 
 # Define a new Flask route for the admin settings page
 @auth.route('/admin', methods=['GET', 'POST'])
 @login_required
 def admin_settings():
+    from . import jobs, reports, scorers
+    from .reference_cache import reference_cache
+
     # Get the list of database files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
     if request.method == 'POST':
+        # Only admins can upload, update, delete or search the databases
+        if not current_user.isAdmin:
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify({'error': 'Forbidden'}), 403
+            flash('Only admins can manage the databases', category='error')
+            return redirect(url_for('views.home'))
+
         if 'database_file' in request.files and 'database_name' in request.form:
             # Get the uploaded file and form data from the request
             file = request.files['database_file']
             database_name = request.form.get('database_name')
             update_database = request.form.get('update_database')
+            update_mode = request.form.get('update_mode') or 'replace'
+
+            # Check if the database name is reserved for the compiled copies of the databases
+            if database_store.is_artifact(database_name):
+                flash(f'Database name cannot end with {database_store.ARTIFACT_SUFFIX} or {database_store.TMP_SUFFIX}',
+                      category='error')
+                return redirect(url_for('views.admin'))
 
             # Check if the database name already exists and user doesn't want to update
-            if database_name in db_files and update_database != 'on':
+            elif database_name in db_files and update_database != 'on':
                 flash('Database name already exists', category='error')
                 return redirect(url_for('views.admin'))
 
@@ -363,10 +416,47 @@ def admin_settings():
                 flash('Database name not found', category='error')
                 return redirect(url_for('views.admin'))
 
+            # Check if the update mode is known
+            elif update_database == 'on' and update_mode not in database_store.UPDATE_MODES:
+                flash('Unknown update mode', category='error')
+                return redirect(url_for('views.admin'))
+
+            # Apply an update to the existing database row by row, so only the changed rows are processed again
+            if file and update_database == 'on':
+                database_path = 'static/databases/' + database_name
+                upload_path = database_path + '.upload' + database_store.TMP_SUFFIX
+                file.save(upload_path)
+                try:
+                    with metrics.stage('update_database'):
+                        _, uploaded, uploaded_fields = database_store.read_table(upload_path)
+                        artifact, row_map, n_added = database_store.update_database(database_path, uploaded,
+                                                                                    update_mode, uploaded_fields)
+                        reference_cache.apply_update(database_name, artifact, row_map, n_added)
+                except Exception as e:
+                    flash(f'Cannot update database: {e}', category='error')
+                    return redirect(url_for('views.admin'))
+                finally:
+                    os.remove(upload_path)
+                n_removed = int((row_map < 0).sum())
+                flash(f'Database updated to version {artifact.metadata["version"]}: {n_added} rows added, '
+                      f'{n_removed} rows removed.', category='success')
+
             # If a file was uploaded, save it to the specified database path
-            if file:
+            elif file:
                 database_path = 'static/databases/' + database_name
-                file.save(database_path)
+                with metrics.stage('save_database'):
+                    file.save(database_path)
+
+                # Drop any cached copy so the next match uses the new contents
+                reference_cache.invalidate(database_name)
+
+                # Convert the workbook once into the compiled copy that the matching routes load
+                try:
+                    with metrics.stage('convert_database'):
+                        database_store.convert_database(database_path)
+                except Exception as e:
+                    flash(f'Cannot read database: {e}', category='error')
+                    return redirect(url_for('views.admin'))
                 flash('Database uploaded successfully!', category='success')
 
         elif 'delete_database' in request.form:
@@ -374,8 +464,40 @@ def admin_settings():
             if database_to_delete:
                 # Remove the database file from the 'static/databases/' directory
                 os.remove(f'static/databases/{database_to_delete}')
+                database_store.remove_artifact(f'static/databases/{database_to_delete}')
+                reference_cache.invalidate(database_to_delete)
                 flash('Database deleted successfully!', category='success')
 
+        elif 'duplicates_database' in request.form:
+            # Search a database for near-duplicate names in the background
+            database_name = request.form.get('duplicates_database')
+            try:
+                min_score = float(request.form.get('min_score') or reports.SCORE_THRESHOLD)
+                normalizer = normalization.pipeline_key(request.form.get('normalizer'))
+                scorer_name = request.form.get('scorer') or scorers.DEFAULT_SCORER
+                scorers.get_scorer(scorer_name)
+            except ValueError as e:
+                flash(str(e), category='error')
+                return redirect(url_for('views.admin'))
+            if not 0 <= min_score <= 100:
+                flash('Minimum score must be a number between 0 and 100', category='error')
+                return redirect(url_for('views.admin'))
+            if database_name not in db_files:
+                flash('Database name not found', category='error')
+                return redirect(url_for('views.admin'))
+
+            job = MatchJob(user_id=current_user.id, database_name=database_name)
+            db.session.add(job)
+            db.session.commit()
+            jobs.submit_duplicates_job(job, current_user.email, {'database_name': database_name,
+                                                                 'min_score': min_score, 'normalizer': normalizer,
+                                                                 'scorer': scorer_name})
+
+            # API clients get the job id straight away and poll the progress endpoint
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify(jobs.job_progress(job)), 202
+            return render_template('admin.html', user=current_user, database_files=db_files, job_id=job.id)
+
     # Render the 'admin.html' template with the current user data
     return render_template('admin.html', user=current_user, database_files=db_files)
 
@@ -384,8 +506,12 @@ def admin_settings():
 @auth.route('/singleMatchAnalysis', methods=['GET', 'POST'])
 @login_required
 def single_match_analysis():
+    from . import candidate_index, matching, scorers, sharded_matching
+    from .match_cache import match_cache
+    from .reference_cache import reference_cache
+
     # Get the list of database files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
     if request.method == 'POST':
         # Get the input record (record_name)
         record_name = request.form.get('record_name')
@@ -393,24 +519,48 @@ def single_match_analysis():
         database_name = request.form.get('dataset_selection')
         # Get the number of matches
         num_matches = int(request.form.get('num_matches'))
-
-        if database_name == 'All':
-            database_files = os.listdir('static/databases/')
-            first_column_values = [pd.read_excel(os.path.join('static/databases/', file_name)).iloc[:, 0].tolist() for
-                                   file_name in database_files]
-            df = pd.DataFrame(
-                {"names": [value for sublist in first_column_values for value in sublist]})
-
-        else:
-            # Read the selected database file into a DataFrame
-            df = pd.read_excel(f'static/databases/{database_name}')
-
-        df = df.dropna()
-        df['names'] = df['names'].astype(str)
-
-        # Get the closest match using rapidfuzz
-        closest_matches = rapidfuzz_process.extract(record_name, df['names'], limit=num_matches, scorer=rapidfuzz.ratio)
-        closest_matches = [f'{match[0]}: {round(match[1], 2)}' for match in closest_matches]
+        # Get the normalization pipeline and the scorer
+        try:
+            normalizer = normalization.pipeline_key(request.form.get('normalizer'))
+            scorer = scorers.get_scorer(request.form.get('scorer'))
+        except ValueError as e:
+            flash(str(e), category='error')
+            return redirect(url_for('views.singleMatchAnalysis'))
+        # Get the matching mode: 'full' scores every database name and 'tfidf' matches by TF-IDF n-gram vectors
+        # (re-ranking the candidates with the scorer when asked); without one, the database's default is used
+        match_mode = request.form.get('match_mode') or matching.default_mode(database_name)
+        if match_mode not in ('full', 'tfidf'):
+            flash(f'Unknown matching mode: {match_mode}', category='error')
+            return redirect(url_for('views.singleMatchAnalysis'))
+        rerank = request.form.get('rerank') == 'on'
+
+        with metrics.stage('load_database'):
+            if database_name == 'All':
+                # Get every database from the resident combined copy
+                reference = reference_cache.get_merged()
+            else:
+                # Get the selected database from the shared cache
+                reference = reference_cache.get(database_name)
+            keys = reference.normalized(normalizer)
+            tfidf = reference.tfidf_index(normalizer) if match_mode == 'tfidf' else None
+
+        # Get the closest match using rapidfuzz, comparing the normalized record with the normalized database keys
+        # (records looked up before are answered from the result cache), or using the TF-IDF vectors
+        start = time.perf_counter()
+        with metrics.stage('matching'):
+            query = normalization.normalize(record_name, normalizer)
+            if tfidf is not None:
+                rows, scores = matching.top_matches([query], keys, n_matches=num_matches, scorer=scorer, tfidf=tfidf,
+                                                    candidate_limit=candidate_index.DEFAULT_CANDIDATE_LIMIT
+                                                    if rerank else None)
+            else:
+                rows, scores = matching.top_matches([query], keys, n_matches=num_matches, scorer=scorer,
+                                                    cache=match_cache.view(reference.version, normalizer, scorer,
+                                                                           num_matches, None),
+                                                    shards=sharded_matching.shard_plan(reference, normalizer))
+        metrics.record_rows(1, time.perf_counter() - start)
+        closest_matches = [f'{reference.names[row]}: {round(float(score), 2)}'
+                           for row, score in zip(rows[0], scores[0]) if row >= 0]
         display_closest_matches = True
 
     return render_template('singleMatchAnalysis.html', user=current_user, database_files=db_files,
@@ -418,22 +568,241 @@ def single_match_analysis():
                            closest_matches=closest_matches)
 
 
+# Define a JSON API route for low-latency single matches (e.g. type-ahead)
+# Query parameters: q (record name), db (database name or 'All'), k (number of matches), full (score every name),
+# norm (normalization pipeline) and scorer
+# mode chooses between the candidate index ('indexed', the default unless the database defaults to TF-IDF), a full
+# scan ('full', like full=1) and TF-IDF vectors ('tfidf', with rerank=1 re-ranking the candidates with the scorer)
+# With min_score (at least threshold_matching.MIN_SCORE), every match scoring at least that score is returned instead
+# of the top k, with the number of database names scored and pruned by length
+@auth.route('/api/match')
+@login_required
+def api_match():
+    from . import candidate_index, matching, scorers, sharded_matching, threshold_matching
+    from .match_cache import match_cache
+    from .reference_cache import reference_cache
+
+    start = time.perf_counter()
+    query = request.args.get('q', '')
+    database_name = request.args.get('db', 'All')
+    full_scan = request.args.get('full', '').lower() in ('1', 'true', 'yes')
+    match_mode = request.args.get('mode') or ('full' if full_scan else matching.default_mode(database_name, 'indexed'))
+    rerank = request.args.get('rerank', '').lower() in ('1', 'true', 'yes')
+    min_score = request.args.get('min_score')
+
+    # Validate the normalization pipeline, the scorer, the number of matches, the minimum score, the query and the
+    # database name
+    try:
+        normalizer = normalization.pipeline_key(request.args.get('norm'))
+        scorer = scorers.get_scorer(request.args.get('scorer'))
+        num_matches = _query_number('k', int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    num_matches = max(1, min(5 if num_matches is None else num_matches, MAX_API_MATCHES))
+    if min_score is not None:
+        try:
+            min_score = float(min_score)
+        except ValueError:
+            min_score = -1
+        if not threshold_matching.MIN_SCORE <= min_score <= 100:
+            return jsonify({'error': f'min_score must be a number between {threshold_matching.MIN_SCORE} and 100'}), 400
+    if match_mode not in ('indexed', 'full', 'tfidf'):
+        return jsonify({'error': f'Unknown mode: {match_mode} (use indexed, full or tfidf)'}), 400
+    if not query.strip():
+        return jsonify({'error': 'Missing query parameter q'}), 400
+    if database_name != 'All' and database_name not in list_databases():
+        return jsonify({'error': 'Database name not found'}), 404
+
+    if min_score is not None:
+        return _api_match_threshold(start, query, database_name, min_score, normalizer, scorer)
+
+    # Answer from the resident copy of the database(s); unless a full scan is requested,
+    # only the candidates proposed by the n-gram index (or the TF-IDF vectors) are scored
+    with metrics.stage('load_database'):
+        reference = reference_cache.get_merged() if database_name == 'All' else reference_cache.get(database_name)
+        keys = reference.normalized(normalizer)
+        index, candidate_limit, tfidf = None, None, None
+        if match_mode == 'indexed':
+            index, candidate_limit = reference.candidate_index(normalizer), candidate_index.DEFAULT_CANDIDATE_LIMIT
+        elif match_mode == 'tfidf':
+            tfidf = reference.tfidf_index(normalizer)
+            candidate_limit = candidate_index.DEFAULT_CANDIDATE_LIMIT if rerank else None
+
+    match_start = time.perf_counter()
+    with metrics.stage('matching'):
+        query_key = normalization.normalize(query, normalizer)
+        if tfidf is not None:
+            rows, scores = matching.top_matches([query_key], keys, n_matches=num_matches, scorer=scorer,
+                                                candidate_limit=candidate_limit, tfidf=tfidf)
+        else:
+            rows, scores = matching.top_matches([query_key], keys, n_matches=num_matches, scorer=scorer, index=index,
+                                                candidate_limit=candidate_limit,
+                                                cache=match_cache.view(reference.version, normalizer, scorer,
+                                                                       num_matches, candidate_limit),
+                                                shards=sharded_matching.shard_plan(reference, normalizer)
+                                                if match_mode == 'full' else None)
+    metrics.record_rows(1, time.perf_counter() - match_start)
+
+    return jsonify({
+        'query': query,
+        'db': database_name,
+        'matches': [{'name': reference.names[row], 'score': round(float(score), 2), 'database': reference.source(row)}
+                    for row, score in zip(rows[0], scores[0]) if row >= 0],
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 3),
+    })
+
+
+# Answer /api/match with every match scoring at least 'min_score', scoring only the database names whose length
+# can reach it
+def _api_match_threshold(start: float, query: str, database_name: str, min_score: float, normalizer: str, scorer):
+    from . import threshold_matching
+    from .reference_cache import reference_cache
+
+    with metrics.stage('load_database'):
+        reference = reference_cache.get_merged() if database_name == 'All' else reference_cache.get(database_name)
+        keys = reference.normalized(normalizer)
+        length_index = reference.length_index(normalizer)
+
+    match_start = time.perf_counter()
+    with metrics.stage('matching'):
+        _, rows, scores, pruning = threshold_matching.threshold_matches([normalization.normalize(query, normalizer)],
+                                                                        keys, min_score, scorer=scorer,
+                                                                        length_index=length_index)
+    metrics.record_rows(1, time.perf_counter() - match_start)
+    for outcome in ('scored', 'pruned'):
+        metrics.registry.inc('record_matching_threshold_pairs_total', pruning[outcome],
+                             'Name and database key pairs of threshold matching, scored or pruned by length.',
+                             route=request.endpoint, outcome=outcome)
+
+    return jsonify({
+        'query': query,
+        'db': database_name,
+        'min_score': min_score,
+        'matches': [{'name': reference.names[row], 'score': round(float(score), 2), 'database': reference.source(row)}
+                    for row, score in zip(rows[:MAX_THRESHOLD_MATCHES], scores[:MAX_THRESHOLD_MATCHES])],
+        'truncated': len(rows) > MAX_THRESHOLD_MATCHES,
+        'candidates_scored': pruning['scored'],
+        'candidates_pruned': pruning['pruned'],
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 3),
+    })
+
+
+# Define a JSON API route that matches many record names in one request and streams the results as NDJSON
+# The body is a JSON array of names, a JSON object {"names": [...], "db": ..., "k": ..., "norm": ..., "scorer": ...}
+# or one name per line; db, k, norm and scorer can also be given as query parameters
+# mode ('full' or 'tfidf') and rerank choose the matching mode like for /api/match
+@auth.route('/api/match/batch', methods=['POST'])
+@login_required
+def api_match_batch():
+    from . import candidate_index, matching, scorers, sharded_matching
+    from .match_cache import match_cache
+    from .reference_cache import reference_cache
+
+    options = {}
+    if request.is_json:
+        body = request.get_json(silent=True)
+        if isinstance(body, dict):
+            options, names = body, body.get('names')
+        else:
+            names = body
+    else:
+        names = [line.strip() for line in request.get_data(as_text=True).splitlines() if line.strip()]
+
+    database_name = request.args.get('db', options.get('db', 'All'))
+    match_mode = request.args.get('mode', options.get('mode')) or matching.default_mode(database_name)
+    rerank = str(request.args.get('rerank', options.get('rerank', ''))).lower() in ('1', 'true', 'yes')
+
+    # Validate the normalization pipeline, the scorer, the number of matches, the names and the database name
+    try:
+        normalizer = normalization.pipeline_key(request.args.get('norm', options.get('norm')))
+        scorer = scorers.get_scorer(request.args.get('scorer', options.get('scorer')))
+        num_matches = _query_number('k', int)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if num_matches is None:
+        num_matches = options.get('k', 5)
+    if not isinstance(num_matches, int) or isinstance(num_matches, bool):
+        return jsonify({'error': 'k must be an integer'}), 400
+    num_matches = max(1, min(num_matches, MAX_API_MATCHES))
+    if match_mode not in ('full', 'tfidf'):
+        return jsonify({'error': f'Unknown mode: {match_mode} (use full or tfidf)'}), 400
+    if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+        return jsonify({'error': 'Body must be a list of record names'}), 400
+    if len(names) > MAX_BATCH_NAMES:
+        return jsonify({'error': f'At most {MAX_BATCH_NAMES} record names per request'}), 413
+    if database_name != 'All' and database_name not in list_databases():
+        return jsonify({'error': 'Database name not found'}), 404
+
+    with metrics.stage('load_database'):
+        reference = reference_cache.get_merged() if database_name == 'All' else reference_cache.get(database_name)
+        keys = reference.normalized(normalizer)
+        tfidf = reference.tfidf_index(normalizer) if match_mode == 'tfidf' else None
+
+    # Score the names chunk by chunk on all cores, writing each chunk out as soon as it is matched
+    # (the chunks are timed while the response streams, after the request's log line was written)
+    # Repeated names are scored once, and names looked up before are answered from the result cache
+    route = request.endpoint
+    if tfidf is None:
+        cache = match_cache.view(reference.version, normalizer, scorer, num_matches, None)
+        shards = sharded_matching.shard_plan(reference, normalizer)
+        candidate_limit = None
+    else:
+        cache, shards = None, None
+        candidate_limit = candidate_index.DEFAULT_CANDIDATE_LIMIT if rerank else None
+
+    def generate():
+        for start in range(0, len(names), BATCH_STREAM_CHUNK):
+            chunk = names[start:start + BATCH_STREAM_CHUNK]
+            match_start = time.perf_counter()
+            with metrics.stage('matching', route=route):
+                rows, scores = matching.top_matches(normalization.normalize_all(chunk, normalizer), keys,
+                                                    n_matches=num_matches, scorer=scorer, cache=cache,
+                                                    shards=shards, candidate_limit=candidate_limit, tfidf=tfidf)
+            metrics.record_rows(len(chunk), time.perf_counter() - match_start, route=route)
+            for name, name_rows, name_scores in zip(chunk, rows, scores):
+                yield json.dumps({
+                    'query': name,
+                    'matches': [{'name': reference.names[row], 'score': round(float(score), 2),
+                                 'database': reference.source(row)}
+                                for row, score in zip(name_rows, name_scores) if row >= 0],
+                }) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+
+# Define a route exposing the timings, throughput and cache counters of this process in the Prometheus text format
+# Only the addresses of METRICS_ALLOW and signed-in admins can read it, since it names the databases and routes
+@auth.route('/metrics')
+def metrics_endpoint():
+    if request.remote_addr not in METRICS_ALLOW and not (current_user.is_authenticated and current_user.isAdmin):
+        return jsonify({'error': 'Forbidden'}), 403
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
 # Define a new Flask route for the User Close event
-# This route is used to delete the user's files from the 'static/matches/' and 'static/records/' directory when they exit the site
+# This route is used to delete the user's files from the 'static/matches/' and 'static/records/' directory when they
+# exit the site. Files are named '<email>_<job id>_...'; the files of queued and running jobs, and of jobs that
+# finished less than DOWNLOAD_TTL seconds ago, are kept, since the page also posts this event on every navigation
 @auth.route('/log_user_close', methods=['POST'])
 def log_user_close():
     # Get the user_id from the request data (assuming it's sent as JSON)
     data = request.get_json()
-    user_id = data.get('user_id')
-
-    # Delete the user's files from the 'static/matches/' and 'static/records/' directory
-    email = User.query.filter_by(id=user_id).first().email
-    for file in os.listdir('static/matches/'):
-        if email in file:
-            os.remove(f'static/matches/{file}')
-    for file in os.listdir('static/records/'):
-        if email in file:
-            os.remove(f'static/records/{file}')
+    user = User.query.filter_by(id=data.get('user_id')).first()
+    if user is None:
+        return jsonify({'message': 'User close event logged successfully'})
+
+    # Find the jobs of the user whose files are still needed
+    finished_after = datetime.utcnow() - timedelta(seconds=DOWNLOAD_TTL)
+    kept_jobs = {str(job_id) for job_id, in db.session.query(MatchJob.id).filter(
+        MatchJob.user_id == user.id,
+        MatchJob.status.in_(('queued', 'running')) | (MatchJob.finished_at >= finished_after))}
+
+    # Delete the user's other files from the 'static/matches/' and 'static/records/' directory
+    prefix = user.email + '_'
+    for directory in ('static/matches/', 'static/records/'):
+        for file in os.listdir(directory):
+            if file.startswith(prefix) and file[len(prefix):].split('_', 1)[0] not in kept_jobs:
+                os.remove(directory + file)
 
     # Respond with a JSON response if needed
     return jsonify({'message': 'User close event logged successfully'})
@@ -0,0 +1 @@
+# Benchmark suite for the matching engine (see run_benchmarks.py)
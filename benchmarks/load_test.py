@@ -0,0 +1,381 @@
+# Load-test the web application over HTTP with concurrent logged-in users
+#
+# Run from the directory that contains the package, e.g.
+#     python -m website.benchmarks.load_test --users 20 --duration 60 --mix single=60,api=20,upload=10,download=10
+# The app runs in a separate process (werkzeug's threaded server, or gunicorn with --gunicorn-workers) in a
+# throwaway working directory with its own SQLite database and a synthetic reference database, so nothing of the
+# real deployment is touched. Every virtual user signs up and then performs actions drawn from the mix until the
+# duration is over; the report gives the throughput, latency percentiles and error rate of every route.
+# Comparing a run with uploads in the mix against one without shows how much the uploads slow the other routes down.
+
+# Import required modules
+import argparse
+import csv
+import http.cookiejar
+import io
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+import numpy as np
+
+from .. import database_store
+from .run_benchmarks import _environment
+from .synthetic import generate_queries, generate_reference
+
+# Actions a virtual user can perform, and the default share of each
+ACTIONS = ('login', 'single', 'api', 'upload', 'download', 'results')
+DEFAULT_MIX = 'single=60,api=20,upload=10,download=5,results=5'
+
+# Default number of concurrent users, test duration (seconds), reference database size and names per upload
+DEFAULT_USERS = 10
+DEFAULT_DURATION = 30.0
+DEFAULT_REFERENCE_SIZE = 10000
+DEFAULT_UPLOAD_ROWS = 1000
+
+# Name of the generated reference database
+DATABASE_NAME = 'load_test.xlsx'
+
+# Seconds to wait for the server to answer, for one request and for an upload job to finish
+STARTUP_TIMEOUT = 60.0
+REQUEST_TIMEOUT = 300.0
+JOB_TIMEOUT = 600.0
+
+# Seconds between two progress requests of an upload job, as the upload page polls
+JOB_POLL_INTERVAL = 1.0
+
+
+# Parse a mix such as 'single=60,upload=10' into the actions and their weights
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for part in mix.split(','):
+        if not part.strip():
+            continue
+        action, _, weight = part.partition('=')
+        action = action.strip()
+        if action not in ACTIONS:
+            raise ValueError(f'Unknown action: {action} (use {", ".join(ACTIONS)})')
+        weights[action] = float(weight or 1)
+    if not weights or sum(weights.values()) <= 0:
+        raise ValueError('The mix needs at least one action with a positive weight')
+    return weights
+
+
+# Latencies and outcomes of the requests sent by every user, by route
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = {}
+
+    def record(self, route: str, seconds: float, ok: bool):
+        with self._lock:
+            self._requests.setdefault(route, []).append((seconds, ok))
+
+    # Describe every route: requests, errors, throughput over the test and latency percentiles (in milliseconds)
+    def summary(self, elapsed: float) -> dict:
+        with self._lock:
+            requests = {route: list(entries) for route, entries in self._requests.items()}
+
+        routes = {}
+        for route, entries in sorted(requests.items()):
+            latencies_ms = np.array([seconds for seconds, _ in entries]) * 1000
+            errors = sum(1 for _, ok in entries if not ok)
+            routes[route] = {
+                'requests': len(entries),
+                'errors': errors,
+                'error_rate': round(errors / len(entries), 4),
+                'requests_per_second': round(len(entries) / elapsed, 3) if elapsed else None,
+                'p50_ms': round(float(np.percentile(latencies_ms, 50)), 2),
+                'p90_ms': round(float(np.percentile(latencies_ms, 90)), 2),
+                'p99_ms': round(float(np.percentile(latencies_ms, 99)), 2),
+                'max_ms': round(float(latencies_ms.max()), 2),
+                'mean_ms': round(float(latencies_ms.mean()), 2),
+            }
+        return routes
+
+
+# Encode form fields and files as multipart/form-data; returns the body and its content type
+def _multipart(fields: dict, files: dict) -> tuple:
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for name, value in fields.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (file_name, content) in files.items():
+        body.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{file_name}"\r\n'
+                   f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+# One logged-in user of the app, with its own session cookie, sending requests one after the other
+class VirtualUser:
+    def __init__(self, number: int, base_url: str, recorder: Recorder, queries: list, upload_rows: int,
+                 upload_format: str, seed: int):
+        self.email = f'load{number}@example.com'
+        self.password = 'load-test'
+        self.base_url = base_url
+        self.recorder = recorder
+        self.queries = queries
+        self.upload_rows = upload_rows
+        self.upload_format = upload_format
+        self.rng = random.Random(seed)
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+        # Upload jobs of this user that finished, for the download and results actions
+        self.jobs = []
+
+    # Send one request and record its latency under a route name; the request fails when its status is not one of
+    # 'expected' (redirects are followed). Returns the status (None when the server could not be reached) and body
+    def request(self, route: str, path: str, data: bytes = None, headers: dict = None, expected: tuple = (200,)):
+        request = urllib.request.Request(self.base_url + path, data=data, headers=headers or {})
+        start = time.perf_counter()
+        try:
+            with self.opener.open(request, timeout=REQUEST_TIMEOUT) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except OSError:
+            status, body = None, b''
+        self.recorder.record(route, time.perf_counter() - start, status in expected)
+        return status, body
+
+    def _form(self, route: str, path: str, fields: dict):
+        return self.request(route, path, urllib.parse.urlencode(fields).encode(),
+                            {'Content-Type': 'application/x-www-form-urlencoded'})
+
+    def sign_up(self):
+        self._form('sign_up', '/sign-up', {'email': self.email, 'password1': self.password,
+                                           'password2': self.password, 'adminKey': ''})
+
+    def login(self):
+        self._form('login', '/login', {'email': self.email, 'password': self.password})
+
+    def single(self):
+        self._form('single_match', '/singleMatchAnalysis', {'record_name': self.rng.choice(self.queries),
+                                                            'dataset_selection': DATABASE_NAME, 'num_matches': 5})
+
+    def api(self):
+        query = urllib.parse.urlencode({'q': self.rng.choice(self.queries), 'db': DATABASE_NAME, 'k': 5})
+        self.request('api_match', f'/api/match?{query}')
+
+    # Upload a file of noisy names, then poll the job like the upload page does until it finishes
+    # The time from the upload to the finished job is recorded as the route 'upload_job'
+    def upload(self):
+        names = self.rng.sample(self.queries, min(self.upload_rows, len(self.queries)))
+        content = io.StringIO()
+        writer = csv.writer(content)
+        writer.writerow(['name'])
+        writer.writerows([name] for name in names)
+        body, content_type = _multipart({'database_name': DATABASE_NAME, 'output_format': self.upload_format},
+                                        {'record_file': (f'load_{uuid.uuid4().hex}.csv', content.getvalue().encode())})
+
+        start = time.perf_counter()
+        status, response = self.request('upload', '/uploadRecords', body,
+                                        {'Content-Type': content_type, 'Accept': 'application/json'}, expected=(202,))
+        if status != 202:
+            return
+        job_id = json.loads(response)['job_id']
+
+        job_status = None
+        while time.perf_counter() - start < JOB_TIMEOUT:
+            time.sleep(JOB_POLL_INTERVAL)
+            status, response = self.request('job_status', f'/jobs/{job_id}')
+            if status == 200:
+                job_status = json.loads(response)['status']
+                if job_status in ('done', 'failed'):
+                    break
+        self.recorder.record('upload_job', time.perf_counter() - start, job_status == 'done')
+        if job_status == 'done':
+            self.jobs.append(job_id)
+
+    # Download the result of one of this user's finished jobs (uploading first when there is none yet)
+    def download(self):
+        if not self.jobs:
+            return self.upload()
+        self.request('download', f'/download_file?job_id={self.rng.choice(self.jobs)}')
+
+    # Read a page of the stored results of one of this user's finished jobs, best scores first
+    def results(self):
+        if not self.jobs:
+            return self.upload()
+        self.request('results', f'/api/jobs/{self.rng.choice(self.jobs)}/results?sort=score&limit=100')
+
+
+# Sign a user up, then perform actions drawn from the mix until the deadline
+def run_user(user: VirtualUser, mix: dict, start_at: float, deadline: float, think_time: float):
+    time.sleep(max(0.0, start_at - time.monotonic()))
+    user.sign_up()
+    actions, weights = list(mix), list(mix.values())
+    while time.monotonic() < deadline:
+        getattr(user, user.rng.choices(actions, weights)[0])()
+        if think_time > 0:
+            time.sleep(user.rng.expovariate(1 / think_time))
+
+
+# Prepare a throwaway working directory for the app: the static directories it writes to, an admin key, and the
+# reference database with its compiled copy
+def prepare_workdir(workdir: str, reference: list):
+    for directory in ('databases', 'records', 'matches', 'results', 'profiles'):
+        os.makedirs(os.path.join(workdir, 'static', directory), exist_ok=True)
+    with open(os.path.join(workdir, 'static', 'admin_key.txt'), 'w') as f:
+        f.write(secrets.token_hex(16))
+
+    database_path = os.path.join(workdir, 'static', 'databases', DATABASE_NAME)
+    database_store.write_workbook(database_path, 'name', reference)
+    database_store.convert_database(database_path)
+
+
+# Find a free local port for the server
+def _free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+
+# Start the app in its own process, in the working directory and with the throwaway database
+def start_server(workdir: str, port: int, gunicorn_workers: int, threads: int, log) -> subprocess.Popen:
+    package = __package__.rpartition('.')[0]
+    package_parent = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f'sqlite:///{os.path.join(workdir, "load_test.db")}',
+               PYTHONPATH=os.pathsep.join(filter(None, [package_parent, os.environ.get('PYTHONPATH')])))
+    if gunicorn_workers:
+        command = [sys.executable, '-m', 'gunicorn', '--workers', str(gunicorn_workers), '--threads', str(threads),
+                   '--timeout', str(int(REQUEST_TIMEOUT)), '--bind', f'127.0.0.1:{port}', f'{package}.main:app']
+    else:
+        command = [sys.executable, '-m', f'{__package__}.load_test', '--serve', str(port)]
+    return subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+# Wait until the server answers, failing when it exits or does not answer in time
+def wait_for_server(process: subprocess.Popen, base_url: str):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'The server exited with code {process.returncode}')
+        try:
+            with urllib.request.urlopen(base_url + '/login', timeout=5):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start')
+
+
+# Serve the app with werkzeug's threaded server (the process started by start_server)
+def serve(port: int):
+    from werkzeug.serving import make_server
+    from .. import create_app
+    make_server('127.0.0.1', port, create_app(), threaded=True).serve_forever()
+
+
+# Print a short table of the numbers of every route
+def _print_summary(routes: dict):
+    print(f"{'route':<14}{'requests':>10}{'errors':>8}{'req/s':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for route, stats in routes.items():
+        print(f"{route:<14}{stats['requests']:>10}{stats['errors']:>8}{stats['requests_per_second']:>9}"
+              f"{stats['p50_ms']:>10}{stats['p90_ms']:>10}{stats['p99_ms']:>10}{stats['max_ms']:>10}")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Load-test the record matching web application over HTTP.')
+    parser.add_argument('--users', type=int, default=DEFAULT_USERS, help='number of concurrent users')
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, help='seconds of load after the ramp-up')
+    parser.add_argument('--ramp-up', type=float, default=0.0, help='seconds over which the users start')
+    parser.add_argument('--think-time', type=float, default=0.0,
+                        help='mean pause (seconds) of a user between two actions')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help=f'comma-separated action=weight pairs ({", ".join(ACTIONS)})')
+    parser.add_argument('--reference-size', type=int, default=DEFAULT_REFERENCE_SIZE,
+                        help='names in the generated reference database')
+    parser.add_argument('--upload-rows', type=int, default=DEFAULT_UPLOAD_ROWS, help='names per uploaded file')
+    parser.add_argument('--upload-format', choices=['xlsx', 'csv'], default='xlsx', help='result format of uploads')
+    parser.add_argument('--gunicorn-workers', type=int, default=0,
+                        help='serve with gunicorn and this many workers instead of the werkzeug server')
+    parser.add_argument('--threads', type=int, default=4, help='threads per gunicorn worker')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory (database, logs, results)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='load_test_results.json', help='JSON results file')
+    parser.add_argument('--serve', type=int, metavar='PORT', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        serve(args.serve)
+        return
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    # Generate the reference database and the noisy names the users look up and upload
+    reference = generate_reference(args.reference_size, args.seed)
+    queries, _ = generate_queries(reference, max(args.upload_rows, 1000), args.seed + 1)
+
+    workdir = tempfile.mkdtemp(prefix='load-test-')
+    log_path = os.path.join(workdir, 'server.log')
+    process = None
+    try:
+        prepare_workdir(workdir, reference)
+        port = _free_port()
+        base_url = f'http://127.0.0.1:{port}'
+        with open(log_path, 'w') as log:
+            process = start_server(workdir, port, args.gunicorn_workers, args.threads, log)
+        wait_for_server(process, base_url)
+
+        # Every user runs in its own thread; the users start evenly over the ramp-up
+        recorder = Recorder()
+        start = time.monotonic()
+        deadline = start + args.ramp_up + args.duration
+        threads = []
+        for number in range(args.users):
+            user = VirtualUser(number, base_url, recorder, queries, args.upload_rows, args.upload_format,
+                               args.seed + number)
+            start_at = start + args.ramp_up * number / max(args.users, 1)
+            thread = threading.Thread(target=run_user, args=(user, mix, start_at, deadline, args.think_time))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        elapsed = time.monotonic() - start
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if args.keep:
+            print(f'Working directory kept in {workdir}', file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    routes = recorder.summary(elapsed)
+    output = {
+        'environment': _environment(),
+        'settings': {'users': args.users, 'duration': args.duration, 'ramp_up': args.ramp_up,
+                     'think_time': args.think_time, 'mix': mix, 'reference_size': args.reference_size,
+                     'upload_rows': args.upload_rows, 'upload_format': args.upload_format,
+                     'server': f'gunicorn ({args.gunicorn_workers} workers, {args.threads} threads)'
+                     if args.gunicorn_workers else 'werkzeug (threaded)', 'seed': args.seed},
+        'elapsed_seconds': round(elapsed, 3),
+        'routes': routes,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+    _print_summary(routes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+# Benchmark the matching engine on synthetic company-name corpora
+#
+# Run from the directory that contains the package, e.g.
+#     python -m website.benchmarks.run_benchmarks --sizes 1000,10000,100000 --output benchmark_results.json
+# Every corpus size runs in a fresh process so that its peak RSS is measured on its own.
+
+# Import required modules
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import rapidfuzz
+from rapidfuzz import process as rapidfuzz_process
+
+from .. import candidate_index
+from .. import database_store
+from .. import ingest
+from .. import matching
+from .. import normalization
+from .. import reports
+from .. import scorers
+from .. import threshold_matching
+from .synthetic import generate_reference, generate_queries
+
+# Default corpus sizes and number of noisy records matched against each corpus
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+DEFAULT_QUERIES = 1000
+
+# Largest corpus written as a workbook to time the xlsx conversion (writing bigger workbooks takes minutes)
+DEFAULT_CONVERT_MAX = 100000
+
+# Number of matches kept per record, as in the upload path
+N_MATCHES = 3
+
+
+# Call a function and return its result with the elapsed wall-clock time in seconds
+def _timed(function, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+# Describe a stage by its duration and throughput
+def _stage(seconds: float, rows: int) -> dict:
+    return {'seconds': round(seconds, 6), 'rows': rows,
+            'rows_per_second': round(rows / seconds, 1) if seconds else None}
+
+
+# Latency percentiles (in milliseconds) of a list of timings in seconds
+def _latency(timings: list) -> dict:
+    timings_ms = np.array(timings) * 1000
+    return {
+        'queries': len(timings),
+        'p50_ms': round(float(np.percentile(timings_ms, 50)), 4),
+        'p99_ms': round(float(np.percentile(timings_ms, 99)), 4),
+        'mean_ms': round(float(timings_ms.mean()), 4),
+    }
+
+
+# Fraction of records whose source reference row is among their top matches
+def _recall(rows: np.ndarray, truth: list) -> float:
+    return round(float(np.mean([row in matched for row, matched in zip(truth, rows)])), 4)
+
+
+# Score every record against every key with the minimum score as cutoff, without length pruning, a chunk of records
+# at a time so that one score matrix stays within matching.DEFAULT_CHUNK_BYTES like threshold_matching does
+# Returns the number of pairs reaching the minimum score
+def _threshold_unpruned(record_keys: list, keys: list, min_score: float, scorer) -> int:
+    scale = scorers.score_scale(scorer)
+    chunk_rows = max(1, matching.DEFAULT_CHUNK_BYTES // (max(len(keys), 1) * np.dtype(np.float64).itemsize))
+    matches = 0
+    for start in range(0, len(record_keys), chunk_rows):
+        chunk_scores = rapidfuzz_process.cdist(record_keys[start:start + chunk_rows], keys, scorer=scorer,
+                                               dtype=np.float64, workers=-1, score_cutoff=min_score / scale)
+        matches += int(np.count_nonzero(chunk_scores * scale >= min_score))
+    return matches
+
+
+# Time whole upload jobs (jobs._match_upload), one per mode: writing the upload, then counting, streaming,
+# normalizing, matching, writing the workbook and storing the results, with the database loaded cold like in a new
+# worker. Runs in 'workdir', which holds the static/ layout with the reference database
+def _batch_end_to_end(workdir: str, database_name: str, queries: list, modes: list, pipeline: str, scorer_name: str,
+                      candidate_limit: int, min_score: float) -> dict:
+    from .. import create_app, jobs, metrics
+    from ..match_cache import match_cache
+    from ..models import MatchJob
+    from ..reference_cache import reference_cache
+
+    cwd = os.getcwd()
+    os.environ['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(workdir, "benchmark.db")}'
+    os.chdir(workdir)
+    try:
+        app = create_app(preload=False)
+        batch = {}
+        with app.app_context():
+            for mode in modes:
+                reference_cache.clear()
+                match_cache.clear()
+                job = MatchJob(user_id=1, database_name=database_name)
+                jobs.db.session.add(job)
+                jobs.db.session.commit()
+                options = {'database_name': database_name, 'match_mode': mode, 'candidate_limit': candidate_limit,
+                           'rerank': False, 'min_score': min_score, 'normalizer': pipeline,
+                           'scorer': scorer_name, 'output_format': 'xlsx', 'charts': False, 'profile': False,
+                           'fields': [], 'name_weight': 1.0}
+
+                def run():
+                    upload_path = os.path.join('static', 'records', f'records_{job.id}.csv')
+                    pd.DataFrame({'name': queries}).to_csv(upload_path, index=False)
+                    jobs._match_upload(job.id, upload_path, 'benchmark', options, metrics.StageTimer(),
+                                       os.path.join('static', 'matches', f'result_{job.id}.xlsx'))
+
+                _, seconds = _timed(run)
+                batch[mode] = _stage(seconds, len(queries))
+        return batch
+    finally:
+        os.chdir(cwd)
+
+
+# Benchmark one corpus size; runs in its own process
+def run_case(size: int, n_queries: int, single_queries: int, modes: list, pipeline: str, scorer_name: str,
+             candidate_limit: int, convert_max: int, seed: int, min_score: float) -> dict:
+    scorer = scorers.get_scorer(scorer_name)
+    reference = generate_reference(size, seed)
+    queries, truth = generate_queries(reference, n_queries, seed + 1)
+    stages = {}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Load: convert the workbook once (small corpora only), then map the compiled copy as the cache does
+        # (the reference database sits in the static/ layout the upload jobs expect, see _batch_end_to_end)
+        for directory in ('databases', 'records', 'matches', 'results'):
+            os.makedirs(os.path.join(tmp, 'static', directory))
+        database_path = os.path.join(tmp, 'static', 'databases', 'reference.xlsx')
+        if size <= convert_max:
+            pd.DataFrame({'names': reference}).to_excel(database_path, index=False)
+            _, seconds = _timed(database_store.convert_database, database_path)
+            stages['convert'] = _stage(seconds, size)
+        else:
+            # An empty workbook stands in for the large one, which the compiled copy written after it is current for
+            open(database_path, 'wb').close()
+            database_store.write_artifact(database_store.artifact_path(database_path),
+                                          {'names': reference, 'choices': [name.lower() for name in reference]},
+                                          {'version': 1, 'column': 'names', 'fields': []})
+
+        def load():
+            artifact = database_store.read_artifact(database_store.artifact_path(database_path))
+            return artifact['names'].tolist()
+
+        names, seconds = _timed(load)
+        stages['load'] = _stage(seconds, size)
+
+        # Ingest: stream the records from a CSV upload
+        records_path = os.path.join(tmp, 'records.csv')
+        pd.DataFrame({'name': queries}).to_csv(records_path, index=False)
+        batches, seconds = _timed(lambda: list(ingest.iter_batches(records_path)))
+        stages['ingest'] = _stage(seconds, n_queries)
+        records = [name for batch in batches for name in batch]
+
+        # Normalize: the database keys (once per database) and the uploaded records
+        keys, seconds = _timed(normalization.normalize_all, names, pipeline)
+        stages['normalize_database'] = _stage(seconds, size)
+        record_keys, seconds = _timed(normalization.normalize_all, records, pipeline)
+        stages['normalize_records'] = _stage(seconds, n_queries)
+
+        index = None
+        if 'indexed' in modes:
+            index, seconds = _timed(candidate_index.NGramIndex, keys)
+            stages['build_index'] = _stage(seconds, size)
+
+        # The TF-IDF vectors (scipy is only imported when the mode is benchmarked)
+        tfidf = None
+        if 'tfidf' in modes:
+            from ..tfidf_matching import TfidfIndex
+            tfidf, seconds = _timed(TfidfIndex, keys)
+            stages['build_tfidf_index'] = _stage(seconds, size)
+
+        # Score: batch matching in every requested mode
+        recall = {}
+        for mode in modes:
+            mode_index = index if mode == 'indexed' else None
+            (rows, scores), seconds = _timed(matching.top_matches, record_keys, keys, n_matches=N_MATCHES,
+                                             scorer=scorer, index=mode_index,
+                                             candidate_limit=candidate_limit if mode == 'indexed' else None,
+                                             tfidf=tfidf if mode == 'tfidf' else None)
+            stages[f'score_{mode}'] = _stage(seconds, n_queries)
+            recall[mode] = _recall(rows, truth)
+
+        # Threshold matching: every match scoring at least min_score, scoring only the keys whose length can reach
+        # it, against the same cutoff applied to every key
+        length_index, seconds = _timed(threshold_matching.LengthIndex, keys)
+        stages['build_length_index'] = _stage(seconds, size)
+        (match_names, _, _, pruning), seconds = _timed(threshold_matching.threshold_matches, record_keys, keys,
+                                                       min_score, scorer=scorer, length_index=length_index)
+        stages['score_threshold'] = _stage(seconds, n_queries)
+        _, seconds = _timed(_threshold_unpruned, record_keys, keys, min_score, scorer)
+        stages['score_threshold_unpruned'] = _stage(seconds, n_queries)
+        threshold = dict(pruning, min_score=min_score, matches=len(match_names),
+                         pruned_share=round(pruning['pruned'] / pruning['pairs'], 4) if pruning['pairs'] else None)
+
+        # Report: write the results of the last mode with the fast workbook path
+        labels = np.array(names + [None], dtype=object)
+        result_df = pd.DataFrame({'name': records})
+        for i in range(rows.shape[1]):
+            result_df[f'match{i + 1}'] = labels[rows[:, i]]
+            result_df[f'match_score{i + 1}'] = scores[:, i]
+        _, seconds = _timed(reports.write_report, result_df, N_MATCHES, os.path.join(tmp, 'result.xlsx'))
+        stages['report'] = _stage(seconds, n_queries)
+
+        # End to end: one real upload job per mode, from the uploaded records to the written workbook
+        batch = _batch_end_to_end(tmp, os.path.basename(database_path), queries, modes, pipeline, scorer_name,
+                                  candidate_limit, min_score)
+
+    # Single match: one record at a time, as the JSON API answers it
+    single = {}
+    for mode in modes:
+        timings = []
+        for query in queries[:single_queries]:
+            start = time.perf_counter()
+            if mode == 'tfidf':
+                tfidf.top_matches([normalization.normalize(query, pipeline)], keys, N_MATCHES)
+            else:
+                candidate_index.extract(normalization.normalize(query, pipeline), keys,
+                                        index=index if mode == 'indexed' else None, scorer=scorer, limit=N_MATCHES,
+                                        candidate_limit=candidate_limit if mode == 'indexed' else None)
+            timings.append(time.perf_counter() - start)
+        single[mode] = _latency(timings)
+
+    return {
+        'size': size,
+        'queries': n_queries,
+        'stages': stages,
+        'batch_end_to_end': batch,
+        'single_match': single,
+        'top3_recall': recall,
+        'threshold': threshold,
+        # ru_maxrss is reported in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+# Describe the machine and library versions, so result files from different runs can be compared
+def _environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'rapidfuzz': rapidfuzz.__version__,
+    }
+
+
+# Print a short table of the main numbers
+def _print_summary(results: list):
+    for result in results:
+        print(f"size={result['size']:>8} peak_rss={result['peak_rss_mb']:>8.1f} MB")
+        for mode, stage in result['batch_end_to_end'].items():
+            single = result['single_match'][mode]
+            print(f"  {mode:>8}: batch {stage['rows_per_second']} rows/s, single p50 {single['p50_ms']} ms "
+                  f"p99 {single['p99_ms']} ms, top-3 recall {result['top3_recall'][mode]}")
+        threshold = result['threshold']
+        print(f"  threshold {threshold['min_score']}: {result['stages']['score_threshold']['rows_per_second']} rows/s "
+              f"({result['stages']['score_threshold_unpruned']['rows_per_second']} rows/s unpruned), "
+              f"{threshold['pruned_share']:.1%} of pairs pruned by length, {threshold['matches']} matches")
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Benchmark the record matching engine on synthetic corpora.')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='comma-separated reference database sizes')
+    parser.add_argument('--queries', type=int, default=DEFAULT_QUERIES, help='noisy records matched per size')
+    parser.add_argument('--single-queries', type=int, default=200, help='records timed one at a time')
+    parser.add_argument('--modes', default='full,indexed', help='comma-separated matching modes (full, indexed, tfidf)')
+    parser.add_argument('--normalizer', default=normalization.DEFAULT_PIPELINE, help='normalization pipeline')
+    parser.add_argument('--scorer', default=scorers.DEFAULT_SCORER, choices=sorted(scorers.SCORERS))
+    parser.add_argument('--candidate-limit', type=int, default=candidate_index.DEFAULT_CANDIDATE_LIMIT)
+    parser.add_argument('--min-score', type=float, default=reports.SCORE_THRESHOLD,
+                        help='minimum score of the threshold matching benchmark')
+    parser.add_argument('--convert-max', type=int, default=DEFAULT_CONVERT_MAX,
+                        help='largest size for which the xlsx conversion is timed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark_results.json', help='JSON results file')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    modes = [mode for mode in args.modes.split(',') if mode]
+    unknown = set(modes) - {'full', 'indexed', 'tfidf'}
+    if unknown:
+        parser.error(f'unknown mode(s): {", ".join(sorted(unknown))}')
+    pipeline = normalization.pipeline_key(args.normalizer)
+
+    # Run every size in a fresh process so peak RSS is not inherited from a previous size
+    results = []
+    for size in sizes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_case, size, args.queries, args.single_queries, modes, pipeline, args.scorer,
+                                     args.candidate_limit, args.convert_max, args.seed,
+                                     args.min_score).result()
+        results.append(result)
+        print(f'finished size {size}', file=sys.stderr)
+
+    output = {
+        'environment': _environment(),
+        'settings': {'queries': args.queries, 'single_queries': args.single_queries, 'modes': modes,
+                     'normalizer': pipeline, 'scorer': args.scorer, 'candidate_limit': args.candidate_limit,
+                     'seed': args.seed, 'n_matches': N_MATCHES, 'min_score': args.min_score},
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+    _print_summary(results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Import required modules
+import random
+
+# Words used to build synthetic company names
+_PREFIXES = [
+    'Atlantic', 'Pacific', 'Summit', 'Pioneer', 'Liberty', 'Heritage', 'Guardian', 'Union', 'National', 'Federal',
+    'Royal', 'Northern', 'Southern', 'Western', 'Eastern', 'Central', 'United', 'American', 'European', 'Global',
+    'Continental', 'Mutual', 'First', 'Great', 'Standard', 'Sovereign', 'Crown', 'Capital', 'Metropolitan', 'Allied',
+]
+_INDUSTRY = [
+    'Insurance', 'Assurance', 'Life', 'General', 'Casualty', 'Indemnity', 'Reinsurance', 'Re', 'Health', 'Surety',
+    'Financial', 'Holdings', 'Group', 'Fire', 'Marine', 'Property', 'Benefit', 'Trust', 'Guaranty', 'Risk',
+]
+_SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'ten', 'vor', 'sel', 'dan', 'bri', 'qua', 'zen', 'tor', 'pel', 'mar', 'nis',
+              'hel', 'gro', 'fin', 'ost', 'ber', 'lin', 'cas', 'ver', 'don', 'sum', 'tal', 'rik', 'ul', 'ex', 'am']
+
+# Legal suffixes and the variants a noisy record may use instead
+_SUFFIX_VARIANTS = {
+    'Inc.': ['Inc', 'Incorporated', 'inc.', ''],
+    'LLC': ['L.L.C.', 'llc', ''],
+    'Ltd': ['Ltd.', 'Limited', ''],
+    'Limited': ['Ltd', 'Ltd.', ''],
+    'Corporation': ['Corp.', 'Corp', ''],
+    'Company': ['Co.', 'Co', ''],
+    'S.A.': ['SA', 'S.A', ''],
+    'AG': ['A.G.', ''],
+    'plc': ['PLC', 'p.l.c.', ''],
+}
+_SUFFIXES = list(_SUFFIX_VARIANTS)
+
+_ALPHABET = 'abcdefghijklmnopqrstuvwxyz'
+
+
+# Make up a pronounceable word, so that large corpora contain many distinct names
+def _made_up_word(rng: random.Random) -> str:
+    return ''.join(rng.choice(_SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+
+
+# Generate 'size' distinct company names, reproducible for a given seed
+def generate_reference(size: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    names = []
+    seen = set()
+    while len(names) < size:
+        words = []
+        if rng.random() < 0.6:
+            words.append(rng.choice(_PREFIXES))
+        words.append(_made_up_word(rng))
+        words += rng.sample(_INDUSTRY, rng.randint(1, 2))
+        if rng.random() < 0.8:
+            words.append(rng.choice(_SUFFIXES))
+        name = ' '.join(words)
+        if name not in seen:
+            seen.add(name)
+            names.append(name)
+    return names
+
+
+# Apply one random typo: insertion, deletion, substitution or transposition of characters
+def _typo(rng: random.Random, text: str) -> str:
+    if len(text) < 2:
+        return text
+    i = rng.randrange(len(text) - 1)
+    kind = rng.randrange(4)
+    if kind == 0:
+        return text[:i] + rng.choice(_ALPHABET) + text[i:]
+    if kind == 1:
+        return text[:i] + text[i + 1:]
+    if kind == 2:
+        return text[:i] + rng.choice(_ALPHABET) + text[i + 1:]
+    return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+
+
+# Replace the legal suffix with one of its variants, or drop it
+def _suffix_variant(rng: random.Random, text: str) -> str:
+    words = text.split()
+    if words and words[-1] in _SUFFIX_VARIANTS:
+        words[-1] = rng.choice(_SUFFIX_VARIANTS[words[-1]])
+    return ' '.join(word for word in words if word)
+
+
+# Move one word to another position
+def _reorder(rng: random.Random, text: str) -> str:
+    words = text.split()
+    if len(words) > 1:
+        word = words.pop(rng.randrange(len(words)))
+        words.insert(rng.randrange(len(words) + 1), word)
+    return ' '.join(words)
+
+
+# Sample 'count' noisy records from the reference names
+# Returns the records and, for each one, the row of the reference name it was derived from
+def generate_queries(reference: list, count: int, seed: int = 1, typo_rate: float = 0.7, suffix_rate: float = 0.5,
+                     reorder_rate: float = 0.2) -> tuple:
+    rng = random.Random(seed)
+    queries, truth = [], []
+    for _ in range(count):
+        row = rng.randrange(len(reference))
+        text = reference[row]
+        if rng.random() < suffix_rate:
+            text = _suffix_variant(rng, text)
+        if rng.random() < reorder_rate:
+            text = _reorder(rng, text)
+        # Each further typo is half as likely as the previous one
+        typos = 0
+        while rng.random() < typo_rate / 2 ** typos:
+            text = _typo(rng, text)
+            typos += 1
+        if rng.random() < 0.3:
+            text = text.upper() if rng.random() < 0.5 else text.lower()
+        queries.append(text)
+        truth.append(row)
+    return queries, truth
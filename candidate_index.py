@@ -0,0 +1,118 @@
+# Import required modules
+import numpy as np
+from rapidfuzz import process as rapidfuzz_process
+
+from .scorers import score_scale
+
+# Length of the character n-grams used as blocking keys
+NGRAM_SIZE = 3
+
+# Default number of candidates scored per query; higher values trade speed for recall
+DEFAULT_CANDIDATE_LIMIT = 200
+
+# Largest number of candidates a request can ask for per query
+MAX_CANDIDATE_LIMIT = 10000
+
+
+# Split a string into its set of character n-grams, padding with spaces so word boundaries form n-grams too
+def ngrams(text: str, n: int = NGRAM_SIZE) -> set:
+    padded = f' {text} '
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+# Inverted index from character n-grams to the rows of a choice list that contain them
+class NGramIndex:
+    def __init__(self, choices: list, n: int = NGRAM_SIZE):
+        self.n = n
+        self.size = len(choices)
+
+        # Collect the rows for every n-gram, then freeze the posting lists as compact integer arrays
+        postings = {}
+        self.gram_counts = np.zeros(len(choices), dtype=np.int32)
+        for row, choice in enumerate(choices):
+            grams = ngrams(choice, n)
+            self.gram_counts[row] = len(grams)
+            for gram in grams:
+                postings.setdefault(gram, []).append(row)
+        self.postings = {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+        # Approximate memory footprint of the posting arrays, counted against the reference cache budget
+        self.nbytes = sum(rows.nbytes for rows in self.postings.values()) + self.gram_counts.nbytes
+
+    # Return a copy of the index after the choice list changed: 'row_map' gives the new row of every indexed row
+    # (-1 for removed rows, kept rows must stay in order) and 'added' choices are placed at 'added_rows'
+    # Only the added choices are split into n-grams; the posting lists of the other rows are renumbered
+    def updated(self, row_map: np.ndarray, added: list, added_rows: np.ndarray, size: int) -> 'NGramIndex':
+        index = NGramIndex([], self.n)
+        index.size = size
+
+        kept = row_map >= 0
+        index.gram_counts = np.zeros(size, dtype=np.int32)
+        index.gram_counts[row_map[kept]] = self.gram_counts[kept]
+
+        # Renumber the posting lists, sharing the arrays when no row moved
+        unchanged = bool(kept.all()) and np.array_equal(row_map, np.arange(len(row_map)))
+        postings = {}
+        for gram, rows in self.postings.items():
+            if not unchanged:
+                rows = row_map[rows]
+                rows = rows[rows >= 0].astype(np.int32)
+            if len(rows):
+                postings[gram] = rows
+
+        # Add the n-grams of the added choices, keeping every posting list sorted by row
+        added_postings = {}
+        for row, choice in zip(added_rows, added):
+            grams = ngrams(choice, self.n)
+            index.gram_counts[row] = len(grams)
+            for gram in grams:
+                added_postings.setdefault(gram, []).append(row)
+        for gram, rows in added_postings.items():
+            combined = np.concatenate([postings.get(gram, np.empty(0, dtype=np.int32)), np.array(rows, dtype=np.int32)])
+            postings[gram] = np.sort(combined)
+
+        index.postings = postings
+        index.nbytes = sum(rows.nbytes for rows in postings.values()) + index.gram_counts.nbytes
+        return index
+
+    # Return the rows whose n-gram sets are most similar to the query's, at most 'limit' of them (at least one)
+    def candidates(self, query: str, limit: int = DEFAULT_CANDIDATE_LIMIT) -> np.ndarray:
+        limit = max(int(limit), 1)
+        query_grams = ngrams(query, self.n)
+        posting_lists = [self.postings[gram] for gram in query_grams if gram in self.postings]
+        if not posting_lists:
+            return np.empty(0, dtype=np.int32)
+
+        # Count the shared n-grams for every row that appears in at least one posting list
+        counts = np.bincount(np.concatenate(posting_lists), minlength=self.size)
+        rows = np.flatnonzero(counts)
+        if len(rows) <= limit:
+            return rows
+
+        # Keep the rows with the highest Jaccard overlap, so long names sharing many common n-grams
+        # do not crowd out short close matches
+        shared = counts[rows]
+        overlap = shared / (self.gram_counts[rows] + len(query_grams) - shared)
+        top = np.argpartition(overlap, len(rows) - limit)[len(rows) - limit:]
+        return np.sort(rows[top])
+
+
+# Find the closest matches for a query, scoring only the candidates proposed by the index
+# Passing candidate_limit=None scores the full choice list, which gives the exhaustive results
+def extract(query: str, choices: list, index: NGramIndex = None, scorer=None, limit: int = 3,
+            candidate_limit: int = DEFAULT_CANDIDATE_LIMIT) -> list:
+    # Scores are reported between 0 and 100 whatever the native range of the scorer
+    scale = score_scale(scorer)
+
+    if index is None or candidate_limit is None:
+        matches = rapidfuzz_process.extract(query, choices, scorer=scorer, limit=limit)
+        return [(match, score * scale, row) for match, score, row in matches]
+
+    rows = index.candidates(query, candidate_limit)
+    candidates = [choices[row] for row in rows]
+    matches = rapidfuzz_process.extract(query, candidates, scorer=scorer, limit=limit)
+
+    # Map the positions in the candidate list back to rows of the full choice list
+    return [(match, score * scale, int(rows[position])) for match, score, position in matches]
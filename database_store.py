@@ -0,0 +1,360 @@
+# Import required modules
+import json
+import mmap
+import os
+import struct
+import tempfile
+from collections import Counter
+
+import numpy as np
+
+from . import normalization
+
+# Directory that holds the reference databases managed from the admin page
+DATABASE_DIR = 'static/databases/'
+
+# Suffix of the compiled copy stored next to each reference database
+ARTIFACT_SUFFIX = '.rmdb'
+
+# File signature and format version of the compiled copies
+MAGIC = b'RMDB'
+FORMAT_VERSION = 1
+
+# Fixed-size prefix: signature, format version and the length of the JSON header that follows
+_PREFIX = struct.Struct('<4sII')
+
+# Strings of a column are stored back to back, separated by this character
+_SEPARATOR = '\x00'
+
+# Suffix of files being written in the databases directory (renamed into place once complete)
+TMP_SUFFIX = '.tmp'
+
+# Ways an admin upload can change an existing database
+# replace: the database becomes the uploaded list; append: every uploaded name is added;
+# upsert: uploaded names not in the database yet are added; delete: every row holding an uploaded name is removed
+UPDATE_MODES = ('replace', 'append', 'upsert', 'delete')
+
+
+# Round a byte position up to the next multiple of 8 so the offset arrays stay aligned
+def _align(position: int) -> int:
+    return (position + 7) // 8 * 8
+
+
+# Get the path of the compiled copy of a database file
+def artifact_path(database_path: str) -> str:
+    return database_path + ARTIFACT_SUFFIX
+
+
+# Check if a file in the databases directory is a compiled copy or a file being written, rather than a database
+# uploaded by the admin
+def is_artifact(file_name: str) -> bool:
+    return file_name.endswith(ARTIFACT_SUFFIX) or file_name.endswith(TMP_SUFFIX)
+
+
+# List the reference databases uploaded by the admin, leaving out their compiled copies
+def list_databases(directory: str = DATABASE_DIR) -> list:
+    return [file_name for file_name in os.listdir(directory) if not is_artifact(file_name)]
+
+
+# Check if the compiled copy of a database exists and is at least as recent as the database file
+def is_current(database_path: str) -> bool:
+    path = artifact_path(database_path)
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(database_path)
+
+
+# A read-only list of strings backed by a memory-mapped string table
+class StringTable:
+    def __init__(self, buffer, offsets: np.ndarray, blob_start: int, blob_size: int):
+        self._buffer = buffer
+        self._offsets = offsets
+        self._blob_start = blob_start
+        self._blob_size = blob_size
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    # Decode a single string without touching the rest of the table
+    def __getitem__(self, i: int) -> str:
+        if not -len(self) <= i < len(self):
+            raise IndexError('string table index out of range')
+        i %= len(self)
+        start = self._blob_start + int(self._offsets[i])
+        end = self._blob_start + int(self._offsets[i + 1]) - 1
+        return self._buffer[start:end].decode('utf-8')
+
+    # Decode the whole table in one pass
+    def tolist(self) -> list:
+        if len(self) == 0:
+            return []
+        blob = self._buffer[self._blob_start:self._blob_start + self._blob_size]
+        return blob.decode('utf-8').split(_SEPARATOR)
+
+    # Decode the strings of rows start to end (exclusive) in one pass, without touching the rest of the table
+    def slice(self, start: int, end: int) -> list:
+        if end <= start:
+            return []
+        blob = self._buffer[self._blob_start + int(self._offsets[start]):self._blob_start + int(self._offsets[end]) - 1]
+        return blob.decode('utf-8').split(_SEPARATOR)
+
+
+# A compiled reference database: named string columns of equal length plus free-form metadata
+# 'path' and 'mtime' identify the file it was mapped from
+class Artifact:
+    def __init__(self, buffer, header: dict, data_start: int, path: str = None, mtime: float = None):
+        self._buffer = buffer
+        self.path = path
+        self.mtime = mtime
+        self.count = header['count']
+        self.metadata = header['metadata']
+        self.columns = {}
+        for name, column in header['columns'].items():
+            offsets = np.frombuffer(buffer, dtype='<u8', count=self.count + 1, offset=data_start + column['offsets'])
+            self.columns[name] = StringTable(buffer, offsets, data_start + column['blob'], column['size'])
+
+    def __getitem__(self, name: str) -> StringTable:
+        return self.columns[name]
+
+
+# Write a file through a temporary file of its own next to its final path, renamed into place once 'write' (called
+# with the temporary path) has filled it, so readers never see a partial file and writers of the same file in
+# several processes (e.g. web workers converting a database on first use) never write into each other's file
+def _replace_file(path: str, write):
+    descriptor, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix=TMP_SUFFIX,
+                                            dir=os.path.dirname(path) or '.')
+    os.close(descriptor)
+    try:
+        write(tmp_path)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+# Write string columns to a compiled copy, replacing the file once it is complete (see _replace_file)
+def write_artifact(path: str, columns: dict, metadata: dict = None):
+    count = len(next(iter(columns.values()), []))
+    header = {'count': count, 'columns': {}, 'metadata': metadata or {}}
+    sections = []
+    position = 0
+
+    for name, values in columns.items():
+        if len(values) != count:
+            raise ValueError('All columns must have the same length.')
+
+        # Encode the strings and record where each one starts (the separator follows every string)
+        encoded = [value.replace(_SEPARATOR, '').encode('utf-8') for value in values]
+        offsets = np.zeros(count + 1, dtype='<u8')
+        offsets[1:] = np.cumsum([len(value) + 1 for value in encoded], dtype=np.uint64)
+        blob = _SEPARATOR.encode('utf-8').join(encoded)
+
+        header['columns'][name] = {'offsets': position, 'blob': position + offsets.nbytes, 'size': len(blob)}
+        sections.append(offsets.tobytes())
+        sections.append(blob)
+        position = _align(position + offsets.nbytes + len(blob))
+        sections.append(b'\0' * (position - (header['columns'][name]['blob'] + len(blob))))
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (_align(_PREFIX.size + len(header_bytes)) - _PREFIX.size - len(header_bytes))
+
+    def write(tmp_path: str):
+        with open(tmp_path, 'wb') as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for section in sections:
+                f.write(section)
+
+    _replace_file(path, write)
+
+
+# Memory-map a compiled copy; the pages are shared by every process that maps the same file
+def read_artifact(path: str) -> Artifact:
+    with open(path, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        if stat.st_size == 0:
+            raise ValueError(f'{path} is empty')
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, header_size = _PREFIX.unpack_from(buffer, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError(f'{path} is not a compiled reference database')
+
+    header = json.loads(bytes(buffer[_PREFIX.size:_PREFIX.size + header_size]))
+    return Artifact(buffer, header, _PREFIX.size + header_size, path, stat.st_mtime)
+
+
+# Name of the column holding the names normalized with a pipeline
+def normalized_column(pipeline: str) -> str:
+    return f'normalized:{pipeline}'
+
+
+# Name of the column holding the values of another column of the database workbook (e.g. a city or postcode)
+def field_column(field: str) -> str:
+    return f'field:{field}'
+
+
+# Text of a cell of another column (of a database workbook or of a record file): empty cells are empty strings, and
+# whole numbers (e.g. postcodes read as numbers) lose the '.0' pandas gives them when the column has empty cells
+def cell_text(value) -> str:
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+# Read a database workbook: the names of its first column (as strings, with empty cells removed) and the values of
+# its other columns in the rows that have a name
+# Returns the header of the first column, the names and the values of the other columns by header
+# (pandas and openpyxl are imported by the functions that read or write workbooks, so that listing the databases
+# does not load them)
+def read_table(workbook_path: str) -> tuple:
+    import pandas as pd
+    df = pd.read_excel(workbook_path)
+    df = df[df[df.columns[0]].notna()]
+    fields = {str(header): [cell_text(value) for value in df[header].tolist()] for header in df.columns[1:]}
+    return str(df.columns[0]), df[df.columns[0]].astype(str).tolist(), fields
+
+
+# Compute the columns stored in a compiled copy for a list of names: the names, lowercased choices, the keys of
+# every named normalization pipeline and the values of the other columns of the workbook
+def _columns(names: list, fields: dict = None) -> dict:
+    columns = {'names': names, 'choices': [value.lower() for value in names]}
+    for pipeline in normalization.PIPELINES:
+        if pipeline != normalization.DEFAULT_PIPELINE:
+            columns[normalized_column(pipeline)] = normalization.normalize_all(names, pipeline)
+    for field, values in (fields or {}).items():
+        columns[field_column(field)] = values
+    return columns
+
+
+# Parse a database workbook once and store its names, lowercased choices, the keys of every named normalization
+# pipeline and its other columns as a compiled copy
+def convert_database(database_path: str) -> Artifact:
+    column, names, fields = read_table(database_path)
+
+    path = artifact_path(database_path)
+    write_artifact(path, _columns(names, fields), {'version': 1, 'column': column, 'fields': list(fields)})
+    return read_artifact(path)
+
+
+# Load the compiled copy of a database, converting the workbook first when the copy is missing or outdated
+# (copies written before the other columns of the workbook were stored are converted again too)
+def load_database(database_path: str) -> Artifact:
+    if is_current(database_path):
+        try:
+            artifact = read_artifact(artifact_path(database_path))
+            if 'fields' in artifact.metadata:
+                return artifact
+        except ValueError:
+            pass
+    return convert_database(database_path)
+
+
+# Compute how a database changes when an uploaded list of rows is applied to it
+# Rows are compared as a whole: a name, or a tuple of a name and the values of its other columns
+# Returns 'row_map', the new row of every current row (-1 for removed rows), and the rows appended at the end
+# Rows that stay keep their order, so derived data (normalized keys, indexes, cached results) can be carried over
+def diff_rows(current: list, uploaded: list, mode: str) -> tuple:
+    if mode not in UPDATE_MODES:
+        raise ValueError(f'Unknown update mode: {mode}')
+
+    keep = np.ones(len(current), dtype=bool)
+    if mode == 'append':
+        added = list(uploaded)
+    elif mode == 'upsert':
+        present = set(current)
+        added = [name for name in dict.fromkeys(uploaded) if name not in present]
+    elif mode == 'delete':
+        removed = set(uploaded)
+        keep = np.fromiter((name not in removed for name in current), dtype=bool, count=len(current))
+        added = []
+    else:
+        # Compare the lists as multisets: surplus copies of a name are removed from the end,
+        # missing copies are added
+        wanted = Counter(uploaded)
+        for row, name in enumerate(current):
+            if wanted[name] > 0:
+                wanted[name] -= 1
+            else:
+                keep[row] = False
+        added = []
+        for name in uploaded:
+            if wanted[name] > 0:
+                wanted[name] -= 1
+                added.append(name)
+
+    row_map = np.full(len(current), -1, dtype=np.int64)
+    row_map[keep] = np.arange(int(keep.sum()))
+    return row_map, added
+
+
+# Write the names of a database and the values of its other columns to its workbook, replacing the file once it is
+# complete
+def write_workbook(database_path: str, column: str, names: list, fields: dict = None):
+    from openpyxl.workbook import Workbook
+    fields = fields or {}
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    sheet.append([column] + list(fields))
+    for name, *values in zip(names, *fields.values()):
+        sheet.append([name] + values)
+    _replace_file(database_path, wb.save)
+
+
+# Header of the first column of a workbook, for compiled copies written before it was recorded
+def _read_header(database_path: str) -> str:
+    from openpyxl import load_workbook
+    wb = load_workbook(database_path, read_only=True)
+    try:
+        row = next(wb.active.iter_rows(max_row=1, values_only=True), None)
+        return str(row[0]) if row and row[0] is not None else 'names'
+    finally:
+        wb.close()
+
+
+# Apply an uploaded list of names to a database without recomputing what did not change:
+# the stored columns of the rows that stay are copied, and only the added names are normalized
+# 'uploaded_fields' holds the values of the other columns of the upload by header; rows are compared on the name and
+# those columns, and the added rows take their values (columns of the database missing from the upload are left
+# empty). Raises ValueError for upload columns the database does not have
+# The workbook is rewritten first and the compiled copy after it, so the copy stays current, and its version
+# number is incremented. Returns the new compiled copy, the row map and the number of added rows
+def update_database(database_path: str, uploaded: list, mode: str, uploaded_fields: dict = None) -> tuple:
+    artifact = load_database(database_path)
+    fields = artifact.metadata.get('fields', [])
+    uploaded_fields = uploaded_fields or {}
+    unknown = [field for field in uploaded_fields if field not in fields]
+    if unknown:
+        raise ValueError(f'Columns not in the database: {", ".join(unknown)}')
+
+    # Compare the rows on the name and the columns of the upload
+    compared = [field for field in fields if field in uploaded_fields]
+    current = list(zip(artifact['names'].tolist(), *[artifact[field_column(field)].tolist() for field in compared]))
+    row_map, added = diff_rows(current, list(zip(uploaded, *[uploaded_fields[field] for field in compared])), mode)
+    kept = np.flatnonzero(row_map >= 0)
+
+    # Copy the kept rows of every stored column and compute the same columns for the added names
+    added_values = dict(zip(compared, ([row[i] for row in added] for i in range(1, len(compared) + 1))))
+    added_columns = _columns([row[0] for row in added],
+                             {field: added_values.get(field, [''] * len(added)) for field in fields})
+    columns = {}
+    for name, table in artifact.columns.items():
+        values = table.tolist()
+        columns[name] = [values[row] for row in kept] + added_columns[name]
+
+    metadata = dict(artifact.metadata)
+    metadata['column'] = metadata.get('column') or _read_header(database_path)
+    metadata['version'] = metadata.get('version', 1) + 1
+
+    write_workbook(database_path, metadata['column'], columns['names'],
+                   {field: columns[field_column(field)] for field in fields})
+    path = artifact_path(database_path)
+    write_artifact(path, columns, metadata)
+    return read_artifact(path), row_map, len(added)
+
+
+# Remove the compiled copy of a database, if there is one
+def remove_artifact(database_path: str):
+    if os.path.exists(artifact_path(database_path)):
+        os.remove(artifact_path(database_path))
@@ -0,0 +1,167 @@
+# Duplicate detection within a reference database: every pair of names scoring at least a minimum score against
+# each other, grouped into clusters of names that are linked by such pairs
+#
+# Names are only compared within blocks. Every name is put in the blocks of its rarest character n-grams, which
+# near-duplicates share, so the work grows with the size of the blocks rather than with the square of the database.
+# Within a block the names are sorted by length, and names too far apart in length to reach the minimum score
+# (see scorers.min_length_ratio) are not compared
+
+# Import required modules
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz as rapidfuzz
+from rapidfuzz import process as rapidfuzz_process
+
+from .candidate_index import NGRAM_SIZE, ngrams
+from .scorers import min_length_ratio, score_scale
+from .threshold_matching import length_window
+
+# Number of rarest n-grams of each name used as its blocking keys; more keys find more pairs and score more
+BLOCK_KEYS = 8
+
+# Largest block scored; larger blocks hold names made only of very common n-grams and are skipped (and counted)
+MAX_BLOCK_ROWS = 5000
+
+# Number of names of a block scored at once against the rest of the block, bounding the score matrix
+CHUNK_ROWS = 500
+
+# Slack on the score cutoff handed to rapidfuzz, which can reject pairs scoring exactly the cutoff
+_CUTOFF_TOLERANCE = 1e-6
+
+
+# Group the rows of the keys into blocks: every row joins the blocks of its 'n_keys' rarest n-grams
+# N-grams found in a single name cannot bring two names together (typos create many of them), so they are never
+# used as blocking keys. Returns the blocks as arrays of rows, in row order
+def blocks(keys: list, n_keys: int = BLOCK_KEYS, n: int = NGRAM_SIZE) -> list:
+    grams = [ngrams(key, n) for key in keys]
+    frequency = Counter(gram for key_grams in grams for gram in key_grams)
+
+    members = {}
+    for row, key_grams in enumerate(grams):
+        shared = [gram for gram in key_grams if frequency[gram] > 1]
+        for gram in sorted(shared, key=lambda gram: (frequency[gram], gram))[:n_keys]:
+            members.setdefault(gram, []).append(row)
+    return [np.array(rows, dtype=np.int64) for rows in members.values() if len(rows) > 1]
+
+
+# Score the names of a block against each other; returns the pairs reaching the minimum score (as rows of the
+# database, each pair once) and the number of comparisons
+def _score_block(rows: np.ndarray, keys: list, min_score: float, scorer, workers: int) -> tuple:
+    scale = score_scale(scorer)
+    ratio = min_length_ratio(scorer, min_score)
+
+    # Sort the block by length: each name is only compared with the names after it that are not too long for it
+    lengths = np.fromiter((len(keys[row]) for row in rows.tolist()), dtype=np.int64, count=len(rows))
+    order = np.argsort(lengths, kind='stable')
+    rows, lengths = rows[order], lengths[order]
+    block_keys = [keys[row] for row in rows.tolist()]
+
+    lefts, rights, scores = [], [], []
+    compared = 0
+    for start in range(0, len(rows), CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, len(rows))
+
+        # The longest name of the chunk bounds the length of the names that can reach the minimum score
+        stop = int(np.searchsorted(lengths, length_window(int(lengths[end - 1]), ratio)[1], side='right'))
+        chunk_scores = rapidfuzz_process.cdist(block_keys[start:end], block_keys[start:stop], scorer=scorer,
+                                               dtype=np.float64, workers=workers,
+                                               score_cutoff=max(0.0, min_score / scale - _CUTOFF_TOLERANCE)) * scale
+        compared += (end - start) * (stop - start)
+
+        # Keep each pair once: a name with the names after it in the block
+        left, right = np.nonzero(chunk_scores >= min_score)
+        after = right > left
+        left, right = left[after], right[after]
+        lefts.append(rows[start + left])
+        rights.append(rows[start + right])
+        scores.append(chunk_scores[left, right])
+
+    left, right = np.concatenate(lefts), np.concatenate(rights)
+    return np.minimum(left, right), np.maximum(left, right), np.concatenate(scores), compared
+
+
+# Find the pairs of rows whose keys score at least 'min_score' (0-100) against each other
+# Returns three arrays (first row, second row with first < second, score) sorted by rows, and the counts
+# {'blocks', 'compared', 'skipped_blocks', 'skipped_rows'}. 'progress' is called with the fraction of blocks done
+def find_pairs(keys: list, min_score: float, scorer=rapidfuzz.ratio, n_keys: int = BLOCK_KEYS,
+               max_block_rows: int = MAX_BLOCK_ROWS, workers: int = -1, progress=None) -> tuple:
+    key_blocks = blocks(keys, n_keys)
+    stats = {'blocks': len(key_blocks), 'compared': 0, 'skipped_blocks': 0, 'skipped_rows': 0}
+
+    found_left, found_right, found_scores = [], [], []
+    for position, rows in enumerate(key_blocks):
+        if len(rows) > max_block_rows:
+            stats['skipped_blocks'] += 1
+            stats['skipped_rows'] += len(rows)
+            continue
+
+        left, right, scores, compared = _score_block(rows, keys, min_score, scorer, workers)
+        found_left.append(left)
+        found_right.append(right)
+        found_scores.append(scores)
+        stats['compared'] += compared
+
+        if progress is not None:
+            progress((position + 1) / len(key_blocks))
+
+    if not found_left:
+        empty = np.empty(0, dtype=np.int64)
+        return empty, empty, np.empty(0, dtype=np.float64), stats
+
+    # Pairs found in several blocks are kept once
+    left, right, scores = np.concatenate(found_left), np.concatenate(found_right), np.concatenate(found_scores)
+    _, first = np.unique(left * len(keys) + right, return_index=True)
+    return left[first], right[first], scores[first], stats
+
+
+# Label every row with the cluster it belongs to, joining the rows of every pair (union-find)
+# Rows without a pair form a cluster of their own; labels are the smallest row of each cluster
+def cluster_labels(size: int, left: np.ndarray, right: np.ndarray) -> np.ndarray:
+    parent = list(range(size))
+
+    def find(row: int) -> int:
+        while parent[row] != row:
+            # Halve the path on the way up, so later lookups are shorter
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for first, second in zip(left.tolist(), right.tolist()):
+        first, second = find(first), find(second)
+        if first != second:
+            parent[max(first, second)] = min(first, second)
+    return np.array([find(row) for row in range(size)], dtype=np.int64)
+
+
+# Describe the clusters with more than one name for review: one row per name with its cluster number (largest
+# clusters first), the cluster size, its row in the database (1-based) and the name
+def cluster_table(names: list, labels: np.ndarray) -> pd.DataFrame:
+    _, inverse, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    sizes = counts[inverse]
+    rows = np.flatnonzero(sizes > 1)
+
+    # Number the clusters from the largest down, ties by their first row
+    order = np.lexsort((rows, labels[rows], -sizes[rows]))
+    rows = rows[order]
+    first_rows = np.r_[True, labels[rows][1:] != labels[rows][:-1]] if len(rows) else np.empty(0, dtype=bool)
+    return pd.DataFrame({
+        'cluster': np.cumsum(first_rows),
+        'size': sizes[rows],
+        'row': rows + 1,
+        'name': [names[row] for row in rows.tolist()],
+    })
+
+
+# Describe the pairs for review: both names, their rows in the database (1-based) and their score, best first
+def pair_table(names: list, left: np.ndarray, right: np.ndarray, scores: np.ndarray) -> pd.DataFrame:
+    order = np.lexsort((right, left, -scores))
+    left, right = left[order], right[order]
+    return pd.DataFrame({
+        'row1': left + 1,
+        'name1': [names[row] for row in left.tolist()],
+        'row2': right + 1,
+        'name2': [names[row] for row in right.tolist()],
+        'score': scores[order],
+    })
@@ -0,0 +1,178 @@
+# Multi-field matching: records with a name and other fields (e.g. city, postcode) matched against the rows of a
+# reference database that holds the same fields in the other columns of its workbook
+#
+# Blocking fields are compared exactly, ignoring case, spaces and punctuation: a record is only scored against the
+# database rows with the same values in every blocking field, which the block index of the database looks up
+# without a scan. The name and the other mapped fields are scored with their own scorers, and the combined score is
+# the weighted mean of the field scores. A field that is empty in the record or in the database row is left out of
+# the mean for that pair, so a missing value neither helps nor hurts a match. Records are grouped by their blocking
+# values, and every group is scored against its block in one matrix per field
+
+# Import required modules
+import re
+
+import numpy as np
+from rapidfuzz import fuzz as rapidfuzz
+from rapidfuzz import process as rapidfuzz_process
+
+from .matching import DEFAULT_CHUNK_BYTES, top_columns
+from .normalization import strip_punctuation
+from .scorers import get_scorer, score_scale
+
+# Method of a mapped field that makes it a blocking field instead of a scored one
+BLOCK = 'block'
+
+# Score matrices with fewer pairs are scored in the calling thread: starting the rapidfuzz worker threads costs more
+# than scoring a small block
+PARALLEL_PAIRS = 100000
+
+# Entries of a field mapping are separated by commas or new lines
+_ENTRY_SEPARATOR = re.compile(r'[,\n]')
+
+
+# Parse the field mapping of an upload. Every entry reads 'upload column=database column:method:weight', where the
+# method is 'block' or the name of a scorer (the scorer of the request when left out) and the weight defaults to 1;
+# the database column defaults to the upload column (e.g. 'Postcode:block, City=town:token_set_ratio:0.5')
+# Returns one dict per entry (column, field, method, weight); raises ValueError for malformed entries
+def parse_fields(text: str, default_scorer: str) -> list:
+    fields = []
+    for entry in _ENTRY_SEPARATOR.split(text or ''):
+        if not entry.strip():
+            continue
+        column, _, spec = entry.rpartition('=')
+        parts = [part.strip() for part in spec.split(':')]
+        field = parts[0]
+        column = column.strip() or field
+        method = parts[1] if len(parts) > 1 and parts[1] else default_scorer
+        if not field or len(parts) > 3:
+            raise ValueError(f'Malformed field mapping: {entry.strip()}')
+        if method == BLOCK:
+            if len(parts) > 2:
+                raise ValueError(f'Blocking fields have no weight: {entry.strip()}')
+            weight = None
+        else:
+            get_scorer(method)
+            try:
+                weight = float(parts[2]) if len(parts) > 2 else 1.0
+            except ValueError:
+                weight = -1.0
+            if not weight > 0:
+                raise ValueError(f'Field weights must be positive numbers: {entry.strip()}')
+        fields.append({'column': column, 'field': field, 'method': method, 'weight': weight})
+    return fields
+
+
+# Key of a blocking value: lowercased, without punctuation and spaces, so 'SW1A 1AA' and 'sw1a-1aa' block together
+def block_key(value: str) -> str:
+    return ''.join(strip_punctuation(value.lower()).split())
+
+
+# Rows of a reference database grouped by their values in the blocking fields
+class BlockIndex:
+    def __init__(self, columns: list):
+        # 'columns' holds the database values of every blocking field
+        self.size = len(columns[0]) if columns else 0
+        keys = zip(*[[block_key(value) for value in column] for column in columns])
+
+        # Number of every distinct combination of blocking values, in order of first appearance
+        self.blocks = {}
+        block_ids = np.fromiter((self.blocks.setdefault(key, len(self.blocks)) for key in keys), dtype=np.int64,
+                                count=self.size)
+
+        # Rows sorted by block (in row order within a block) and where every block starts in that order
+        self.order = np.argsort(block_ids, kind='stable')
+        self.starts = np.searchsorted(block_ids[self.order], np.arange(len(self.blocks) + 1))
+
+        # Approximate memory footprint, counted against the reference cache budget
+        self.nbytes = self.order.nbytes + self.starts.nbytes + 100 * len(self.blocks)
+
+    # Rows with the given blocking key (a tuple of block keys, one per blocking field), in row order
+    def rows(self, key: tuple) -> np.ndarray:
+        block = self.blocks.get(key)
+        if block is None:
+            return self.order[:0]
+        return self.order[self.starts[block]:self.starts[block + 1]]
+
+
+# Score a list of values against a list of database values, scaled to 0-100
+def _score(queries: list, choices: list, scorer, workers: int) -> np.ndarray:
+    workers = workers if len(queries) * len(choices) >= PARALLEL_PAIRS else 1
+    return rapidfuzz_process.cdist(queries, choices, scorer=scorer, dtype=np.float64,
+                                   workers=workers) * score_scale(scorer)
+
+
+# Combined scores of some records against some database rows: the weighted mean of the name score and of the scores
+# of the scored fields present on both sides
+def _combined_scores(queries: list, choices: list, scored: list, scorer, name_weight: float, workers: int):
+    total = _score(queries, choices, scorer, workers) * name_weight
+    if not scored:
+        return total / name_weight
+    weights = np.full(total.shape, name_weight)
+    for values, keys, field_scorer, weight in scored:
+        present = np.outer(np.fromiter((value != '' for value in values), dtype=bool, count=len(values)),
+                           np.fromiter((key != '' for key in keys), dtype=bool, count=len(keys)))
+        total += np.where(present, _score(values, keys, field_scorer, workers) * weight, 0)
+        weights += present * weight
+    return total / weights
+
+
+# Find the top matches of every record by the weighted mean of its field scores
+# 'queries' are the (normalized) record names and 'keys' the database keys, scored with 'scorer' and 'name_weight'.
+# 'scored' holds one (record values, database values, scorer, weight) tuple per scored field, normalized like the
+# names, and 'blocking' the record values of the blocking fields, in the order of the fields of 'block_index'
+# Records missing a blocking value are scored against every row, and database rows missing one are only found by
+# those records. Returns the same arrays as matching.top_matches and the pair counts (pairs without blocking,
+# pairs scored, records without blocking values)
+def top_matches(queries: list, keys: list, scored: list = (), blocking: list = (), block_index: BlockIndex = None,
+                n_matches: int = 3, scorer=rapidfuzz.ratio, name_weight: float = 1.0, workers: int = -1,
+                chunk_bytes: int = DEFAULT_CHUNK_BYTES, progress=None) -> tuple:
+    n_rows = len(queries)
+    n_matches = min(n_matches, len(keys))
+    rows = np.full((n_rows, n_matches), -1, dtype=np.int64)
+    scores = np.full((n_rows, n_matches), np.nan, dtype=np.float64)
+    counts = {'pairs': n_rows * len(keys), 'scored': 0, 'unblocked': 0}
+
+    # Group the records by their blocking key; records missing a blocking value form the group None
+    groups = {}
+    record_keys = zip(*[[block_key(value) for value in column] for column in blocking]) if blocking \
+        else [()] * n_rows
+    for record, key in enumerate(record_keys):
+        groups.setdefault(None if '' in key or block_index is None else key, []).append(record)
+
+    done = 0
+    every_row = np.arange(len(keys))
+    for key, members in groups.items():
+        candidates = every_row if key is None else block_index.rows(key)
+        group_matches = min(n_matches, len(candidates))
+        if key is None and block_index is not None:
+            counts['unblocked'] += len(members)
+
+        if group_matches > 0:
+            # Database values of the block; the full lists are used as they are for the records scored against
+            # every row
+            choices = keys if key is None else [keys[row] for row in candidates.tolist()]
+            block_fields = [field_keys if key is None else [field_keys[row] for row in candidates.tolist()]
+                            for _, field_keys, _, _ in scored]
+
+            # Number of records per chunk so that the score matrices of a chunk stay within the memory bound
+            # (the combined scores, the weights and the scores of one field)
+            chunk_rows = max(1, chunk_bytes // (len(candidates) * np.dtype(np.float64).itemsize * 3))
+            for start in range(0, len(members), chunk_rows):
+                part = members[start:start + chunk_rows]
+                chunk_scores = _combined_scores(
+                    [queries[record] for record in part], choices,
+                    [([values[record] for record in part], field_keys, field_scorer, weight)
+                     for (values, _, field_scorer, weight), field_keys in zip(scored, block_fields)],
+                    scorer, name_weight, workers)
+
+                # Columns are in row order, so ties are ordered by database row like the other modes
+                columns = top_columns(chunk_scores, group_matches)
+                rows[part, :group_matches] = candidates[columns]
+                scores[part, :group_matches] = np.take_along_axis(chunk_scores, columns, axis=1)
+                counts['scored'] += len(part) * len(candidates)
+
+        done += len(members)
+        if progress is not None:
+            progress(done)
+
+    return rows, scores, counts
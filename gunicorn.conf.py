@@ -0,0 +1,18 @@
+# Gunicorn settings of the web process (see Procfile)
+#
+# With MATCH_PRELOAD set, the app is loaded once in the master process, which imports the matching engine and loads
+# the reference databases (see warmup.py), and every worker is forked from it with those pages shared copy-on-write
+
+# Import required modules
+import gc
+import os
+
+# Load the app in the master process before forking the workers
+preload_app = os.environ.get('MATCH_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+
+# Move the objects loaded so far out of the garbage collector's reach before each fork, so that collections in the
+# workers do not write to (and so copy) the shared pages
+def pre_fork(server, worker):
+    if preload_app:
+        gc.freeze()
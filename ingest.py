@@ -0,0 +1,118 @@
+# Import required modules
+import csv
+import os
+
+import pandas as pd
+from openpyxl import load_workbook
+
+from .database_store import cell_text
+
+# Number of names handed to the matcher at a time
+DEFAULT_BATCH_SIZE = 10000
+
+
+# Get the lowercase extension of a file name
+def _extension(file_path: str) -> str:
+    return os.path.splitext(file_path)[1].lower()
+
+
+# Iterate over the rows of a record file as tuples of cell values, header row included
+# xlsx files are read row by row in read-only mode and CSV files line by line, so memory stays flat
+def iter_rows(file_path: str):
+    extension = _extension(file_path)
+
+    if extension in ('.xlsx', '.xlsm'):
+        wb = load_workbook(file_path, read_only=True, data_only=True)
+        try:
+            yield from wb.worksheets[0].iter_rows(values_only=True)
+        finally:
+            wb.close()
+
+    elif extension == '.csv':
+        with open(file_path, newline='', encoding='utf-8-sig', errors='replace') as f:
+            for row in csv.reader(f):
+                yield tuple(row)
+
+    elif extension == '.txt':
+        # Plain text files hold one record name per line and have no header, so a header is made up
+        yield ('name',)
+        with open(file_path, encoding='utf-8-sig', errors='replace') as f:
+            for line in f:
+                yield (line.rstrip('\r\n'),)
+
+    else:
+        # Other spreadsheet formats (e.g. xls, read by pandas through xlrd) have no streaming reader, so they are
+        # loaded in one go
+        df = pd.read_excel(file_path, dtype=object)
+        yield tuple(df.columns)
+        yield from df.itertuples(index=False, name=None)
+
+
+# Get the column names of a record file, ignoring empty trailing cells
+def read_header(file_path: str) -> list:
+    header = list(next(iter_rows(file_path), ()))
+    while header and header[-1] in (None, ''):
+        header.pop()
+    return header
+
+
+# Estimate the number of records in a file without reading the cell values (used for progress reporting)
+def count_records(file_path: str) -> int:
+    extension = _extension(file_path)
+
+    if extension in ('.xlsx', '.xlsm'):
+        # The sheet dimension is stored in the file, so this does not iterate the rows
+        wb = load_workbook(file_path, read_only=True)
+        try:
+            return max((wb.worksheets[0].max_row or 1) - 1, 0)
+        finally:
+            wb.close()
+
+    if extension in ('.csv', '.txt'):
+        with open(file_path, 'rb') as f:
+            lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
+        return lines if extension == '.txt' else max(lines - 1, 0)
+
+    return 0
+
+
+# Iterate over the record names of the first column in batches of lowercased, non-empty strings
+def iter_batches(file_path: str, batch_size: int = DEFAULT_BATCH_SIZE):
+    rows = iter_rows(file_path)
+
+    # Skip the header row
+    next(rows, None)
+
+    batch = []
+    for row in rows:
+        value = row[0] if row else None
+        if isinstance(value, str) and value != '':
+            batch.append(value.lower())
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+# Iterate over the records of a file in batches, for multi-field matching: the lowercased, non-empty names of the
+# first column with the values of the columns at the positions in 'columns' ('' where empty)
+# Yields the names and one list of values per column
+def iter_field_batches(file_path: str, columns: list, batch_size: int = DEFAULT_BATCH_SIZE):
+    rows = iter_rows(file_path)
+
+    # Skip the header row
+    next(rows, None)
+
+    names, values = [], [[] for _ in columns]
+    for row in rows:
+        value = row[0] if row else None
+        if isinstance(value, str) and value != '':
+            names.append(value.lower())
+            for column, column_values in zip(columns, values):
+                column_values.append(cell_text(row[column]) if column < len(row) else '')
+            if len(names) == batch_size:
+                yield names, values
+                names, values = [], [[] for _ in columns]
+    if names:
+        yield names, values
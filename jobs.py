@@ -0,0 +1,487 @@
+# Import required modules and classes
+import cProfile
+import io
+import multiprocessing
+import os
+import pstats
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+from flask import current_app, url_for
+
+from . import db
+from . import duplicates
+from . import field_matching
+from . import ingest
+from . import match_results
+from . import matching
+from . import metrics
+from . import normalization
+from . import scorers
+from . import reports
+from . import result_store
+from . import sharded_matching
+from . import threshold_matching
+from .match_cache import match_cache
+from .models import MatchJob
+from .reference_cache import reference_cache
+
+# Number of local worker processes that run matching jobs
+JOB_WORKERS = int(os.environ.get('MATCH_JOB_WORKERS', 2))
+
+# Number of matches kept per record
+N_MATCHES = 3
+
+# Minimum number of seconds between two progress updates written to the job table
+PROGRESS_UPDATE_INTERVAL = 1.0
+
+# Directory of the profiles written for jobs submitted with profiling turned on
+PROFILE_DIR = 'static/profiles/'
+
+# Number of functions listed in the text summary written next to each profile
+PROFILE_SUMMARY_LINES = 40
+
+# Process pool shared by the requests of this server process, created on first use
+# Workers are spawned rather than forked: a fork from a threaded server copies the locks other request threads
+# hold at that moment (e.g. of the reference cache while a database loads), and the worker then waits on them forever
+_executor = None
+_executor_lock = threading.Lock()
+
+# Application instance of a worker process, used for database access inside jobs
+_worker_app = None
+
+
+# Create the application once per worker process so jobs can use the database models
+# (without the MATCH_PRELOAD warm-up: every worker would otherwise load every reference database when it starts)
+# 'shard_info' holds the shard workers of the submitting process, which the worker uses instead of starting its own
+def _init_worker(shard_info: tuple = None):
+    global _worker_app
+    from . import create_app
+    if shard_info is not None:
+        sharded_matching.connect(shard_info)
+    _worker_app = create_app(preload=False)
+
+
+# Return the process pool, (re)creating it when it does not exist yet
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(sharded_matching.connection_info(),))
+        return _executor
+
+
+# Write the given fields to a job row
+def _update_job(job_id: int, **fields):
+    MatchJob.query.filter_by(id=job_id).update(fields)
+    db.session.commit()
+
+
+# Run a job function in the worker pool; 'record' adds the summary the job returns to this process's metrics
+def _submit(job: MatchJob, record, function, *args):
+    app = current_app._get_current_object()
+    job_id = job.id
+    future = get_executor().submit(function, job_id, *args)
+
+    # Jobs record their own errors; this only catches workers that died before they could
+    def on_done(done_future):
+        global _executor
+        exception = done_future.exception()
+        if exception is not None:
+            _executor = None
+            with app.app_context():
+                _update_job(job_id, status='failed', stage='failed', error=str(exception) or type(exception).__name__,
+                            finished_at=datetime.utcnow())
+            metrics.log_event('job', job_id=job_id, status='failed', error=str(exception))
+            return
+        record(done_future.result())
+
+    future.add_done_callback(on_done)
+
+
+# Enqueue a matching job for an uploaded record file
+# 'options' holds the matching settings chosen on the upload form
+# (database_name, match_mode, candidate_limit, rerank, min_score, normalizer, scorer, output_format, charts,
+# profile, and for multi-field matching the mapped fields and name_weight)
+def submit_match_job(job: MatchJob, file_path: str, email: str, options: dict):
+    _submit(job, _record_job_metrics, run_match_job, file_path, email, options)
+
+
+# Enqueue a duplicate search in a reference database, started from the admin page
+# 'options' holds the settings chosen on the admin page (database_name, min_score, normalizer, scorer)
+def submit_duplicates_job(job: MatchJob, email: str, options: dict):
+    _submit(job, _record_duplicates_metrics, run_duplicates_job, email, options)
+
+
+# Add the stage timings and cache counts a worker reported for a job to this process's metrics
+def _record_job_metrics(summary: dict):
+    for stage_name, seconds in summary['stages'].items():
+        metrics.record_stage(stage_name, seconds, route='match_job')
+    if summary['status'] == 'done' and not summary['reused']:
+        metrics.record_rows(summary['rows'], summary['stages'].get('matching', 0), route='match_job')
+    for result in ('hits', 'misses'):
+        metrics.registry.inc(f'record_matching_reference_cache_{result}_total', summary['cache'][result],
+                             process='job_worker')
+        metrics.registry.inc(f'record_matching_result_cache_{result}_total', summary['result_cache'][result],
+                             process='job_worker')
+    if summary['pruning'] is not None:
+        for outcome in ('scored', 'pruned'):
+            metrics.registry.inc('record_matching_threshold_pairs_total', summary['pruning'][outcome],
+                                 'Name and database key pairs of threshold matching, scored or pruned by length.',
+                                 route='match_job', outcome=outcome)
+    if summary['blocking'] is not None:
+        for outcome in ('scored', 'skipped'):
+            metrics.registry.inc('record_matching_field_pairs_total', summary['blocking'][outcome],
+                                 'Record and database row pairs of multi-field matching, scored or skipped by '
+                                 'blocking.', route='match_job', outcome=outcome)
+    metrics.registry.inc('record_matching_jobs_total', 1, 'Matching jobs finished.', status=summary['status'],
+                         reused=str(summary['reused']).lower())
+    metrics.log_event('job', **summary)
+
+
+# Add the stage timings and counts a worker reported for a duplicate search to this process's metrics
+def _record_duplicates_metrics(summary: dict):
+    for stage_name, seconds in summary['stages'].items():
+        metrics.record_stage(stage_name, seconds, route='duplicates_job')
+    metrics.registry.inc('record_matching_duplicate_jobs_total', 1, 'Duplicate searches finished.',
+                         status=summary['status'])
+    metrics.log_event('duplicates_job', **summary)
+
+
+# Write the profile of a job in the pstats format, with a text summary of the most expensive functions next to it
+def _write_profile(profiler: cProfile.Profile, email: str, job_id: int) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    profile_path = f'{PROFILE_DIR}{email}_{job_id}.prof'
+    profiler.dump_stats(profile_path)
+
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(PROFILE_SUMMARY_LINES)
+    with open(profile_path[:-len('.prof')] + '.txt', 'w') as f:
+        f.write(summary.getvalue())
+    return profile_path
+
+
+# Match the records of an uploaded file, write the result to the download path and keep it in the result table
+# Returns the number of records and of results, with the pruning counts of threshold matching and the blocking
+# counts of multi-field matching (None in the other modes)
+def _match_upload(job_id: int, file_path: str, email: str, options: dict, timer: metrics.StageTimer,
+                  download_path: str) -> tuple:
+    # Estimate the size of the upload for progress reporting; the records are streamed later
+    with timer.stage('count_records'):
+        _update_job(job_id, status='running', stage='reading records', started_at=datetime.utcnow(),
+                    rows_total=ingest.count_records(file_path))
+
+    # Get the database from this worker's cache, with its names already lowercased
+    _update_job(job_id, stage='loading database')
+    with timer.stage('load_database'):
+        reference = reference_cache.get(options['database_name'])
+    normalizer = options['normalizer']
+    scorer = scorers.get_scorer(options['scorer'])
+
+    # Get the database keys for the normalization pipeline, computed once per database
+    with timer.stage('normalize_database'):
+        keys = reference.normalized(normalizer)
+
+    # Build (or reuse) the candidate index of the database when candidate pruning is requested, its keys
+    # sorted by length for threshold matching, or its TF-IDF vectors
+    threshold = options['match_mode'] == 'threshold'
+    pruning = {'min_score': options['min_score'], 'pairs': 0, 'scored': 0, 'pruned': 0} if threshold else None
+    index, candidate_limit, tfidf = None, None, None
+    if threshold:
+        with timer.stage('build_length_index'):
+            length_index = reference.length_index(normalizer)
+    elif options['match_mode'] == 'indexed':
+        with timer.stage('build_index'):
+            index = reference.candidate_index(normalizer)
+        candidate_limit = options['candidate_limit']
+    elif options['match_mode'] == 'tfidf':
+        with timer.stage('build_tfidf_index'):
+            tfidf = reference.tfidf_index(normalizer)
+
+        # With re-ranking, the TF-IDF candidates of every record are scored with the scorer
+        candidate_limit = options['candidate_limit'] if options.get('rerank') else None
+
+    # With mapped fields, the records are matched on their names and fields within their blocks (see
+    # field_matching): the values of the scored fields are normalized like the names, and the database rows are
+    # grouped by their blocking values
+    fields = options.get('fields') or []
+    blocking = [field for field in fields if field['method'] == field_matching.BLOCK]
+    scored = [field for field in fields if field['method'] != field_matching.BLOCK]
+    block_index, field_counts = None, None
+    if fields:
+        with timer.stage('build_block_index'):
+            field_keys = [reference.field_values(field['field'], normalizer) for field in scored]
+            if blocking:
+                block_index = reference.block_index(tuple(field['field'] for field in blocking))
+        field_scorers = [scorers.get_scorer(field['method']) for field in scored]
+
+        # Database values of the mapped columns, reported next to every match
+        reported_fields = {column: reference.field_values(column)
+                           for column in dict.fromkeys(field['field'] for field in fields)}
+        field_counts = {'blocking_fields': [field['field'] for field in blocking], 'pairs': 0, 'scored': 0,
+                        'skipped': 0, 'unblocked': 0}
+
+    # Full scans are split across the shard workers when sharding is configured
+    full_scan = index is None and tfidf is None and not threshold and not fields
+    shards = sharded_matching.shard_plan(reference, normalizer) if full_scan else None
+
+    # Names matched before against this version of the database are answered from the result cache
+    # (not in the TF-IDF mode, whose cached results could not be carried over to an updated database, nor with
+    # mapped fields, whose scores depend on more than the name)
+    cache = None
+    if tfidf is None and not fields:
+        cache = match_cache.view(reference.version, normalizer, scorer, N_MATCHES, candidate_limit)
+
+    # Record the number of matched names, at most once per update interval
+    rows_matched = 0
+    last_update = [0.0]
+
+    def progress(rows_done: int):
+        now = time.monotonic()
+        if now - last_update[0] >= PROGRESS_UPDATE_INTERVAL:
+            last_update[0] = now
+            _update_job(job_id, rows_done=rows_matched + rows_done)
+
+    # Stream the uploaded names in fixed-size batches and find the closest matches for each batch
+    # (reading the batches is timed as 'ingest', scoring them as 'matching')
+    _update_job(job_id, stage='matching')
+    result_frames = []
+    if fields:
+        batches = ingest.iter_field_batches(file_path, [field['position'] for field in fields])
+    else:
+        batches = ((names, []) for names in ingest.iter_batches(file_path))
+    while True:
+        with timer.stage('ingest'):
+            batch = next(batches, None)
+        if batch is None:
+            break
+        names, values = batch
+        with timer.stage('normalize_records'):
+            queries = normalization.normalize_all(names, normalizer)
+            blocking_values = [column for field, column in zip(fields, values)
+                               if field['method'] == field_matching.BLOCK]
+            scored_values = [normalization.normalize_all(column, normalizer) for field, column in zip(fields, values)
+                             if field['method'] != field_matching.BLOCK]
+        with timer.stage('matching'):
+            if fields:
+                rows, scores, batch_counts = field_matching.top_matches(
+                    queries, keys, scored=list(zip(scored_values, field_keys, field_scorers,
+                                                   [field['weight'] for field in scored])),
+                    blocking=blocking_values, block_index=block_index, n_matches=N_MATCHES, scorer=scorer,
+                    name_weight=options['name_weight'], progress=progress)
+                batch_df = matching.result_frame(names, rows, scores, reference.choices, reported_fields,
+                                                 n_matches=N_MATCHES)
+                for count in ('pairs', 'scored', 'unblocked'):
+                    field_counts[count] += batch_counts[count]
+            elif threshold:
+                batch_df, batch_pruning = threshold_matching.threshold_batch(
+                    names, keys, options['min_score'], scorer=scorer, length_index=length_index,
+                    progress=progress, queries=queries, labels=reference.choices)
+                for count in ('pairs', 'scored', 'pruned'):
+                    pruning[count] += batch_pruning[count]
+            else:
+                batch_df = matching.match_batch(names, keys, n_matches=N_MATCHES, scorer=scorer, index=index,
+                                                candidate_limit=candidate_limit, progress=progress, queries=queries,
+                                                labels=reference.choices, cache=cache, shards=shards,
+                                                tfidf=tfidf)
+
+        # Index the results by the position of their record in the upload
+        batch_df.index += rows_matched
+        result_frames.append(batch_df)
+        rows_matched += len(names)
+
+    if not result_frames:
+        raise ValueError('File does not contain any record names.')
+    # Records without a full set of matches (fewer database rows, TF-IDF candidates or block rows than matches) keep
+    # the matches they have, with the other match columns left empty
+    result_df = pd.concat(result_frames)
+    if field_counts is not None:
+        field_counts['skipped'] = field_counts['pairs'] - field_counts['scored']
+
+    # Write the results the user downloads; the charts are only rendered when they were asked for
+    # (threshold matching has no ranked match columns to chart)
+    if options['charts'] and options['output_format'] == 'xlsx' and not threshold:
+        _update_job(job_id, stage='rendering charts', rows_done=rows_matched, rows_total=rows_matched)
+        img_path = f'static/matches/{email}_{job_id}_match.png'
+    else:
+        _update_job(job_id, stage='writing results', rows_done=rows_matched, rows_total=rows_matched)
+        img_path = None
+    reports.write_report(result_df, None if threshold else N_MATCHES, download_path, img_path, timer=timer,
+                         pruning=pruning, blocking=field_counts)
+
+    # Keep the results in the result table, where they can be browsed a page at a time
+    _update_job(job_id, stage='storing results')
+    with timer.stage('store_results'):
+        n_results = match_results.store_results(job_id, result_df, None if threshold else N_MATCHES,
+                                                options['database_name'])
+    return rows_matched, n_results, pruning, field_counts
+
+
+# Read, match and report an uploaded record file, recording progress in the job table (runs in a worker process)
+# The same file matched against an unchanged database with the same options reuses the earlier result
+# Returns the stage timings and cache counts of the job, which the submitting process adds to its metrics
+def run_match_job(job_id: int, file_path: str, email: str, options: dict) -> dict:
+    timer = metrics.StageTimer()
+    cache_hits, cache_misses = reference_cache.hits, reference_cache.misses
+    result_hits, result_misses = match_cache.hits, match_cache.misses
+    rows_matched = 0
+    pruning, blocking = None, None
+    status = 'failed'
+    reused = False
+
+    # Profile the whole job when it was submitted with profiling turned on
+    profiler = cProfile.Profile() if options.get('profile') else None
+    if profiler is not None:
+        profiler.enable()
+
+    with _worker_app.app_context():
+        try:
+            download_path = f'static/matches/{email}_{job_id}_match.{options["output_format"]}'
+
+            # Keep the result table to the most recent jobs of the user, this one included
+            with timer.stage('prune_results'):
+                match_results.prune_results(MatchJob.query.get(job_id).user_id)
+
+            # Look for the result of an earlier job on the same file, database and options
+            with timer.stage('hash_upload'):
+                database_path = os.path.join(reference_cache.directory, options['database_name'])
+                result_key = result_store.result_key(file_path, database_path, options, N_MATCHES)
+                stored = result_store.restore(result_key, options['output_format'], download_path)
+
+            # The job also takes over the results the earlier job kept in the result table; when they were deleted
+            # since (see match_results.prune_results), the records are matched again
+            if stored is not None:
+                with timer.stage('copy_results'):
+                    if not match_results.copy_results(stored['job_id'], job_id, stored['results']):
+                        os.remove(download_path)
+                        stored = None
+
+            if stored is not None:
+                now = datetime.utcnow()
+                _update_job(job_id, status='done', stage='done', started_at=now, finished_at=now,
+                            rows_done=stored['rows'], rows_total=stored['rows'], result_path=download_path)
+                rows_matched, reused = stored['rows'], True
+            else:
+                rows_matched, n_results, pruning, blocking = _match_upload(job_id, file_path, email, options,
+                                                                           timer, download_path)
+                result_store.store(result_key, options['output_format'], download_path, rows_matched, job_id,
+                                   n_results)
+                _update_job(job_id, status='done', stage='done', result_path=download_path,
+                            finished_at=datetime.utcnow())
+            status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            _update_job(job_id, status='failed', stage='failed', error=str(e), finished_at=datetime.utcnow())
+
+    profile_path = None
+    if profiler is not None:
+        profiler.disable()
+        profile_path = _write_profile(profiler, email, job_id)
+
+    return {
+        'job_id': job_id,
+        'status': status,
+        'reused': reused,
+        'rows': rows_matched,
+        'stages': {stage_name: round(seconds, 6) for stage_name, seconds in timer.stages.items()},
+        'cache': {'hits': reference_cache.hits - cache_hits, 'misses': reference_cache.misses - cache_misses},
+        'result_cache': {'hits': match_cache.hits - result_hits, 'misses': match_cache.misses - result_misses},
+        'pruning': pruning,
+        'blocking': blocking,
+        'profile_path': profile_path,
+    }
+
+
+# Find the near-duplicate names of a reference database, cluster them and write the clusters for review, recording
+# progress in the job table (runs in a worker process)
+# Returns the stage timings and counts of the search, which the submitting process adds to its metrics
+def run_duplicates_job(job_id: int, email: str, options: dict) -> dict:
+    timer = metrics.StageTimer()
+    status = 'failed'
+    counts = {}
+
+    with _worker_app.app_context():
+        try:
+            _update_job(job_id, status='running', stage='loading database', started_at=datetime.utcnow())
+            with timer.stage('load_database'):
+                reference = reference_cache.get(options['database_name'])
+            normalizer = options['normalizer']
+            scorer = scorers.get_scorer(options['scorer'])
+            with timer.stage('normalize_database'):
+                keys = reference.normalized(normalizer)
+
+            # Progress is reported in database rows, at most once per update interval
+            _update_job(job_id, stage='finding duplicates', rows_total=len(keys))
+            last_update = [0.0]
+
+            def progress(fraction: float):
+                now = time.monotonic()
+                if now - last_update[0] >= PROGRESS_UPDATE_INTERVAL:
+                    last_update[0] = now
+                    _update_job(job_id, rows_done=int(fraction * len(keys)))
+
+            with timer.stage('find_pairs'):
+                left, right, scores, counts = duplicates.find_pairs(keys, options['min_score'], scorer=scorer,
+                                                                    progress=progress)
+            with timer.stage('cluster'):
+                labels = duplicates.cluster_labels(len(keys), left, right)
+                clusters_df = duplicates.cluster_table(reference.names, labels)
+                pairs_df = duplicates.pair_table(reference.names, left, right, scores)
+            counts.update(pairs=len(pairs_df), clusters=int(clusters_df['cluster'].max()) if len(clusters_df) else 0,
+                          clustered_rows=len(clusters_df))
+
+            _update_job(job_id, stage='writing results', rows_done=len(keys))
+            download_path = f'static/matches/{email}_{job_id}_duplicates.xlsx'
+            with timer.stage('write_workbook'):
+                reports.write_duplicates_report(clusters_df, pairs_df, {
+                    'Database': options['database_name'],
+                    'Rows': len(keys),
+                    'Minimum score': options['min_score'],
+                    'Scorer': options['scorer'],
+                    'Normalization': normalizer,
+                    'Blocks': counts['blocks'],
+                    'Comparisons': counts['compared'],
+                    'Comparisons without blocking': len(keys) * (len(keys) - 1) // 2,
+                    'Blocks skipped (too large)': counts['skipped_blocks'],
+                    'Pairs found': counts['pairs'],
+                    'Clusters': counts['clusters'],
+                    'Names in clusters': counts['clustered_rows'],
+                }, download_path)
+            _update_job(job_id, status='done', stage='done', result_path=download_path, finished_at=datetime.utcnow())
+            status = 'done'
+        except Exception as e:
+            db.session.rollback()
+            _update_job(job_id, status='failed', stage='failed', error=str(e), finished_at=datetime.utcnow())
+
+    return {
+        'job_id': job_id,
+        'status': status,
+        'database_name': options['database_name'],
+        'stages': {stage_name: round(seconds, 6) for stage_name, seconds in timer.stages.items()},
+        'counts': counts,
+    }
+
+
+# Describe the state of a job for the progress endpoint, with an estimate of the remaining matching time
+def job_progress(job: MatchJob) -> dict:
+    eta_seconds = None
+    if job.status == 'running' and job.started_at is not None and 0 < job.rows_done < job.rows_total:
+        elapsed = (datetime.utcnow() - job.started_at).total_seconds()
+        eta_seconds = round(elapsed / job.rows_done * (job.rows_total - job.rows_done), 1)
+
+    return {
+        'job_id': job.id,
+        'status': job.status,
+        'stage': job.stage,
+        'rows_done': job.rows_done,
+        'rows_total': job.rows_total,
+        'eta_seconds': eta_seconds,
+        'error': job.error,
+        'download_url': url_for('auth.download_file', job_id=job.id) if job.status == 'done' else None,
+        'results_url': url_for('auth.job_results', job_id=job.id)
+        if job.status == 'done' and match_results.has_results(job.id) else None,
+    }
@@ -0,0 +1,144 @@
+# Import required modules
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from rapidfuzz import process as rapidfuzz_process
+
+from .scorers import score_scale
+
+# Largest number of query results kept, and how long (in seconds) a result is reused; configurable through the
+# environment
+DEFAULT_MAX_ENTRIES = int(os.environ.get('MATCH_CACHE_ENTRIES', 100000))
+DEFAULT_TTL = float(os.environ.get('MATCH_CACHE_TTL', 3600))
+
+
+# Results of one query setting: a database version, normalization pipeline, scorer, number of matches and
+# candidate pruning, under which each normalized query maps to its top matches
+# Cache keys are (version, pipeline, scorer, n_matches, candidate_limit, query)
+class CacheView:
+    def __init__(self, cache, prefix: tuple):
+        self._cache = cache
+        self._prefix = prefix
+
+    # Return the (rows, scores) of a normalized query, or None when it is not cached
+    def get(self, query: str):
+        return self._cache.get(self._prefix + (query,))
+
+    # Remember the (rows, scores) of a normalized query
+    def put(self, query: str, rows, scores):
+        self._cache.put(self._prefix + (query,), (rows, scores))
+
+
+# Process-wide LRU cache of query results with a time-to-live
+# Keys start with the database version (its name and modification time), so results of a database that changed
+# are never served; they are evicted by age or by the entry limit
+class MatchCache:
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        # Cached results with the time they were stored, ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # Lookups answered from the cache and lookups that had to be scored
+        self.hits = 0
+        self.misses = 0
+
+    # Return the results of one query setting
+    def view(self, version, pipeline: str, scorer, n_matches: int, candidate_limit: int = None) -> CacheView:
+        return CacheView(self, (version, pipeline, scorer, n_matches, candidate_limit))
+
+    def get(self, key: tuple):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: tuple, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic(), value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Carry the results of a database over to its next version instead of dropping them all
+    # 'row_map' gives the new row of every old row (-1 when removed) and 'added_rows' the rows of the added names
+    # in 'reference' (the new version). Results that matched a removed row are dropped; the others are renumbered
+    # and the added names are scored against their queries, entering the top matches when they score higher
+    # (with candidate pruning the merged results are as approximate as the pruned ones)
+    def apply_update(self, old_version, reference, row_map: np.ndarray, added_rows: np.ndarray):
+        with self._lock:
+            affected = [(key, entry) for key, entry in self._entries.items() if key[0] == old_version]
+            for key, _ in affected:
+                del self._entries[key]
+
+        # Results of the same pipeline, scorer and number of matches are updated together
+        groups = {}
+        for key, entry in affected:
+            groups.setdefault(key[1:5], []).append((key, entry))
+
+        size = len(reference)
+        carried = []
+        for (pipeline, scorer, n_matches, candidate_limit), entries in groups.items():
+            rows = np.array([entry[1][0] for _, entry in entries], dtype=np.int64)
+            scores = np.array([entry[1][1] for _, entry in entries], dtype=np.float64)
+
+            # Renumber the matched rows and drop the results that lost one of their matches
+            found = rows >= 0
+            mapped = np.where(found, row_map[np.where(found, rows, 0)], -1) if len(row_map) else rows
+            valid = ~(found & (mapped < 0)).any(axis=1)
+            entries = [item for item, keep in zip(entries, valid) if keep]
+            if not entries:
+                continue
+            rows, scores = mapped[valid], scores[valid]
+
+            # Score the added names and keep the best matches, ties ordered by row like a fresh match
+            if len(added_rows):
+                keys = reference.normalized(pipeline)
+                queries = [key[5] for key, _ in entries]
+                added_scores = rapidfuzz_process.cdist(queries, [keys[row] for row in added_rows], scorer=scorer,
+                                                       dtype=np.float64, workers=-1)
+                rows = np.hstack([rows, np.broadcast_to(added_rows, added_scores.shape)])
+                scores = np.hstack([scores, added_scores * score_scale(scorer)])
+            ranked = np.where(rows >= 0, scores, -np.inf)
+            order = np.lexsort((rows, -ranked))[:, :min(n_matches, size)]
+            rows = np.take_along_axis(rows, order, axis=1)
+            scores = np.take_along_axis(ranked, order, axis=1)
+            missing = np.isinf(scores)
+            rows[missing], scores[missing] = -1, np.nan
+
+            for (key, (stored_at, _)), name_rows, name_scores in zip(entries, rows, scores):
+                carried.append(((reference.version,) + key[1:], (stored_at, (name_rows, name_scores))))
+
+        with self._lock:
+            for key, entry in carried:
+                self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Drop every cached result
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # Number of lookups and cached results, for the metrics endpoint
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries),
+                    'max_entries': self.max_entries}
+
+
+# Shared cache instance used by the routes and the matching jobs of this process
+match_cache = MatchCache()
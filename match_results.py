@@ -0,0 +1,161 @@
+# Match results kept in the database for browsing: one row per record and rank, written in bulk when a job finishes
+# and read back one page at a time
+#
+# Pages use keyset pagination: each page ends with a cursor holding the sort key of its last row, and the next page
+# starts right after that key through the indexes of the table, so the last page of a million results is read as
+# quickly as the first
+
+# Import required modules
+import os
+
+import numpy as np
+from sqlalchemy import literal, select, tuple_
+
+from . import db
+from .models import MatchJob, MatchResult
+
+# Number of most recent jobs of each user whose results are kept; the results of older jobs are deleted
+RESULT_JOBS_PER_USER = int(os.environ.get('MATCH_RESULT_JOBS', 20))
+
+# Number of results inserted per statement
+INSERT_CHUNK = 10000
+
+# Number of results per page by default, and at most
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Statement inserting one result (SQLite placeholders)
+_INSERT_SQL = ('INSERT INTO match_result (job_id, "row", name, rank, "match", score, database_name) '
+               'VALUES (?, ?, ?, ?, ?, ?, ?)')
+
+# Orders the results can be browsed in: upload order, best scores first and worst scores first
+SORTS = ('row', 'score', 'score_asc')
+
+
+# Turn the results of a job into one entry per record and rank: five arrays (record row, rank, match, score and
+# record name), in upload order and by rank
+# The result DataFrame is indexed by the position of each record in the upload. Top matching results have the
+# columns match1, match_score1, ...; threshold results (n_matches=None) have one match per row, best first
+def _long_format(result_df, n_matches: int) -> tuple:
+    positions = result_df.index.to_numpy(dtype=np.int64)
+    if n_matches is None:
+        # Rank the matches of each record in the order they come in
+        first = np.r_[True, positions[1:] != positions[:-1]] if len(positions) else np.empty(0, dtype=bool)
+        starts = np.flatnonzero(first)
+        ranks = np.arange(len(positions)) - np.repeat(starts, np.diff(np.r_[starts, len(positions)])) + 1
+        return (positions + 1, ranks, result_df['match'].to_numpy(dtype=object),
+                result_df['match_score'].to_numpy(dtype=np.float64), result_df['name'].to_numpy(dtype=object))
+
+    # Interleave the ranked match columns, so that the matches of a record follow each other
+    matches = np.column_stack([result_df[f'match{n}'].to_numpy(dtype=object) for n in range(1, n_matches + 1)])
+    scores = np.column_stack([result_df[f'match_score{n}'].to_numpy(dtype=np.float64)
+                              for n in range(1, n_matches + 1)])
+    return (np.repeat(positions + 1, n_matches), np.tile(np.arange(1, n_matches + 1), len(positions)),
+            matches.ravel(), scores.ravel(), np.repeat(result_df['name'].to_numpy(dtype=object), n_matches))
+
+
+# Write the results of a job to the result table in bulk; returns the number of results written
+# The rows are handed to the driver as plain tuples (executemany), about twice as fast as ORM or Core inserts
+def store_results(job_id: int, result_df, n_matches: int, database_name: str) -> int:
+    rows, ranks, matches, scores, names = _long_format(result_df, n_matches)
+
+    # Ranks a record has no match for (e.g. fewer TF-IDF candidates or block rows than matches) are left out
+    found = ~np.isnan(scores)
+    rows, ranks, matches, scores, names = rows[found], ranks[found], matches[found], scores[found], names[found]
+    connection = db.session.connection()
+    for start in range(0, len(rows), INSERT_CHUNK):
+        stop = start + INSERT_CHUNK
+        connection.exec_driver_sql(_INSERT_SQL, [
+            (job_id, row, name, rank, match, score, database_name)
+            for row, name, rank, match, score in zip(rows[start:stop].tolist(), names[start:stop].tolist(),
+                                                     ranks[start:stop].tolist(), matches[start:stop].tolist(),
+                                                     scores[start:stop].tolist())
+        ])
+    db.session.commit()
+    return len(rows)
+
+
+# Give a job the 'count' results of an earlier job whose result it reuses
+# Returns False, copying nothing, when the results of the earlier job are no longer all kept
+def copy_results(source_job_id: int, job_id: int, count: int) -> bool:
+    table = MatchResult.__table__
+    columns = ['row', 'name', 'rank', 'match', 'score', 'database_name']
+    source = select(literal(job_id), *[table.c[column] for column in columns]) \
+        .where(table.c.job_id == source_job_id).order_by(table.c.id)
+    copied = db.session.execute(table.insert().from_select(['job_id'] + columns, source)).rowcount
+    if copied != count:
+        db.session.rollback()
+        return False
+    db.session.commit()
+    return True
+
+
+# Delete the results of the jobs of a user beyond the most recent ones
+def prune_results(user_id: int, keep: int = RESULT_JOBS_PER_USER):
+    oldest_kept = db.session.query(MatchJob.id).filter_by(user_id=user_id).order_by(MatchJob.id.desc()) \
+        .offset(max(keep, 1) - 1).limit(1).scalar()
+    if oldest_kept is None:
+        return
+    old_jobs = select(MatchJob.id).where(MatchJob.user_id == user_id, MatchJob.id < oldest_kept)
+    MatchResult.query.filter(MatchResult.job_id.in_(old_jobs)).delete(synchronize_session=False)
+    db.session.commit()
+
+
+# Check if a job has results to browse
+def has_results(job_id: int) -> bool:
+    return db.session.query(MatchResult.query.filter_by(job_id=job_id).exists()).scalar()
+
+
+# Cursor of the row after which the next page starts: its id, preceded by its score when sorting by score
+def _cursor(result: MatchResult, sort: str) -> str:
+    return str(result.id) if sort == 'row' else f'{result.score!r}:{result.id}'
+
+
+# Read one page of the results of a job, after the row of 'cursor' (the first page when None)
+# Filters: min_score (scores at least), below (scores below), rank (only that rank) and query (record names
+# containing it, ignoring case). Returns the results as dicts and the cursor of the next page (None on the last page)
+# Raises ValueError for an unknown sort or a malformed cursor
+def page(job_id: int, sort: str = 'row', cursor: str = None, limit: int = PAGE_SIZE, min_score: float = None,
+         below: float = None, rank: int = None, query: str = None) -> tuple:
+    if sort not in SORTS:
+        raise ValueError(f'Unknown sort: {sort} (use {", ".join(SORTS)})')
+
+    results = MatchResult.query.filter(MatchResult.job_id == job_id)
+    if min_score is not None:
+        results = results.filter(MatchResult.score >= min_score)
+    if below is not None:
+        results = results.filter(MatchResult.score < below)
+    if rank is not None:
+        results = results.filter(MatchResult.rank == rank)
+    if query:
+        pattern = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        results = results.filter(MatchResult.name.ilike(f'%{pattern}%', escape='\\'))
+
+    # Start after the last row of the previous page: ids are unique, so they break ties between equal scores
+    try:
+        if sort == 'row':
+            key = int(cursor) if cursor else None
+        else:
+            score, _, result_id = (cursor or '').partition(':')
+            key = (float(score), int(result_id)) if cursor else None
+    except ValueError:
+        raise ValueError('Malformed cursor')
+
+    if sort == 'row':
+        if key is not None:
+            results = results.filter(MatchResult.id > key)
+        results = results.order_by(MatchResult.id)
+    else:
+        if key is not None:
+            position = tuple_(MatchResult.score, MatchResult.id)
+            results = results.filter(position < key if sort == 'score' else position > key)
+        if sort == 'score':
+            results = results.order_by(MatchResult.score.desc(), MatchResult.id.desc())
+        else:
+            results = results.order_by(MatchResult.score, MatchResult.id)
+
+    # Read one row more than the page holds to know whether another page follows
+    rows = results.limit(limit + 1).all()
+    next_cursor = _cursor(rows[limit - 1], sort) if len(rows) > limit else None
+    return [{'row': result.row, 'name': result.name, 'rank': result.rank, 'match': result.match,
+             'score': result.score, 'database': result.database_name} for result in rows[:limit]], next_cursor
@@ -0,0 +1,217 @@
+# Import required modules
+import os
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz as rapidfuzz
+from rapidfuzz import process as rapidfuzz_process
+
+from . import candidate_index
+from .scorers import score_scale
+
+# Upper bound (in bytes) for the score matrix computed for one chunk of uploaded names
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+# How often (in names) progress is reported when names are matched one at a time
+PROGRESS_INTERVAL = 1000
+
+# Matching modes of an upload: score every database name, score the candidates of the n-gram index, return every
+# match above a minimum score, or match by cosine similarity of TF-IDF n-gram vectors (see tfidf_matching)
+MATCH_MODES = ('full', 'indexed', 'threshold', 'tfidf')
+
+# Reference databases matched in the TF-IDF mode when a request does not choose a mode (comma-separated file names,
+# 'All' for the combination of every database)
+TFIDF_DATABASES = {name.strip() for name in os.environ.get('MATCH_TFIDF_DATABASES', '').split(',') if name.strip()}
+
+
+# Matching mode of a request that does not choose one: the TF-IDF mode for the databases configured for it,
+# 'fallback' for the others
+def default_mode(database_name: str, fallback: str = 'full') -> str:
+    return 'tfidf' if database_name in TFIDF_DATABASES else fallback
+
+
+# Select the top 'n_matches' columns of every row of a score matrix, best score first
+# Ties are ordered by database row like rapidfuzz_process.extract does
+def top_columns(scores: np.ndarray, n_matches: int) -> np.ndarray:
+    if n_matches < scores.shape[1]:
+        # Score of the n-th best match of every row
+        kth = -np.partition(-scores, n_matches - 1, axis=1)[:, n_matches - 1:n_matches]
+
+        # Keep everything above it, then fill the remaining slots with the first rows tied with it
+        greater = scores > kth
+        equal = scores == kth
+        needed = n_matches - greater.sum(axis=1, keepdims=True)
+        keep = greater | (equal & (np.cumsum(equal, axis=1) <= needed))
+        columns = np.nonzero(keep)[1].reshape(-1, n_matches)
+    else:
+        columns = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+
+    # Columns are in database row order, so the stable sort by score keeps ties in row order
+    selected = np.take_along_axis(scores, columns, axis=1)
+    order = np.argsort(-selected, axis=1, kind='stable')
+    return np.take_along_axis(columns, order, axis=1)
+
+
+# Score every name against the database choices (the work behind top_matches, without deduplication or caching)
+def _score_names(names: list, choices: list, n_matches: int, scorer, score_cutoff: float, workers: int,
+                 chunk_bytes: int, index, candidate_limit: int, progress, shards=None, tfidf=None) -> tuple:
+    n_rows = len(names)
+    n_matches = min(n_matches, len(choices))
+
+    # The TF-IDF mode matches the whole list against the vectors of the database (re-ranking that many candidates
+    # with the scorer when a candidate limit is given); matches below the cutoff are left empty
+    if tfidf is not None:
+        rows, scores = tfidf.top_matches(names, choices, n_matches, scorer, candidate_limit, progress, workers,
+                                         chunk_bytes)
+        if score_cutoff is not None:
+            below = ~(scores >= score_cutoff)
+            rows[below], scores[below] = -1, np.nan
+        return rows, scores
+
+    # Full scans are handed to the shard workers when a shard plan is given
+    if shards is not None and (index is None or candidate_limit is None) and n_rows:
+        result = shards.top_matches(names, n_matches, scorer, score_cutoff)
+        if result is not None:
+            if progress is not None:
+                progress(n_rows)
+            return result
+
+    # Scores are reported between 0 and 100 whatever the native range of the scorer
+    scale = score_scale(scorer)
+
+    # Preallocate the result arrays
+    rows = np.full((n_rows, n_matches), -1, dtype=np.int64)
+    scores = np.full((n_rows, n_matches), np.nan, dtype=np.float64)
+
+    if index is not None and candidate_limit is not None:
+        # Candidate pruning scores a different subset per name, so names are matched one at a time
+        for row, name in enumerate(names):
+            closest_matches = candidate_index.extract(name, choices, index=index, scorer=scorer, limit=n_matches,
+                                                      candidate_limit=candidate_limit)
+            for i, (_, score, choice_row) in enumerate(closest_matches):
+                if score_cutoff is None or score >= score_cutoff:
+                    rows[row, i] = choice_row
+                    scores[row, i] = score
+            if progress is not None and (row + 1) % PROGRESS_INTERVAL == 0:
+                progress(row + 1)
+    elif n_matches > 0:
+        # Number of names per chunk so that one score matrix stays within the memory bound
+        chunk_rows = max(1, chunk_bytes // (len(choices) * np.dtype(np.float64).itemsize))
+
+        for start in range(0, n_rows, chunk_rows):
+            end = min(start + chunk_rows, n_rows)
+
+            # Score the whole chunk against every choice using all cores
+            chunk_scores = rapidfuzz_process.cdist(names[start:end], choices, scorer=scorer, dtype=np.float64,
+                                                   workers=workers,
+                                                   score_cutoff=None if score_cutoff is None else score_cutoff / scale)
+
+            # Keep the best columns and write them straight into the result arrays
+            columns = top_columns(chunk_scores, n_matches)
+            best = np.take_along_axis(chunk_scores, columns, axis=1) * scale
+
+            # cdist reports scores below the cutoff as 0, so those slots are left empty
+            found = best >= (score_cutoff or 0)
+            rows[start:end] = np.where(found, columns, -1)
+            scores[start:end] = np.where(found, best, np.nan)
+            if progress is not None:
+                progress(end)
+
+    return rows, scores
+
+
+# Find the top matches of every name in the database choices
+# Returns two arrays of shape (len(names), n_matches): the matched rows of 'choices' (-1 where there is no match)
+# and their scores (NaN where there is no match). 'progress' is called with the number of names matched so far
+# Repeated names are scored once; with a 'cache' (a match_cache.CacheView for the same database, pipeline, scorer,
+# number of matches and pruning settings), names answered before are not scored again
+# With 'shards' (a sharded_matching.ShardPlan over the same keys as 'choices'), full scans run on the shard workers
+# With 'tfidf' (a tfidf_matching.TfidfIndex over 'choices'), names are matched in the TF-IDF mode
+def top_matches(names: list, choices: list, n_matches: int = 3, scorer=rapidfuzz.ratio, score_cutoff: float = None,
+                workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES, index=None, candidate_limit: int = None,
+                progress=None, cache=None, shards=None, tfidf=None) -> tuple:
+    n_rows = len(names)
+    n_matches = min(n_matches, len(choices))
+
+    # Collapse repeated names: 'inverse' maps every name to its position in 'unique'
+    positions = {}
+    inverse = np.fromiter((positions.setdefault(name, len(positions)) for name in names), dtype=np.int64,
+                          count=n_rows)
+    unique = list(positions)
+
+    unique_rows = np.full((len(unique), n_matches), -1, dtype=np.int64)
+    unique_scores = np.full((len(unique), n_matches), np.nan, dtype=np.float64)
+
+    # Take the names answered before from the cache and score only the others
+    missing = []
+    for position, name in enumerate(unique):
+        cached = cache.get(name) if cache is not None else None
+        if cached is None:
+            missing.append(position)
+        else:
+            unique_rows[position], unique_scores[position] = cached
+
+    if missing:
+        # Report progress in uploaded names rather than scored names
+        scored_progress = None
+        if progress is not None:
+            def scored_progress(done: int):
+                progress(done * n_rows // len(missing))
+
+        rows, scores = _score_names([unique[position] for position in missing], choices, n_matches, scorer,
+                                    score_cutoff, workers, chunk_bytes, index, candidate_limit, scored_progress,
+                                    shards, tfidf)
+        unique_rows[missing] = rows
+        unique_scores[missing] = scores
+        if cache is not None:
+            for position, name_rows, name_scores in zip(missing, rows, scores):
+                # Copies, so a cached row does not keep the whole result array alive
+                cache.put(unique[position], name_rows.copy(), name_scores.copy())
+
+    if progress is not None:
+        progress(n_rows)
+
+    # Fan the results back out to every occurrence of each name
+    return unique_rows[inverse], unique_scores[inverse]
+
+
+# Match a list of names against the database choices and return the top matches as a DataFrame
+# with the columns name, match1, match_score1, match2, match_score2, ...
+# 'queries' are the (normalized) strings scored for the names, and 'labels' the values reported for the matched
+# choices; both default to the names and choices themselves
+def match_batch(names: list, choices: list, n_matches: int = 3, scorer=rapidfuzz.ratio, score_cutoff: float = None,
+                workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES, index=None,
+                candidate_limit: int = None, progress=None, queries: list = None, labels: list = None,
+                cache=None, shards=None, tfidf=None) -> pd.DataFrame:
+    rows, scores = top_matches(names if queries is None else queries, choices, n_matches=n_matches, scorer=scorer,
+                               score_cutoff=score_cutoff, workers=workers, chunk_bytes=chunk_bytes, index=index,
+                               candidate_limit=candidate_limit, progress=progress, cache=cache, shards=shards,
+                               tfidf=tfidf)
+    return result_frame(names, rows, scores, choices if labels is None else labels, n_matches=n_matches)
+
+
+# Turn the matched rows and scores of a list of names into the result DataFrame, with the columns name, match1,
+# match_score1, match2, match_score2, ... in the order the report expects; 'labels' are the values reported for the
+# database rows. 'fields' maps column headers to other values of the database rows, reported after the score of
+# every match (match1 <header>, ...), so matches with the same name can be told apart
+# With 'n_matches', there are always that many match columns: matches a record has no row for (a database smaller
+# than 'n_matches', or fewer candidates than matches) are left empty, so every batch has the same columns
+def result_frame(names: list, rows: np.ndarray, scores: np.ndarray, labels: list, fields: dict = None,
+                 n_matches: int = None) -> pd.DataFrame:
+    if n_matches is not None and rows.shape[1] < n_matches:
+        missing = n_matches - rows.shape[1]
+        rows = np.pad(rows, ((0, 0), (0, missing)), constant_values=-1)
+        scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=np.nan)
+
+    # Look up the matched labels and values; missing matches stay None
+    matches = np.array(list(labels) + [None], dtype=object)[rows]
+    field_matches = {field: np.array(list(values) + [None], dtype=object)[rows]
+                     for field, values in (fields or {}).items()}
+
+    result_df = pd.DataFrame({'name': names})
+    for i in range(rows.shape[1]):
+        result_df[f'match{i + 1}'] = matches[:, i]
+        result_df[f'match_score{i + 1}'] = scores[:, i]
+        for field, values in field_matches.items():
+            result_df[f'match{i + 1} {field}'] = values[:, i]
+    return result_df
@@ -0,0 +1,247 @@
+# Import required modules
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+# Logger for the structured per-request and per-job log lines (one JSON object per line)
+logger = logging.getLogger('record_matching')
+
+# Upper bounds (in seconds) of the duration histogram buckets
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, float('inf'))
+
+
+# Format a label set the way the Prometheus text format expects it
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = [(key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for key, value in labels]
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+# Format a number for the Prometheus text format
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+# In-process store of counters, gauges and duration histograms, rendered in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._types = {}
+        self._help = {}
+        self._values = {}
+        self._histograms = {}
+
+        # Functions called at render time that return (name, type, help, labels, value) samples
+        self._collectors = []
+
+    def _declare(self, name: str, metric_type: str, help_text: str):
+        self._types.setdefault(name, metric_type)
+        if help_text:
+            self._help.setdefault(name, help_text)
+
+    # Add to a counter
+    def inc(self, name: str, value: float = 1, help_text: str = None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, 'counter', help_text)
+            self._values[key] = self._values.get(key, 0) + value
+
+    # Set a gauge
+    def set(self, name: str, value: float, help_text: str = None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, 'gauge', help_text)
+            self._values[key] = value
+
+    # Record a duration (or any value) in a histogram
+    def observe(self, name: str, value: float, help_text: str = None, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._declare(name, 'histogram', help_text)
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    # Register a function that reports samples computed at scrape time (e.g. cache sizes)
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    # Render every metric in the Prometheus text exposition format
+    def render(self) -> str:
+        samples = {}
+        with self._lock:
+            types = dict(self._types)
+            help_texts = dict(self._help)
+            for (name, labels), value in self._values.items():
+                samples.setdefault(name, []).append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                lines = samples.setdefault(name, [])
+                for bound, count in zip(DURATION_BUCKETS, histogram['buckets']):
+                    lines.append((f'{name}_bucket', labels + (('le', _format_value(bound)),), count))
+                lines.append((f'{name}_sum', labels, histogram['sum']))
+                lines.append((f'{name}_count', labels, histogram['count']))
+
+        for collector in self._collectors:
+            for name, metric_type, help_text, labels, value in collector():
+                types.setdefault(name, metric_type)
+                if help_text:
+                    help_texts.setdefault(name, help_text)
+                samples.setdefault(name, []).append((name, tuple(sorted(labels.items())), value))
+
+        output = []
+        for name in sorted(samples):
+            if name in help_texts:
+                output.append(f'# HELP {name} {help_texts[name]}')
+            output.append(f'# TYPE {name} {types[name]}')
+            for sample_name, labels, value in samples[name]:
+                output.append(f'{sample_name}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(output) + '\n'
+
+
+# Registry shared by the routes of this process
+registry = MetricsRegistry()
+
+
+# Report the reference-database cache of this process at scrape time
+# (only once a route has imported the cache module: importing it here would load the matching engine on the first
+# scrape; see warmup.py)
+def _reference_cache_samples() -> list:
+    module = sys.modules.get(f'{__package__}.reference_cache')
+    if module is None:
+        return []
+    stats = module.reference_cache.stats()
+    labels = {'process': 'web'}
+    return [
+        ('record_matching_reference_cache_hits_total', 'counter', 'Reference database lookups answered from memory.',
+         labels, stats['hits']),
+        ('record_matching_reference_cache_misses_total', 'counter', 'Reference database lookups that loaded the file.',
+         labels, stats['misses']),
+        ('record_matching_reference_cache_evictions_total', 'counter', 'Reference databases evicted for space.',
+         labels, stats['evictions']),
+        ('record_matching_reference_cache_entries', 'gauge', 'Reference databases resident in memory.',
+         labels, stats['entries']),
+        ('record_matching_reference_cache_bytes', 'gauge', 'Approximate memory used by the resident databases.',
+         labels, stats['nbytes']),
+        ('record_matching_reference_cache_budget_bytes', 'gauge', 'Memory budget of the reference database cache.',
+         labels, stats['memory_budget']),
+    ]
+
+
+# Report the query result cache of this process at scrape time, once a route has imported it
+def _match_cache_samples() -> list:
+    module = sys.modules.get(f'{__package__}.match_cache')
+    if module is None:
+        return []
+    stats = module.match_cache.stats()
+    labels = {'process': 'web'}
+    return [
+        ('record_matching_result_cache_hits_total', 'counter', 'Queries answered from the result cache.',
+         labels, stats['hits']),
+        ('record_matching_result_cache_misses_total', 'counter', 'Queries that had to be scored.',
+         labels, stats['misses']),
+        ('record_matching_result_cache_entries', 'gauge', 'Query results held by the result cache.',
+         labels, stats['entries']),
+    ]
+
+
+registry.add_collector(_reference_cache_samples)
+registry.add_collector(_match_cache_samples)
+
+
+# Label of the route being served, unless one is given
+def _route(route: str = None) -> str:
+    if route:
+        return route
+    return request.endpoint or 'unknown' if has_request_context() else 'unknown'
+
+
+# Record the duration of one stage of a route
+def record_stage(stage_name: str, seconds: float, route: str = None):
+    registry.observe('record_matching_stage_seconds', seconds, 'Duration of each matching pipeline stage.',
+                     route=_route(route), stage=stage_name)
+
+    # Keep the stage timings of the current request for its log line
+    if has_request_context():
+        stages = g.setdefault('stages', {})
+        stages[stage_name] = round(stages.get(stage_name, 0) + seconds, 6)
+
+
+# Time a block of code as one stage of a route
+@contextmanager
+def stage(stage_name: str, route: str = None):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage_name, time.perf_counter() - start, route)
+
+
+# Count the records matched by a route and the throughput of the last batch
+def record_rows(rows: int, seconds: float, route: str = None):
+    route = _route(route)
+    registry.inc('record_matching_rows_total', rows, 'Records matched.', route=route)
+    if seconds > 0:
+        registry.set('record_matching_rows_per_second', rows / seconds,
+                     'Throughput of the most recent matching batch.', route=route)
+    if has_request_context():
+        g.rows = g.get('rows', 0) + rows
+
+
+# Stage timings collected without a registry, for code that runs in another process (e.g. matching jobs)
+# and reports its timings back with its result
+class StageTimer:
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, stage_name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[stage_name] = self.stages.get(stage_name, 0) + time.perf_counter() - start
+
+
+# Write one structured log line
+def log_event(event: str, **fields):
+    logger.info(json.dumps({'event': event, **fields}, default=str, sort_keys=True))
+
+
+# Time every request and write one structured log line per request
+def init_app(app):
+    if not logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def log_request(response):
+        seconds = time.perf_counter() - g.get('request_start', time.perf_counter())
+        route = request.endpoint or 'unknown'
+        registry.inc('record_matching_requests_total', 1, 'HTTP requests handled.', route=route,
+                     status=response.status_code)
+        registry.observe('record_matching_request_seconds', seconds, 'HTTP request duration.', route=route)
+        if route not in ('auth.metrics_endpoint', 'static'):
+            log_event('request', route=route, method=request.method, status=response.status_code,
+                      seconds=round(seconds, 6), stages=g.get('stages', {}), rows=g.get('rows'))
+        return response
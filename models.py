@@ -1,6 +1,7 @@
 # Import the 'db' instance, which is an instance of SQLAlchemy
 from . import db
 from flask_login import UserMixin
+from sqlalchemy.sql import func
 
 
 # Define the User model class, which represents a table in the database
@@ -10,3 +11,38 @@ class User(db.Model, UserMixin):
     email = db.Column(db.String(150), unique=True)  # Email column, unique constraint
     password = db.Column(db.String(100))  # Password column
     isAdmin = db.Column(db.Boolean, default=False)  # isAdmin column, defaults to False
+
+
+# Define the MatchJob model class, which tracks record uploads matched in the background
+class MatchJob(db.Model):
+    # Define the columns of the MatchJob table
+    id = db.Column(db.Integer, primary_key=True)  # Primary key column, used as the job id
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)  # Owner of the job
+    database_name = db.Column(db.String(150))  # Reference database the records are matched against
+    status = db.Column(db.String(20), default='queued')  # queued, running, done or failed
+    stage = db.Column(db.String(50), default='queued')  # Current processing stage, shown to the user
+    rows_done = db.Column(db.Integer, default=0)  # Number of records matched so far
+    rows_total = db.Column(db.Integer, default=0)  # Number of records in the upload
+    result_path = db.Column(db.String(300))  # Workbook produced by the job, set when it is done
+    error = db.Column(db.Text)  # Error message, set when the job failed
+    created_at = db.Column(db.DateTime, default=func.now())  # Time the job was enqueued (UTC)
+    started_at = db.Column(db.DateTime)  # Time a worker picked the job up (UTC)
+    finished_at = db.Column(db.DateTime)  # Time the job completed or failed (UTC)
+
+
+# Define the MatchResult model class, which keeps the matches found by a job for browsing, one row per record and
+# rank (ids follow the upload order)
+# Results are browsed within a job in upload order or by score, which the two indexes serve (SQLite appends the id
+# to every index, so ties are ordered by id without a separate column)
+class MatchResult(db.Model):
+    __table_args__ = (db.Index('ix_match_result_job_score', 'job_id', 'score'),)
+
+    # Define the columns of the MatchResult table
+    id = db.Column(db.Integer, primary_key=True)  # Primary key column, in the order the results were written
+    job_id = db.Column(db.Integer, db.ForeignKey('match_job.id'), index=True)  # Job that found the match
+    row = db.Column(db.Integer)  # Position of the record in the upload (1-based)
+    name = db.Column(db.Text)  # Record name as uploaded
+    rank = db.Column(db.Integer)  # Rank of the match for the record (1 is the best match)
+    match = db.Column(db.Text)  # Matched database name
+    score = db.Column(db.Float)  # Score of the match (0-100)
+    database_name = db.Column(db.String(150))  # Reference database the match comes from
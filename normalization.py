@@ -0,0 +1,107 @@
+# Import required modules
+import re
+import unicodedata
+
+# Legal-form words removed from the end of company names by the 'remove_legal_suffixes' step
+LEGAL_SUFFIXES = {
+    'ab', 'ag', 'as', 'asa', 'bhd', 'bv', 'co', 'company', 'corp', 'corporation', 'cv', 'gmbh', 'inc',
+    'incorporated', 'kg', 'kk', 'llc', 'llp', 'lp', 'ltd', 'limited', 'nv', 'oy', 'plc', 'pte', 'pty', 'sa', 'sae',
+    'sarl', 'sas', 'se', 'spa', 'srl',
+}
+
+# Punctuation removed by the 'strip_punctuation' step; periods are dropped so that abbreviations like
+# 's.a.' become one word, everything else becomes a space
+_PERIODS = re.compile(r'\.')
+_PUNCTUATION = re.compile(r'[^\w\s]|_')
+_WHITESPACE = re.compile(r'\s+')
+
+
+# Lowercase the text
+def lower(text: str) -> str:
+    return text.lower()
+
+
+# Replace accented characters by their unaccented form (e.g. 'é' -> 'e')
+def fold_accents(text: str) -> str:
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+# Remove punctuation and collapse runs of whitespace
+def strip_punctuation(text: str) -> str:
+    text = _PUNCTUATION.sub(' ', _PERIODS.sub('', text))
+    return _WHITESPACE.sub(' ', text).strip()
+
+
+# Remove legal-form words (inc, llc, ltd, ...) from the end of the name, keeping at least one word
+def remove_legal_suffixes(text: str) -> str:
+    tokens = text.split()
+    while len(tokens) > 1 and tokens[-1].lower().strip('.,') in LEGAL_SUFFIXES:
+        tokens.pop()
+    return ' '.join(tokens)
+
+
+# Sort the words of the name so that word order does not affect the score
+def sort_tokens(text: str) -> str:
+    return ' '.join(sorted(text.split()))
+
+
+# Steps that can be combined into a normalization pipeline, in the order they are written
+STEPS = {
+    'lower': lower,
+    'fold_accents': fold_accents,
+    'strip_punctuation': strip_punctuation,
+    'remove_legal_suffixes': remove_legal_suffixes,
+    'sort_tokens': sort_tokens,
+}
+
+# Named pipelines offered on the forms; 'lower' is the historical behaviour and the default
+PIPELINES = {
+    'lower': ('lower',),
+    'standard': ('lower', 'fold_accents', 'strip_punctuation', 'remove_legal_suffixes'),
+    'token_sorted': ('lower', 'fold_accents', 'strip_punctuation', 'remove_legal_suffixes', 'sort_tokens'),
+}
+DEFAULT_PIPELINE = 'lower'
+
+
+# Turn a pipeline name or a comma-separated list of steps into the canonical pipeline key
+# Raises ValueError for unknown pipelines or steps
+def pipeline_key(spec: str = None) -> str:
+    if not spec:
+        return DEFAULT_PIPELINE
+    if spec in PIPELINES:
+        return spec
+
+    steps = tuple(step.strip() for step in spec.split(',') if step.strip())
+    unknown = [step for step in steps if step not in STEPS]
+    if not steps or unknown:
+        raise ValueError(f'Unknown normalization step(s): {", ".join(unknown) or spec}')
+
+    # A step list identical to a named pipeline shares its cached keys
+    for name, pipeline in PIPELINES.items():
+        if pipeline == steps:
+            return name
+    return ','.join(steps)
+
+
+# Get the step functions of a pipeline
+def _steps(key: str) -> list:
+    return [STEPS[step] for step in PIPELINES.get(key, key.split(','))]
+
+
+# Normalize one name with a pipeline
+def normalize(text: str, pipeline: str = DEFAULT_PIPELINE) -> str:
+    for step in _steps(pipeline_key(pipeline)):
+        text = step(text)
+    return text
+
+
+# Normalize a list of names with a pipeline
+def normalize_all(values: list, pipeline: str = DEFAULT_PIPELINE) -> list:
+    steps = _steps(pipeline_key(pipeline))
+    normalized = []
+    for text in values:
+        for step in steps:
+            text = step(text)
+        normalized.append(text)
+    return normalized
@@ -0,0 +1,395 @@
+# Import required modules
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from . import database_store
+from . import normalization
+from .candidate_index import NGramIndex
+from .database_store import DATABASE_DIR, list_databases
+from .field_matching import BlockIndex
+from .match_cache import match_cache
+from .threshold_matching import LengthIndex
+
+# Memory budget (in bytes) shared by every cached reference database, configurable through the environment
+DEFAULT_MEMORY_BUDGET = int(os.environ.get('REFERENCE_CACHE_BYTES', 512 * 1024 * 1024))
+
+
+# Estimate the memory held by a list of strings (list object plus the string objects it references)
+def _estimate_size(values: list) -> int:
+    return sys.getsizeof(values) + sum(sys.getsizeof(value) for value in values)
+
+
+# Place the values of the kept rows at their new rows ('row_map', -1 for removed rows) and the added values at
+# 'added_rows'
+def _remap(values: list, row_map: np.ndarray, added: list, added_rows: np.ndarray, size: int) -> list:
+    result = [None] * size
+    for row, new_row in enumerate(row_map.tolist()):
+        if new_row >= 0:
+            result[new_row] = values[row]
+    for row, value in zip(added_rows.tolist(), added):
+        result[row] = value
+    return result
+
+
+# A reference database loaded into memory together with its preprocessed choice lists
+class ReferenceDatabase:
+    def __init__(self, name: str, mtime: float, names: list, choices: list = None, artifact=None):
+        # Name of the database file and the modification time it was loaded at
+        self.name = name
+        self.mtime = mtime
+
+        # Original values of the first column, as strings, with empty cells removed
+        self.names = names
+
+        # Lowercased values used for case-insensitive matching
+        self.choices = choices if choices is not None else [value.lower() for value in names]
+
+        # Compiled copy the database was loaded from, which may hold precomputed normalized keys
+        self.artifact = artifact
+
+        # Approximate memory footprint, used by the cache to enforce its budget
+        self.nbytes = _estimate_size(self.names) + _estimate_size(self.choices)
+
+        # Normalized keys, candidate indexes and length-sorted keys per normalization pipeline, built on first use
+        self._normalized = {normalization.DEFAULT_PIPELINE: self.choices}
+        self._indexes = {}
+        self._length_indexes = {}
+        self._tfidf_indexes = {}
+
+        # Values of the other columns of the workbook per (column, pipeline), and block indexes per tuple of
+        # blocking columns, read and built on first use
+        self._fields = {}
+        self._block_indexes = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.names)
+
+    # Compute the keys of a normalization pipeline, reading them from the compiled copy when it has them
+    def _build_normalized(self, pipeline: str) -> list:
+        column = database_store.normalized_column(pipeline)
+        if self.artifact is not None and column in self.artifact.columns:
+            return self.artifact[column].tolist()
+        return normalization.normalize_all(self.names, pipeline)
+
+    # Return the names normalized with a pipeline, computing them once per database
+    def normalized(self, pipeline: str = normalization.DEFAULT_PIPELINE) -> list:
+        pipeline = normalization.pipeline_key(pipeline)
+        with self._lock:
+            if pipeline not in self._normalized:
+                self._normalized[pipeline] = self._build_normalized(pipeline)
+                self.nbytes += _estimate_size(self._normalized[pipeline])
+            return self._normalized[pipeline]
+
+    # Where the keys of a pipeline are stored: a list of (compiled copy path, its mtime, column, row count),
+    # or None when they are not stored (custom pipelines, or databases changed since they were loaded)
+    def segments(self, pipeline: str = normalization.DEFAULT_PIPELINE):
+        pipeline = normalization.pipeline_key(pipeline)
+        column = 'choices' if pipeline == normalization.DEFAULT_PIPELINE else database_store.normalized_column(pipeline)
+        if self.artifact is None or self.artifact.path is None or column not in self.artifact.columns:
+            return None
+        return [(self.artifact.path, self.artifact.mtime, column, len(self))]
+
+    # Check if the keys of a pipeline can be obtained without normalizing every name
+    def _has_stored_normalized(self, pipeline: str) -> bool:
+        return self.artifact is not None and database_store.normalized_column(pipeline) in self.artifact.columns
+
+    # Give an updated copy of this database the keys and candidate indexes built so far, updating them for the
+    # changed rows only; 'row_map' and 'added_rows' describe how rows moved (see database_store.diff_rows)
+    def _carry_over(self, reference: 'ReferenceDatabase', row_map: np.ndarray, added_rows: np.ndarray):
+        with self._lock:
+            normalized = dict(self._normalized)
+            indexes = dict(self._indexes)
+
+        added_names = [reference.names[row] for row in added_rows]
+        for pipeline, keys in normalized.items():
+            if pipeline not in reference._normalized and not reference._has_stored_normalized(pipeline):
+                added_keys = normalization.normalize_all(added_names, pipeline)
+                reference._normalized[pipeline] = _remap(keys, row_map, added_keys, added_rows, len(reference))
+                reference.nbytes += _estimate_size(reference._normalized[pipeline])
+
+        for pipeline, index in indexes.items():
+            keys = reference.normalized(pipeline)
+            reference._indexes[pipeline] = index.updated(row_map, [keys[row] for row in added_rows], added_rows,
+                                                         len(reference))
+            reference.nbytes += reference._indexes[pipeline].nbytes
+
+    # Return the next version of this database, loaded from its updated compiled copy, in which 'n_added' names
+    # were appended after the kept rows
+    def updated(self, mtime: float, artifact, row_map: np.ndarray, n_added: int) -> 'ReferenceDatabase':
+        reference = ReferenceDatabase(self.name, mtime, artifact['names'].tolist(), artifact['choices'].tolist(),
+                                      artifact)
+        self._carry_over(reference, row_map, np.arange(len(reference) - n_added, len(reference)))
+        return reference
+
+    # Return the n-gram candidate index over the keys of a pipeline, building it the first time it is requested
+    def candidate_index(self, pipeline: str = normalization.DEFAULT_PIPELINE) -> NGramIndex:
+        pipeline = normalization.pipeline_key(pipeline)
+        with self._lock:
+            if pipeline not in self._indexes:
+                self._indexes[pipeline] = NGramIndex(self.normalized(pipeline))
+                self.nbytes += self._indexes[pipeline].nbytes
+            return self._indexes[pipeline]
+
+    # Return the keys of a pipeline sorted by length, for threshold matching, sorting them the first time they are
+    # requested (updated copies of the database sort them again, which is much cheaper than an n-gram index)
+    def length_index(self, pipeline: str = normalization.DEFAULT_PIPELINE) -> LengthIndex:
+        pipeline = normalization.pipeline_key(pipeline)
+        with self._lock:
+            if pipeline not in self._length_indexes:
+                self._length_indexes[pipeline] = LengthIndex(self.normalized(pipeline))
+                self.nbytes += self._length_indexes[pipeline].nbytes
+            return self._length_indexes[pipeline]
+
+    # Return the TF-IDF vectors of the keys of a pipeline, building them the first time they are requested
+    # (updated copies of the database build them again, since the weight of every n-gram depends on the whole
+    # database; scipy is only imported here, when the TF-IDF mode is used)
+    def tfidf_index(self, pipeline: str = normalization.DEFAULT_PIPELINE):
+        from .tfidf_matching import TfidfIndex
+        pipeline = normalization.pipeline_key(pipeline)
+        with self._lock:
+            if pipeline not in self._tfidf_indexes:
+                self._tfidf_indexes[pipeline] = TfidfIndex(self.normalized(pipeline))
+                self.nbytes += self._tfidf_indexes[pipeline].nbytes
+            return self._tfidf_indexes[pipeline]
+
+    # Headers of the other columns of the workbook, which multi-field matching compares besides the names
+    @property
+    def fields(self) -> list:
+        if self.artifact is None:
+            return []
+        return list(self.artifact.metadata.get('fields', []))
+
+    # Return the values of another column of the workbook ('' where empty), normalized with a pipeline (None for
+    # the values as they are), reading them once per database; raises ValueError for unknown columns
+    def field_values(self, field: str, pipeline: str = None) -> list:
+        if field not in self.fields:
+            raise ValueError(f'Database {self.name} has no column {field}')
+        if pipeline is not None:
+            pipeline = normalization.pipeline_key(pipeline)
+        with self._lock:
+            if (field, pipeline) not in self._fields:
+                if pipeline is None:
+                    values = self.artifact[database_store.field_column(field)].tolist()
+                else:
+                    values = normalization.normalize_all(self.field_values(field), pipeline)
+                self._fields[(field, pipeline)] = values
+                self.nbytes += _estimate_size(values)
+            return self._fields[(field, pipeline)]
+
+    # Return the rows grouped by their values in the given blocking columns, grouping them the first time they are
+    # requested
+    def block_index(self, fields: tuple) -> BlockIndex:
+        fields = tuple(fields)
+        with self._lock:
+            if fields not in self._block_indexes:
+                self._block_indexes[fields] = BlockIndex([self.field_values(field) for field in fields])
+                self.nbytes += self._block_indexes[fields].nbytes
+            return self._block_indexes[fields]
+
+    # Name of the database a row comes from
+    def source(self, row: int) -> str:
+        return self.name
+
+    # Version of the contents, used to key cached query results (changes whenever the file changes)
+    @property
+    def version(self) -> tuple:
+        return (self.name, self.mtime)
+
+
+# Every reference database combined into one choice list, remembering which database each row came from
+class MergedReference(ReferenceDatabase):
+    def __init__(self, references: list):
+        # Names and modification times of the combined databases, used to detect when a rebuild is needed
+        self.key = tuple((reference.name, reference.mtime) for reference in references)
+        self.database_names = [reference.name for reference in references]
+        self._references = references
+
+        super().__init__('All', None, [name for reference in references for name in reference.names],
+                         [choice for reference in references for choice in reference.choices])
+
+        # Position in 'database_names' of the database each row belongs to
+        self.sources = np.repeat(np.arange(len(references), dtype=np.int32),
+                                 [len(reference) for reference in references])
+        self.nbytes += self.sources.nbytes
+
+    def source(self, row: int) -> str:
+        return self.database_names[self.sources[row]]
+
+    @property
+    def version(self) -> tuple:
+        return self.key
+
+    # Combine the normalized keys of the databases, which each compute them at most once
+    def _build_normalized(self, pipeline: str) -> list:
+        return [key for reference in self._references for key in reference.normalized(pipeline)]
+
+    def _has_stored_normalized(self, pipeline: str) -> bool:
+        return True
+
+    # The stored keys of every combined database, in row order
+    def segments(self, pipeline: str = normalization.DEFAULT_PIPELINE):
+        segments = []
+        for reference in self._references:
+            reference_segments = reference.segments(pipeline)
+            if reference_segments is None:
+                return None
+            segments.extend(reference_segments)
+        return segments
+
+    # Return the combination after one of its databases was replaced by its next version
+    # Returns the new combination with its row map and the combined rows of the added names
+    def updated(self, reference: ReferenceDatabase, row_map: np.ndarray, n_added: int) -> tuple:
+        references = [reference if current.name == reference.name else current for current in self._references]
+        merged = MergedReference(references)
+
+        # Every database keeps its rows; the updated one is renumbered and its added names follow its kept rows
+        offsets = np.cumsum([0] + [len(current) for current in references])
+        parts = []
+        for position, current in enumerate(self._references):
+            if current.name == reference.name:
+                parts.append(np.where(row_map >= 0, row_map + offsets[position], -1))
+                added_rows = np.arange(offsets[position + 1] - n_added, offsets[position + 1])
+            else:
+                parts.append(np.arange(len(current)) + offsets[position])
+        merged_row_map = np.concatenate(parts) if parts else np.empty(0, dtype=np.int64)
+
+        self._carry_over(merged, merged_row_map, added_rows)
+        return merged, merged_row_map, added_rows
+
+
+# Process-wide cache of reference databases with mtime-based invalidation and LRU eviction
+class ReferenceCache:
+    def __init__(self, directory: str = DATABASE_DIR, memory_budget: int = DEFAULT_MEMORY_BUDGET):
+        self.directory = directory
+        self.memory_budget = memory_budget
+
+        # Loaded databases ordered from least to most recently used
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+        # Combination of every database, kept resident for the 'All' selection
+        self._merged = None
+
+        # Lookups answered from memory, lookups that had to load the database, and databases evicted for space
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Load the names and choices of a database from its memory-mapped compiled copy
+    def _load(self, name: str, mtime: float) -> ReferenceDatabase:
+        artifact = database_store.load_database(os.path.join(self.directory, name))
+        return ReferenceDatabase(name, mtime, artifact['names'].tolist(), artifact['choices'].tolist(), artifact)
+
+    # Return the cached database, (re)loading it when it is missing or the file changed on disk
+    def get(self, name: str) -> ReferenceDatabase:
+        mtime = os.path.getmtime(os.path.join(self.directory, name))
+
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry.mtime == mtime:
+                self._entries.move_to_end(name)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        # Parse outside the lock so that other databases stay available while a large file loads
+        entry = self._load(name, mtime)
+
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = entry
+            self._evict()
+        return entry
+
+    # Return every database in the directory, in directory listing order
+    def get_all(self) -> list:
+        return [self.get(name) for name in list_databases(self.directory)]
+
+    # Return the combination of every database, rebuilding it when a database was added, changed or removed
+    def get_merged(self) -> MergedReference:
+        references = self.get_all()
+        key = tuple((reference.name, reference.mtime) for reference in references)
+
+        with self._lock:
+            if self._merged is not None and self._merged.key == key:
+                return self._merged
+
+        merged = MergedReference(references)
+        with self._lock:
+            self._merged = merged
+            self._evict()
+        return merged
+
+    # Replace a cached database by its next version after an incremental update, carrying its normalized keys,
+    # candidate indexes and cached query results over instead of rebuilding them (see database_store.update_database)
+    def apply_update(self, name: str, artifact, row_map: np.ndarray, n_added: int):
+        mtime = os.path.getmtime(os.path.join(self.directory, name))
+        with self._lock:
+            current = self._entries.get(name)
+            merged = self._merged
+
+        # Nothing was built for the database in this process; the next lookup maps the new copy
+        if current is None:
+            self.invalidate(name)
+            return
+
+        reference = current.updated(mtime, artifact, row_map, n_added)
+        match_cache.apply_update(current.version, reference, row_map,
+                                 np.arange(len(reference) - n_added, len(reference)))
+
+        # The combination is carried over too when it was built from the version that was updated
+        updated_merged = None
+        if merged is not None and any(member is current for member in merged._references):
+            updated_merged, merged_row_map, added_rows = merged.updated(reference, row_map, n_added)
+            match_cache.apply_update(merged.version, updated_merged, merged_row_map, added_rows)
+
+        with self._lock:
+            self._entries.pop(name, None)
+            self._entries[name] = reference
+            self._merged = updated_merged
+            self._evict()
+
+    # Drop a database from the cache (called when the admin uploads, updates or deletes it)
+    def invalidate(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+            self._merged = None
+
+    # Drop every cached database
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._merged = None
+
+    # Total approximate size of the cached databases, including any candidate indexes built since loading
+    @property
+    def nbytes(self) -> int:
+        merged = self._merged
+        return sum(entry.nbytes for entry in list(self._entries.values())) + (merged.nbytes if merged else 0)
+
+    # Evict least recently used databases until the budget is met (the newest entry is always kept)
+    # The combination is evicted first: it holds every database it combines, so evicting one of them while the
+    # combination is resident would free nothing and only make the next lookup load it again
+    def _evict(self):
+        if self._merged is not None and self.nbytes > self.memory_budget:
+            self._merged = None
+            self.evictions += 1
+        while self.nbytes > self.memory_budget and len(self._entries) > 1:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    # Number of lookups, resident databases and memory use, for the metrics endpoint
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'merged': self._merged is not None, 'nbytes': self.nbytes,
+                    'memory_budget': self.memory_budget}
+
+
+# Shared cache instance used by the routes
+reference_cache = ReferenceCache()
@@ -0,0 +1,333 @@
+# Import required modules and classes
+from contextlib import nullcontext
+
+import numpy as np
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.drawing.image import Image
+from openpyxl.styles import Font
+from openpyxl.utils import get_column_letter
+from openpyxl.workbook import Workbook
+
+# Score separating the "below" and "above" distributions of the report
+SCORE_THRESHOLD = 90
+
+# Score counted as a (near) exact match in the report
+EXACT_THRESHOLD = 95
+
+# Edges of the score histogram written to the summary sheet
+HISTOGRAM_BINS = np.arange(0, 101, 10)
+
+# Largest number of data rows in a worksheet (Excel's limit, less the header row)
+MAX_SHEET_ROWS = 1048575
+
+
+# Compute the report statistics of every match column with NumPy in one pass over the score matrix
+# Threshold matching results (one row per match, see threshold_matching) pass n_matches=None and are summarized
+# as a single column
+def summarize_scores(result_df: pd.DataFrame, n_matches: int) -> dict:
+    if n_matches is None:
+        columns, labels = ['match_score'], ['all matches']
+    else:
+        columns = [f'match_score{n}' for n in range(1, n_matches + 1)]
+        labels = [f'match {n}' for n in range(1, n_matches + 1)]
+    scores = result_df[columns].to_numpy(dtype=np.float64)
+    found = ~np.isnan(scores)
+    below = found & (scores < SCORE_THRESHOLD)
+    above = found & (scores >= SCORE_THRESHOLD)
+
+    # Count, mean, minimum and maximum of the scores selected by a mask, per match column
+    # (the initial values keep the reductions defined when there are no results, e.g. no record reached the minimum
+    # score of threshold matching; columns without scores get no statistics)
+    def masked_stats(mask: np.ndarray) -> dict:
+        count = mask.sum(axis=0)
+        selected = np.where(mask, scores, np.nan)
+        with np.errstate(invalid='ignore'):
+            return {
+                'count': count,
+                'mean': np.where(count > 0, np.nansum(selected, axis=0) / np.maximum(count, 1), np.nan),
+                'min': np.where(count > 0, np.min(np.where(mask, scores, np.inf), axis=0, initial=np.inf), np.nan),
+                'max': np.where(count > 0, np.max(np.where(mask, scores, -np.inf), axis=0, initial=-np.inf), np.nan),
+            }
+
+    return {
+        'rows': len(result_df),
+        'columns': columns,
+        'labels': labels,
+        'all': masked_stats(found),
+        'below': masked_stats(below),
+        'above': masked_stats(above),
+        'exact': (found & (scores >= EXACT_THRESHOLD)).sum(axis=0),
+        'histogram': np.stack([np.histogram(scores[found[:, i], i], bins=HISTOGRAM_BINS)[0]
+                               for i in range(len(columns))], axis=1) if columns else np.zeros((10, 0), dtype=int),
+    }
+
+
+# Render the dashboard of histograms, pie charts and averages to a PNG image
+# matplotlib is only imported here, so reports without charts never load it
+def render_charts(result_df: pd.DataFrame, n_matches: int, img_path: str):
+    import matplotlib
+
+    # Render figures without a display, since reports are produced in background worker processes
+    matplotlib.use('Agg')
+    from matplotlib import pyplot as plt
+
+    # Create a figure for the visualizations with a large size
+    fig = plt.figure(figsize=(40, 50))
+
+    # Adjust the vertical space between subplots
+    plt.subplots_adjust(hspace=.5)
+
+    # Set the font size for subplot titles
+    plt.rcParams['axes.titlesize'] = 13
+
+    # Set the background color of the figure to white
+    fig.patch.set_facecolor('white')
+
+    # Function to format the text for displaying statistics
+    def get_text_str(mu, minimum, maximum):
+        return '\n'.join((
+            r'$\mu=%.2f$' % (mu,),
+            r'min=%.2f' % (minimum,),
+            r'max=%.2f' % (maximum,)))
+
+    # Function to create a histogram with a threshold
+    def hist_threshold(hist_ax, column_name: str, title: str, greater=False):
+        if greater:
+            hist_data = result_df[result_df[column_name] >= 90][column_name]
+        else:
+            hist_data = result_df[result_df[column_name] < 90][column_name]
+
+        mu = hist_data.mean()
+        minimum = hist_data.min()
+        maximum = hist_data.max()
+        hist_ax.hist(hist_data, int(90 / 10))
+        hist_ax.set_xlabel('Score')
+        hist_ax.set_ylabel('Count')
+        hist_ax.set_title(title)
+        props = dict(boxstyle='round', facecolor='wheat', alpha=0.5)
+        hist_ax.text(0.03, 0.9, get_text_str(mu, minimum, maximum), transform=hist_ax.transAxes, fontsize=11,
+                     verticalalignment='top', bbox=props)
+
+    # Function to create a pie chart with a threshold
+    def pie_threshold(pie_ax, column_name: str, title: str, thresh: int):
+        pie_data = result_df[column_name]
+        pie_data = pie_data.apply(lambda x: 1 if x >= thresh else 0)
+        try:
+            pie_ax.pie(pie_data.value_counts(), labels=[f'<{thresh}%', f'{thresh}%'], autopct='%1.1f%%')
+        except:
+            pie_ax.pie(pie_data.value_counts(), labels=[f'{thresh}%'], autopct='%1.1f%%')
+        pie_ax.set_title(title)
+
+    # Define the number of columns and rows for the subplots grid
+    n_cols = 3
+    n_rows = 6
+
+    # Define the threshold value for pie charts
+    threshold = 95
+
+    # Loop over the number of matches and create subplots with histograms and pie charts
+    for n in range(1, n_matches + 1):
+        ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 1)
+        hist_threshold(ax, f'match_score{n}', f'Distribution of scores below the threshold for match {n}')
+        ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 2)
+        hist_threshold(ax, f'match_score{n}', f'Distribution of scores above the threshold for match {n}',
+                       greater=True)
+        ax = plt.subplot(n_rows, n_cols, (n - 1) * 3 + 3)
+        if n == 1:
+            pie_threshold(ax, f'match_score{n}', f'Distribution of scores that are 100% for match {n}',
+                          threshold)
+        else:
+            pie_threshold(ax, f'match_score{n}', f'Distribution of scores that are {threshold}% for match {n}',
+                          threshold)
+
+    # Create subplots for displaying the average scores
+    ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 1)
+    data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]].mean()
+    ax.bar(data.index, data.values)
+    ax.set_xlabel('Match')
+    ax.set_ylabel('Score')
+    ax.set_title('Average score for each match')
+    plt.setp(ax.get_xticklabels(), rotation=30, horizontalalignment='right')
+
+    ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 2)
+    data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]].mean(axis=1)
+    ax.plot(data.index, data.values)
+    ax.set_xlabel('Insurer name')
+    ax.set_ylabel('Score')
+    ax.set_title('Average score for each insurer name')
+
+    ax = plt.subplot(n_rows, n_cols, n_matches * 3 + 3)
+    data = result_df[[f'match_score{n}' for n in range(1, n_matches + 1)]]
+    ax.boxplot([column.dropna().values for _, column in data.items()])
+    ax.set_xlabel('Match #')
+    ax.set_ylabel('Score')
+    ax.set_title('Box and whisker chart for each match')
+
+    # Save the figure with all the subplots to the specified image path and release it
+    plt.savefig(img_path)
+    plt.close(fig)
+
+
+# Convert a statistic to a cell value, leaving the cell empty when there is no value
+def _cell(value) -> float:
+    return None if np.isnan(value) else float(value)
+
+
+# Bold header cells for a write-only worksheet
+def _header(sheet, values: list) -> list:
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.font = Font(bold=True)
+        cells.append(cell)
+    return cells
+
+
+# Size the columns of a worksheet to fit a DataFrame, measuring the longest value of each column with pandas
+# Empty cells (None or NaN, e.g. the matches a record has fewer of) count as empty strings, and a column without any
+# value is as wide as its header
+def _fit_columns(sheet, df: pd.DataFrame):
+    for i, column in enumerate(df.columns, start=1):
+        values = df[column].map(lambda value: '' if value is None or value != value else str(value))
+        longest = values.str.len().max() if len(values) else 0
+        length = max(len(str(column)), 0 if pd.isna(longest) else int(longest))
+        sheet.column_dimensions[get_column_letter(i)].width = length
+
+
+# Write the match results, the summary statistics and optionally the chart image to a streaming workbook
+# 'pruning' holds the candidate counts of threshold matching (min_score, pairs, scored, pruned), and 'blocking' the
+# pair counts of multi-field matching (blocking_fields, pairs, scored, skipped, unblocked)
+def write_results_workbook(result_df: pd.DataFrame, summary: dict, download_path: str, img_path: str = None,
+                           pruning: dict = None, blocking: dict = None):
+    # Create a new write-only Excel workbook; rows are streamed to disk instead of kept as cell objects
+    wb = Workbook(write_only=True)
+
+    # Create the worksheets storing the data from the result DataFrame: results beyond the row limit of a sheet
+    # continue in 'Results 2', 'Results 3', ...
+    result_sheets = []
+    for start in range(0, max(len(result_df), 1), MAX_SHEET_ROWS):
+        part_df = result_df.iloc[start:start + MAX_SHEET_ROWS]
+        dataframe_sheet = wb.create_sheet('Results' if start == 0 else f'Results {len(result_sheets) + 1}')
+        result_sheets.append(dataframe_sheet.title)
+
+        # Size the columns to fit the data
+        _fit_columns(dataframe_sheet, part_df)
+
+        # Append the bold column headers, then every row of the part (empty cells stay empty)
+        dataframe_sheet.append(_header(dataframe_sheet, part_df.columns.tolist()))
+        for row in part_df.astype(object).where(part_df.notna(), None).itertuples(index=False, name=None):
+            dataframe_sheet.append(row)
+
+    # Create a new worksheet with the summary statistics of every match
+    summary_sheet = wb.create_sheet('Summary')
+    summary_sheet.append(_header(summary_sheet, [
+        'Match', 'Records', 'Mean score', 'Min score', 'Max score',
+        f'Below {SCORE_THRESHOLD}: count', f'Below {SCORE_THRESHOLD}: mean', f'Below {SCORE_THRESHOLD}: min',
+        f'Below {SCORE_THRESHOLD}: max', f'{SCORE_THRESHOLD}+: count', f'{SCORE_THRESHOLD}+: mean',
+        f'{SCORE_THRESHOLD}+: min', f'{SCORE_THRESHOLD}+: max', f'{EXACT_THRESHOLD}+: count']))
+    for i, label in enumerate(summary['labels']):
+        row = [label]
+        for stats in (summary['all'], summary['below'], summary['above']):
+            row += [int(stats['count'][i]), _cell(stats['mean'][i]), _cell(stats['min'][i]), _cell(stats['max'][i])]
+        summary_sheet.append(row + [int(summary['exact'][i])])
+
+    # Add the score histogram below the statistics
+    summary_sheet.append([])
+    summary_sheet.append(_header(summary_sheet, ['Score'] + summary['labels']))
+    for low, high, counts in zip(HISTOGRAM_BINS[:-1], HISTOGRAM_BINS[1:], summary['histogram']):
+        summary_sheet.append([f'{low}-{high}'] + [int(count) for count in counts])
+
+    # List the result sheets when the results did not fit in one
+    if len(result_sheets) > 1:
+        summary_sheet.append([])
+        summary_sheet.append(_header(summary_sheet, ['Results', 'Value']))
+        summary_sheet.append(['Result rows', len(result_df)])
+        summary_sheet.append([f'Result sheets (at most {MAX_SHEET_ROWS} rows each)', ', '.join(result_sheets)])
+
+    # Add the candidate counts of threshold matching, showing how much of the work length pruning skipped
+    if pruning is not None:
+        summary_sheet.append([])
+        summary_sheet.append(_header(summary_sheet, ['Threshold matching', 'Value']))
+        summary_sheet.append(['Minimum score', pruning['min_score']])
+        summary_sheet.append(['Candidate pairs', pruning['pairs']])
+        summary_sheet.append(['Pairs scored', pruning['scored']])
+        summary_sheet.append(['Pairs pruned by length', pruning['pruned']])
+        summary_sheet.append(['Share pruned', pruning['pruned'] / pruning['pairs'] if pruning['pairs'] else None])
+
+    # Add the pair counts of multi-field matching, showing how much of the work blocking skipped
+    if blocking is not None:
+        summary_sheet.append([])
+        summary_sheet.append(_header(summary_sheet, ['Multi-field matching', 'Value']))
+        summary_sheet.append(['Blocking fields', ', '.join(blocking['blocking_fields']) or None])
+        summary_sheet.append(['Candidate pairs', blocking['pairs']])
+        summary_sheet.append(['Pairs scored', blocking['scored']])
+        summary_sheet.append(['Pairs skipped by blocking', blocking['skipped']])
+        summary_sheet.append(['Share skipped', blocking['skipped'] / blocking['pairs'] if blocking['pairs'] else None])
+        summary_sheet.append(['Records without blocking values', blocking['unblocked']])
+
+    # Create a worksheet with the chart image when the charts were rendered
+    if img_path is not None:
+        image_sheet = wb.create_sheet('Report')
+
+        # Load the previously saved image and set its width and height in the Excel sheet
+        img = Image(img_path)
+        img.width = 2000
+        img.height = 2500
+
+        # Add the image to the 'Report' worksheet at cell A1
+        image_sheet.add_image(img, 'A1')
+
+    # Save the workbook to the download path
+    wb.save(download_path)
+
+
+# Write the match results as CSV, the fastest output for large uploads
+def write_results_csv(result_df: pd.DataFrame, download_path: str):
+    result_df.to_csv(download_path, index=False)
+
+
+# Write the output of a matching job: a CSV file, or a workbook with results, summary and optional charts
+# When a stage timer is given, each step is timed as its own stage
+# Threshold matching results pass n_matches=None and their pruning counts, multi-field matching results their
+# blocking counts (see write_results_workbook)
+def write_report(result_df: pd.DataFrame, n_matches: int, download_path: str, img_path: str = None, timer=None,
+                 pruning: dict = None, blocking: dict = None):
+    def stage(name: str):
+        return timer.stage(name) if timer is not None else nullcontext()
+
+    if download_path.endswith('.csv'):
+        with stage('write_csv'):
+            write_results_csv(result_df, download_path)
+        return
+
+    with stage('summarize'):
+        summary = summarize_scores(result_df, n_matches)
+    if img_path is not None:
+        with stage('render_charts'):
+            render_charts(result_df, n_matches, img_path)
+    with stage('write_workbook'):
+        write_results_workbook(result_df, summary, download_path, img_path, pruning, blocking)
+
+
+# Write the clusters and pairs found by a duplicate search to a streaming workbook, with a summary of the search
+# 'summary' maps the labels of the summary sheet to their values; pairs beyond the sheet limit are left out and
+# their number is added to the summary
+def write_duplicates_report(clusters_df: pd.DataFrame, pairs_df: pd.DataFrame, summary: dict, download_path: str):
+    wb = Workbook(write_only=True)
+
+    summary_sheet = wb.create_sheet('Summary')
+    summary_sheet.append(_header(summary_sheet, ['Duplicate search', 'Value']))
+    for label, value in summary.items():
+        summary_sheet.append([label, value])
+    if len(pairs_df) > MAX_SHEET_ROWS:
+        summary_sheet.append(['Pairs left out of the Pairs sheet', len(pairs_df) - MAX_SHEET_ROWS])
+
+    for title, df in (('Clusters', clusters_df), ('Pairs', pairs_df.iloc[:MAX_SHEET_ROWS])):
+        sheet = wb.create_sheet(title)
+        _fit_columns(sheet, df)
+        sheet.append(_header(sheet, df.columns.tolist()))
+        for row in df.astype(object).itertuples(index=False, name=None):
+            sheet.append(row)
+
+    wb.save(download_path)
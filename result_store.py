@@ -0,0 +1,116 @@
+# Import required modules
+import hashlib
+import json
+import os
+import shutil
+
+# Directory of finished results kept for reuse, named after the hash of everything that determines their contents
+RESULT_DIR = 'static/results/'
+
+# Largest number of results kept; the least recently used ones are removed first
+MAX_STORED_RESULTS = int(os.environ.get('RESULT_STORE_MAX', 200))
+
+# Changed whenever the contents of the results change for the same inputs, so older results are not reused
+# (version 2 results also name the job whose results were kept in the result table)
+RESULT_FORMAT_VERSION = 2
+
+# Size of the blocks read when hashing an uploaded file
+_HASH_BLOCK = 1024 * 1024
+
+
+# Hash the contents of a file without reading it into memory at once
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Key of the result of matching an uploaded file against a database with the given job options
+# The database is identified by its name and modification time, like the cached query results
+def result_key(file_path: str, database_path: str, options: dict, n_matches: int) -> str:
+    rerank = options['match_mode'] == 'tfidf' and bool(options.get('rerank'))
+    indexed = options['match_mode'] == 'indexed' or rerank
+    threshold = options['match_mode'] == 'threshold'
+    xlsx = options['output_format'] == 'xlsx'
+    fields = options.get('fields') or None
+    inputs = {
+        'version': RESULT_FORMAT_VERSION,
+        'upload': file_digest(file_path),
+        'database': [os.path.basename(database_path), os.path.getmtime(database_path)],
+        'match_mode': options['match_mode'],
+        'candidate_limit': options['candidate_limit'] if indexed else None,
+        'rerank': rerank,
+        'min_score': options['min_score'] if threshold else None,
+        'normalizer': options['normalizer'],
+        'scorer': options['scorer'],
+        'output_format': options['output_format'],
+        'charts': bool(options['charts']) and xlsx and not threshold,
+        'n_matches': n_matches,
+        'fields': fields,
+        'name_weight': options.get('name_weight') if fields else None,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+# Paths of a stored result and of the description stored next to it
+def _paths(key: str, output_format: str) -> tuple:
+    return f'{RESULT_DIR}{key}.{output_format}', f'{RESULT_DIR}{key}.json'
+
+
+# Link (or copy, when linking is not possible) a file to a new path
+def _link(source: str, destination: str):
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+# Put a stored result at the download path of a new job; returns its description (number of records, job that
+# produced it and number of results that job kept in the result table), or None when there is no stored result for
+# the key
+def restore(key: str, output_format: str, download_path: str):
+    path, meta_path = _paths(key, output_format)
+    try:
+        with open(meta_path) as f:
+            meta = json.load(f)
+        _link(path, download_path)
+    except (OSError, ValueError):
+        return None
+
+    # Mark the result as recently used so pruning keeps it
+    os.utime(meta_path)
+    return meta
+
+
+# Keep the result of a finished job for later uploads of the same file
+def store(key: str, output_format: str, result_path: str, rows: int, job_id: int, results: int):
+    os.makedirs(RESULT_DIR, exist_ok=True)
+    path, meta_path = _paths(key, output_format)
+    _link(result_path, path)
+
+    # The description is written last, so a result is only reused once it is complete
+    with open(meta_path + '.tmp', 'w') as f:
+        json.dump({'rows': rows, 'job_id': job_id, 'results': results}, f)
+    os.replace(meta_path + '.tmp', meta_path)
+    _prune()
+
+
+# Remove the least recently used results beyond the limit
+def _prune():
+    metas = [os.path.join(RESULT_DIR, name) for name in os.listdir(RESULT_DIR) if name.endswith('.json')]
+    if len(metas) <= MAX_STORED_RESULTS:
+        return
+
+    metas.sort(key=os.path.getmtime)
+    for meta_path in metas[:len(metas) - MAX_STORED_RESULTS]:
+        key = os.path.basename(meta_path)[:-len('.json')]
+        for name in os.listdir(RESULT_DIR):
+            if name.startswith(key + '.'):
+                try:
+                    os.remove(os.path.join(RESULT_DIR, name))
+                except OSError:
+                    pass
@@ -0,0 +1,51 @@
+# Import required modules
+from rapidfuzz import fuzz as rapidfuzz
+from rapidfuzz.distance import JaroWinkler
+
+# Scorers that can be selected per request, all reporting scores between 0 and 100
+SCORERS = {
+    'ratio': rapidfuzz.ratio,
+    'token_set_ratio': rapidfuzz.token_set_ratio,
+    'WRatio': rapidfuzz.WRatio,
+    'jaro_winkler': JaroWinkler.normalized_similarity,
+}
+DEFAULT_SCORER = 'ratio'
+
+# Scorers whose native scores lie between 0 and 1; their scores (and cutoffs) are scaled by 100
+_UNIT_SCORERS = {JaroWinkler.normalized_similarity}
+
+
+# Look up a scorer by name, raising ValueError for unknown names
+def get_scorer(name: str = None):
+    if not name:
+        name = DEFAULT_SCORER
+    if name not in SCORERS:
+        raise ValueError(f'Unknown scorer: {name}')
+    return SCORERS[name]
+
+
+# Name under which a scorer is registered, so it can be selected in another process
+def scorer_name(scorer) -> str:
+    for name, function in SCORERS.items():
+        if function is scorer:
+            return name
+    raise ValueError(f'Unregistered scorer: {scorer!r}')
+
+
+# Factor that brings the native scores of a scorer to the 0-100 range
+def score_scale(scorer) -> float:
+    return 100.0 if scorer in _UNIT_SCORERS else 1.0
+
+
+# Smallest ratio between the shorter and the longer string length at which a scorer can still reach a score
+# (0-100); threshold matching never scores keys whose length is further from the name's. Scorers without such a
+# bound (the token and weighted ratios) return 0, so every key is scored
+def min_length_ratio(scorer, score: float) -> float:
+    target = score / 100.0
+    if scorer is rapidfuzz.ratio:
+        # ratio is at most 2 * shorter / (shorter + longer)
+        return max(0.0, target / (2.0 - target)) if target < 2.0 else 1.0
+    if scorer is JaroWinkler.normalized_similarity:
+        # Jaro is at most (2 + shorter / longer) / 3, and the prefix bonus adds at most 0.4 of the remainder
+        return max(0.0, 5.0 * target - 4.0)
+    return 0.0
@@ -0,0 +1,324 @@
+# Sharded matching: the rows of the reference databases are split into shards, each scored by its own worker
+# process, and the per-shard top matches are merged into the overall top matches
+#
+# Workers map the compiled copies of the databases (database_store), so the strings are shared through the page
+# cache and every worker decodes only the rows of its shard. Workers are reached over multiprocessing.connection,
+# either started locally (MATCH_SHARD_WORKERS) or started separately, possibly on other machines, with
+#     python -m website.sharded_matching --listen 127.0.0.1:6001
+# and listed in MATCH_SHARD_ADDRESSES (comma-separated host:port or socket paths) with a shared MATCH_SHARD_AUTHKEY
+#
+# Local workers are started once per server: with MATCH_PRELOAD, the warm-up starts them in the gunicorn master and
+# the forked web workers share them, and the matching job workers connect to the workers of the process that
+# created their pool (see connection_info) instead of starting their own
+
+# Import required modules
+import argparse
+import atexit
+import logging
+import os
+import queue
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from . import database_store
+from . import matching
+from . import normalization
+from . import scorers
+
+logger = logging.getLogger(__name__)
+
+# Number of local shard workers started by a process that matches (0 disables local workers)
+SHARD_WORKERS = int(os.environ.get('MATCH_SHARD_WORKERS', 0))
+
+# Addresses of separately started shard workers, which take precedence over local workers
+SHARD_ADDRESSES = os.environ.get('MATCH_SHARD_ADDRESSES', '')
+
+# Key shared by the processes allowed to talk to the shard workers
+SHARD_AUTHKEY = os.environ.get('MATCH_SHARD_AUTHKEY', '')
+
+# Number of threads each shard worker scores with; one per worker lets the workers use one core each
+SHARD_THREADS = int(os.environ.get('MATCH_SHARD_THREADS', 1))
+
+# Seconds to wait for a local worker to start listening
+STARTUP_TIMEOUT = 30.0
+
+# Number of decoded row ranges a worker keeps; the least recently used are dropped first
+SEGMENT_CACHE_ENTRIES = int(os.environ.get('MATCH_SHARD_SEGMENTS', 16))
+
+
+# Raised when a shard cannot be scored (worker unavailable, or its database file changed); callers fall back to
+# scoring in the calling process
+class ShardError(Exception):
+    pass
+
+
+# Turn an address from the environment or the command line into a multiprocessing.connection address
+def parse_address(address: str):
+    host, _, port = address.rpartition(':')
+    if host and port.isdigit():
+        return host, int(port)
+    return address
+
+
+# Rows of the shards a worker has decoded, keyed by the file, its modification time, the column and the row range,
+# ordered from least to most recently used
+_segments = OrderedDict()
+_segments_lock = threading.Lock()
+
+
+# Decode rows start to end of a column of a compiled copy, once per worker while they stay in use
+def _load_segment(path: str, mtime: float, column: str, start: int, end: int) -> list:
+    key = (path, mtime, column, start, end)
+    with _segments_lock:
+        if key in _segments:
+            _segments.move_to_end(key)
+            return _segments[key]
+
+    artifact = database_store.read_artifact(path)
+    if artifact.mtime != mtime:
+        raise ShardError(f'{path} changed since the shard was planned')
+    values = artifact[column].slice(start, end)
+
+    # Keep a single version of every file, and at most SEGMENT_CACHE_ENTRIES row ranges
+    with _segments_lock:
+        for stale in [other for other in _segments if other[0] == path and other[1] != mtime]:
+            del _segments[stale]
+        _segments[key] = values
+        while len(_segments) > SEGMENT_CACHE_ENTRIES:
+            _segments.popitem(last=False)
+    return values
+
+
+# Score queries against one shard; returns the shard's top matches with rows numbered over all shards
+def _score_shard(request: dict) -> tuple:
+    choices = []
+    row_ids = []
+    for path, mtime, column, start, end, offset in request['segments']:
+        choices.extend(_load_segment(path, mtime, column, start, end))
+        row_ids.append(np.arange(offset, offset + end - start))
+    row_ids = np.concatenate(row_ids) if row_ids else np.empty(0, dtype=np.int64)
+
+    rows, scores = matching.top_matches(request['queries'], choices, n_matches=request['n_matches'],
+                                        scorer=scorers.get_scorer(request['scorer']),
+                                        score_cutoff=request['score_cutoff'], workers=request['threads'])
+    return np.where(rows >= 0, row_ids[np.maximum(rows, 0)] if len(row_ids) else -1, -1), scores
+
+
+# Answer the requests sent over one connection until the client closes it
+def _serve_connection(connection):
+    with connection:
+        while True:
+            try:
+                request = connection.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                connection.send(('ok', _score_shard(request)))
+            except Exception as e:
+                connection.send(('error', f'{type(e).__name__}: {e}'))
+
+
+# Run a shard worker: accept connections and score the shards requested over them, one thread per connection
+def serve(address, authkey: bytes):
+    with Listener(address, authkey=authkey) as listener:
+        while True:
+            connection = listener.accept()
+            threading.Thread(target=_serve_connection, args=(connection,), daemon=True).start()
+
+
+# Client side of the shard workers: one worker per shard, with a pool of open connections to each worker so that
+# concurrent requests do not wait for each other
+class ShardExecutor:
+    def __init__(self, addresses: list, authkey: bytes, threads: int = SHARD_THREADS, processes: list = None):
+        self.addresses = addresses
+        self.authkey = authkey
+        self.threads = threads
+        self._processes = processes or []
+        self._owner = os.getpid()
+        self._idle = [queue.SimpleQueue() for _ in addresses]
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def _connect(self, position: int):
+        try:
+            return self._idle[position].get_nowait()
+        except queue.Empty:
+            return Client(self.addresses[position], authkey=self.authkey)
+
+    # Send one request to every worker, then collect the answers; the workers score their shards at the same time
+    def _call(self, requests: list) -> list:
+        connections = []
+        try:
+            for position, request in enumerate(requests):
+                connection = self._connect(position)
+                connections.append(connection)
+                connection.send(request)
+
+            replies = [connection.recv() for connection in connections]
+        except (OSError, EOFError) as e:
+            # Connections in an unknown state are closed rather than reused
+            for connection in connections:
+                connection.close()
+            raise ShardError(f'Shard worker unavailable: {e}') from e
+
+        for position, connection in enumerate(connections):
+            self._idle[position].put(connection)
+
+        errors = [answer for status, answer in replies if status != 'ok']
+        if errors:
+            raise ShardError(errors[0])
+        return [answer for _, answer in replies]
+
+    # Find the top matches of the queries over segments of compiled copies
+    # 'segments' lists (path, mtime, column, row count) in the order their rows are numbered
+    def top_matches(self, segments: list, queries: list, n_matches: int, scorer, score_cutoff: float = None) -> tuple:
+        total = sum(count for _, _, _, count in segments)
+        bounds = np.linspace(0, total, len(self) + 1).astype(np.int64)
+
+        # Split the rows into one contiguous range per worker, possibly spanning several databases
+        requests = []
+        for shard in range(len(self)):
+            shard_segments = []
+            offset = 0
+            for path, mtime, column, count in segments:
+                start, end = max(bounds[shard], offset), min(bounds[shard + 1], offset + count)
+                if start < end:
+                    shard_segments.append((path, mtime, column, int(start - offset), int(end - offset), int(start)))
+                offset += count
+            requests.append({'segments': shard_segments, 'queries': queries, 'n_matches': n_matches,
+                             'scorer': scorers.scorer_name(scorer), 'score_cutoff': score_cutoff,
+                             'threads': self.threads})
+
+        answers = self._call(requests)
+        return merge_top_matches([rows for rows, _ in answers], [scores for _, scores in answers],
+                                 min(n_matches, total))
+
+    # Stop the local workers started for this executor (only in the process that started them, not in the processes
+    # forked from it that share them)
+    def close(self):
+        if os.getpid() != self._owner:
+            return
+        for process in self._processes:
+            process.terminate()
+
+
+# Merge the top matches of several shards into the overall top matches: best score first, ties by row,
+# which is the order an unsharded match returns
+def merge_top_matches(shard_rows: list, shard_scores: list, n_matches: int) -> tuple:
+    rows = np.hstack(shard_rows)
+    ranked = np.where(rows >= 0, np.hstack(shard_scores), -np.inf)
+    order = np.lexsort((rows, -ranked))[:, :n_matches]
+
+    rows = np.take_along_axis(rows, order, axis=1)
+    scores = np.take_along_axis(ranked, order, axis=1)
+    missing = np.isinf(scores)
+    rows[missing], scores[missing] = -1, np.nan
+    return rows, scores
+
+
+# Start shard workers as local processes listening on sockets in a private directory, stopped when this process exits
+# The workers are separate programs (see main) rather than multiprocessing children, which the processes forked from
+# this one would stop on exit
+def start_local_workers(count: int, threads: int = SHARD_THREADS) -> ShardExecutor:
+    authkey = os.urandom(32).hex()
+    directory = tempfile.mkdtemp(prefix='shards-')
+    environment = dict(os.environ, MATCH_SHARD_AUTHKEY=authkey)
+
+    addresses, processes = [], []
+    for shard in range(count):
+        address = os.path.join(directory, f'shard-{shard}.sock')
+        processes.append(subprocess.Popen([sys.executable, '-m', __name__, '--listen', address], env=environment))
+        addresses.append(address)
+    executor = ShardExecutor(addresses, authkey.encode('utf-8'), threads, processes)
+    atexit.register(executor.close)
+
+    # Wait until every worker accepts connections
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while not all(os.path.exists(address) for address in addresses):
+        if time.monotonic() > deadline or any(process.poll() is not None for process in processes):
+            executor.close()
+            raise ShardError('Shard workers did not start')
+        time.sleep(0.05)
+    return executor
+
+
+# Executor shared by the requests of this process, created on first use; None when sharding is not configured
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            if SHARD_ADDRESSES:
+                addresses = [parse_address(address.strip()) for address in SHARD_ADDRESSES.split(',')
+                             if address.strip()]
+                _executor = ShardExecutor(addresses, SHARD_AUTHKEY.encode('utf-8'))
+            elif SHARD_WORKERS > 0:
+                _executor = start_local_workers(SHARD_WORKERS)
+        return _executor
+
+
+# Addresses, key and threads of the shard workers of this process (starting the local workers if they are not
+# running yet), for the processes it starts; None when sharding is not configured
+def connection_info():
+    executor = get_executor()
+    if executor is None:
+        return None
+    return executor.addresses, executor.authkey, executor.threads
+
+
+# Use the shard workers of another process (see connection_info) instead of starting local workers
+def connect(info: tuple):
+    global _executor
+    with _executor_lock:
+        _executor = ShardExecutor(*info)
+
+
+# The keys of a reference database (or of every database combined) for a pipeline, split across the shard workers
+class ShardPlan:
+    def __init__(self, executor: ShardExecutor, segments: list):
+        self.executor = executor
+        self.segments = segments
+
+    # Return the top matches like matching.top_matches, or None when a shard could not be scored
+    def top_matches(self, queries: list, n_matches: int, scorer, score_cutoff: float = None):
+        try:
+            return self.executor.top_matches(self.segments, queries, n_matches, scorer, score_cutoff)
+        except ShardError as e:
+            logger.warning('Sharded matching failed, scoring in process: %s', e)
+            return None
+
+
+# Plan sharded matching over a reference database for a pipeline
+# Returns None when sharding is not configured or the keys of the pipeline are not stored in compiled copies
+def shard_plan(reference, pipeline: str = normalization.DEFAULT_PIPELINE):
+    executor = get_executor()
+    if executor is None:
+        return None
+    segments = reference.segments(normalization.pipeline_key(pipeline))
+    if segments is None:
+        return None
+    return ShardPlan(executor, segments)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description='Run a shard worker for sharded record matching.')
+    parser.add_argument('--listen', required=True, help='host:port or socket path to listen on')
+    args = parser.parse_args(argv)
+    if not SHARD_AUTHKEY:
+        parser.error('MATCH_SHARD_AUTHKEY must be set')
+    serve(parse_address(args.listen), SHARD_AUTHKEY.encode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+# Shared fixtures of the test suite
+#
+# The package directory is deployed (and imported) as the 'website' package, so it is registered under that name
+# here whatever the checkout directory is called. The tests that touch files run in a throwaway directory holding
+# the static/ layout the routes and jobs expect
+import importlib.util
+import os
+import sys
+
+import pytest
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if 'website' not in sys.modules:
+    spec = importlib.util.spec_from_file_location('website', os.path.join(PACKAGE_DIR, '__init__.py'),
+                                                  submodule_search_locations=[PACKAGE_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['website'] = module
+    spec.loader.exec_module(module)
+
+# Admin key written to the working directory of the app tests
+ADMIN_KEY = 'test-admin-key'
+
+
+# Run in an empty working directory with the static/ directories of the app, and empty process-wide caches
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    from website.match_cache import match_cache
+    from website.reference_cache import reference_cache
+
+    for directory in ('databases', 'records', 'matches', 'results'):
+        os.makedirs(tmp_path / 'static' / directory)
+    (tmp_path / 'static' / 'admin_key.txt').write_text(ADMIN_KEY)
+    monkeypatch.chdir(tmp_path)
+    reference_cache.clear()
+    match_cache.clear()
+    yield tmp_path
+    reference_cache.clear()
+    match_cache.clear()
+
+
+# The app with its own SQLite database in the working directory, inside an app context
+@pytest.fixture
+def app(workdir, monkeypatch):
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', f'sqlite:///{workdir / "test.db"}')
+    from website import create_app
+    app = create_app()
+    app.config['TESTING'] = True
+    with app.app_context():
+        yield app
+
+
+# A client signed up and logged in as an admin
+@pytest.fixture
+def client(app):
+    client = app.test_client()
+    client.post('/sign-up', data={'email': 'admin@example.com', 'password1': 'pw', 'password2': 'pw',
+                                  'adminKey': ADMIN_KEY})
+    return client
+
+
+# Write a DataFrame as a workbook in the reference databases directory and return its name
+@pytest.fixture
+def make_database(workdir):
+    def make_database(df, name: str = 'reference.xlsx') -> str:
+        df.to_excel(os.path.join('static', 'databases', name), index=False)
+        return name
+    return make_database
+
+
+# Match a DataFrame of records as an upload job, in this process (see jobs._match_upload)
+# Returns the download path and what the job returned: the number of records and results, and the pruning and
+# blocking counts
+@pytest.fixture
+def match_upload(app):
+    from website import db, jobs, metrics
+    from website.models import MatchJob
+
+    def match_upload(records, database_name: str, **options):
+        options = dict({'database_name': database_name, 'match_mode': 'full', 'candidate_limit': 200,
+                        'rerank': False, 'min_score': 90.0, 'normalizer': 'lower', 'scorer': 'ratio',
+                        'output_format': 'xlsx', 'charts': False, 'profile': False, 'fields': [],
+                        'name_weight': 1.0}, **options)
+        job = MatchJob(user_id=1, database_name=database_name)
+        db.session.add(job)
+        db.session.commit()
+        file_path = os.path.join('static', 'records', f'records_{job.id}.xlsx')
+        records.to_excel(file_path, index=False)
+        download_path = os.path.join('static', 'matches', f'match_{job.id}.{options["output_format"]}')
+        result = jobs._match_upload(job.id, file_path, 'user@example.com', options, metrics.StageTimer(),
+                                    download_path)
+        return download_path, result
+    return match_upload
@@ -0,0 +1,149 @@
+import json
+
+import pandas as pd
+import pytest
+
+from website import auth
+
+FIRST = ['acme holdings', 'acme holding', 'acme corp', 'apex holdings', 'zenith marine']
+SECOND = ['contoso bank', 'acme holdings group', 'northwind traders']
+
+
+@pytest.fixture
+def databases(make_database):
+    return make_database(pd.DataFrame({'company': FIRST}), 'first.xlsx'), \
+        make_database(pd.DataFrame({'company': SECOND}), 'second.xlsx')
+
+
+# Post a batch request and return the status code and the NDJSON lines of the response
+def _batch(client, body=None, data=None, **params) -> tuple:
+    response = client.post('/api/match/batch', query_string=params, json=body, data=data)
+    if response.status_code != 200:
+        return response.status_code, response.get_json()
+    assert response.mimetype == 'application/x-ndjson'
+    return 200, [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+@pytest.mark.parametrize('mode', ['indexed', 'full', 'tfidf'])
+def test_match_returns_the_top_matches(client, databases, mode):
+    response = client.get('/api/match', query_string={'q': 'ACME Holdings', 'db': 'first.xlsx', 'k': 2, 'mode': mode})
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body['query'] == 'ACME Holdings' and body['db'] == 'first.xlsx'
+    assert body['matches'][0] == {'name': 'acme holdings', 'score': 100.0, 'database': 'first.xlsx'}
+    assert len(body['matches']) == 2 and body['matches'][1]['score'] <= 100.0
+    assert body['elapsed_ms'] >= 0
+
+
+def test_match_against_all_databases_names_the_source(client, databases):
+    body = client.get('/api/match', query_string={'q': 'acme holdings group', 'k': 3}).get_json()
+    assert body['db'] == 'All'
+    assert body['matches'][0] == {'name': 'acme holdings group', 'score': 100.0, 'database': 'second.xlsx'}
+    assert {match['database'] for match in body['matches']} == {'first.xlsx', 'second.xlsx'}
+
+
+@pytest.mark.parametrize('k, expected', [('0', 1), ('-3', 1), ('1000', len(FIRST))])
+def test_match_clamps_the_number_of_matches(client, databases, k, expected):
+    body = client.get('/api/match', query_string={'q': 'acme', 'db': 'first.xlsx', 'k': k, 'mode': 'full'})
+    assert len(body.get_json()['matches']) == expected
+
+
+@pytest.mark.parametrize('params, status, error', [
+    ({'db': 'first.xlsx'}, 400, 'Missing query parameter q'),
+    ({'q': '   ', 'db': 'first.xlsx'}, 400, 'Missing query parameter q'),
+    ({'q': 'acme', 'db': 'missing.xlsx'}, 404, 'Database name not found'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'k': 'abc'}, 400, 'k must be a number'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'k': '1.5'}, 400, 'k must be a number'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'mode': 'fast'}, 400, 'Unknown mode: fast'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'scorer': 'nope'}, 400, 'Unknown scorer: nope'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'norm': 'nope'}, 400, 'Unknown normalization step(s): nope'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'min_score': 'abc'}, 400, 'min_score must be a number'),
+    ({'q': 'acme', 'db': 'first.xlsx', 'min_score': '101'}, 400, 'min_score must be a number'),
+])
+def test_match_rejects_bad_input(client, databases, params, status, error):
+    response = client.get('/api/match', query_string=params)
+    assert response.status_code == status
+    assert response.get_json()['error'].startswith(error)
+
+
+def test_match_with_minimum_score_returns_every_match_above_it(client, databases):
+    body = client.get('/api/match', query_string={'q': 'acme holdings', 'db': 'first.xlsx', 'min_score': 90,
+                                                  'k': 1}).get_json()
+    assert body['min_score'] == 90.0 and not body['truncated']
+    assert [match['name'] for match in body['matches']] == ['acme holdings', 'acme holding']
+    assert all(match['score'] >= 90 for match in body['matches'])
+    assert body['candidates_scored'] + body['candidates_pruned'] == len(FIRST)
+    assert body['candidates_pruned'] > 0
+
+
+def test_match_with_minimum_score_truncates_the_matches(client, databases, monkeypatch):
+    monkeypatch.setattr(auth, 'MAX_THRESHOLD_MATCHES', 1)
+    body = client.get('/api/match', query_string={'q': 'acme holdings', 'db': 'first.xlsx',
+                                                  'min_score': 90}).get_json()
+    assert body['truncated'] and len(body['matches']) == 1
+
+
+def test_match_requires_a_signed_in_user(app, databases):
+    response = app.test_client().get('/api/match', query_string={'q': 'acme', 'db': 'first.xlsx'})
+    assert response.status_code == 302
+
+
+def test_batch_streams_one_line_per_name(client, databases, monkeypatch):
+    # Small chunks, so the response is written over several chunks
+    monkeypatch.setattr(auth, 'BATCH_STREAM_CHUNK', 2)
+    names = ['ACME Holdings', 'zenith marin', 'ACME Holdings', 'apex', 'qqqq']
+    status, lines = _batch(client, names, db='first.xlsx', k=2)
+    assert status == 200
+    assert [line['query'] for line in lines] == names
+    assert lines[0]['matches'][0] == {'name': 'acme holdings', 'score': 100.0, 'database': 'first.xlsx'}
+    assert lines[2] == lines[0]
+    assert lines[1]['matches'][0]['name'] == 'zenith marine'
+    assert all(len(line['matches']) == 2 for line in lines)
+
+
+def test_batch_results_equal_single_queries(client, databases):
+    names = ['acme holdings grp', 'contoso', 'northwind']
+    _, lines = _batch(client, {'names': names, 'k': 3})
+    for name, line in zip(names, lines):
+        single = client.get('/api/match', query_string={'q': name, 'k': 3, 'mode': 'full'}).get_json()
+        assert line['matches'] == single['matches']
+
+
+def test_batch_reads_names_and_options_from_the_body(client, databases):
+    _, lines = _batch(client, {'names': ['acme corp'], 'db': 'first.xlsx', 'k': 1, 'mode': 'tfidf'})
+    assert lines == [{'query': 'acme corp', 'matches': [{'name': 'acme corp', 'score': 100.0,
+                                                          'database': 'first.xlsx'}]}]
+
+    # Query parameters take precedence over the body
+    _, lines = _batch(client, {'names': ['acme corp'], 'db': 'first.xlsx', 'k': 1}, k=3, db='second.xlsx')
+    assert len(lines[0]['matches']) == 3 and lines[0]['matches'][0]['database'] == 'second.xlsx'
+
+
+def test_batch_reads_one_name_per_line(client, databases):
+    status, lines = _batch(client, data='acme corp\n\n  contoso bank  \n', db='All', k=1)
+    assert status == 200
+    assert [(line['query'], line['matches'][0]['name']) for line in lines] == [('acme corp', 'acme corp'),
+                                                                              ('contoso bank', 'contoso bank')]
+
+
+@pytest.mark.parametrize('body, params, status, error', [
+    ({'names': 'acme'}, {}, 400, 'Body must be a list of record names'),
+    (['acme', 3], {}, 400, 'Body must be a list of record names'),
+    (['acme'], {'db': 'missing.xlsx'}, 404, 'Database name not found'),
+    (['acme'], {'k': 'abc'}, 400, 'k must be a number'),
+    ({'names': ['acme'], 'k': '2'}, {}, 400, 'k must be an integer'),
+    ({'names': ['acme'], 'k': 2.5}, {}, 400, 'k must be an integer'),
+    ({'names': ['acme'], 'k': True}, {}, 400, 'k must be an integer'),
+    (['acme'], {'mode': 'indexed'}, 400, 'Unknown mode: indexed'),
+    (['acme'], {'scorer': 'nope'}, 400, 'Unknown scorer: nope'),
+])
+def test_batch_rejects_bad_input(client, databases, body, params, status, error):
+    code, response = _batch(client, body, **params)
+    assert code == status
+    assert response['error'].startswith(error)
+
+
+def test_batch_rejects_too_many_names(client, databases, monkeypatch):
+    monkeypatch.setattr(auth, 'MAX_BATCH_NAMES', 2)
+    code, response = _batch(client, ['a', 'b', 'c'])
+    assert code == 413 and response['error'] == 'At most 2 record names per request'
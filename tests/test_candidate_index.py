@@ -0,0 +1,69 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+from rapidfuzz import fuzz
+
+from website import candidate_index
+from website.candidate_index import NGramIndex
+
+CHOICES = ['acme holdings', 'acme holding', 'acme corp', 'apex holdings', 'zenith marine']
+
+
+@pytest.mark.parametrize('limit', [0, -5])
+def test_candidates_clamps_limit_to_one(limit):
+    rows = NGramIndex(CHOICES).candidates('acme holdings', limit)
+    assert len(rows) == 1
+
+
+def test_candidates_within_limit_are_sorted_rows():
+    rows = NGramIndex(CHOICES).candidates('acme holdings', 3)
+    assert len(rows) == 3
+    assert np.all(np.diff(rows) > 0)
+    assert 0 in rows
+
+
+def test_candidates_without_shared_ngrams():
+    assert len(NGramIndex(CHOICES).candidates('qqqq', 10)) == 0
+
+
+def test_extract_with_index_finds_exact_match():
+    index = NGramIndex(CHOICES)
+    matches = candidate_index.extract('acme holdings', CHOICES, index=index, scorer=fuzz.ratio, limit=2,
+                                       candidate_limit=3)
+    assert matches[0] == ('acme holdings', 100.0, 0)
+
+
+@pytest.mark.parametrize('value', ['0', '-1', 'abc', '1.5', str(candidate_index.MAX_CANDIDATE_LIMIT + 1)])
+def test_upload_rejects_bad_candidate_limit(client, make_database, value):
+    database_name = make_database(pd.DataFrame({'company': CHOICES}))
+    upload = io.BytesIO(b'name\nacme\n')
+    response = client.post('/uploadRecords', data={'record_file': (upload, 'records.csv'),
+                                                   'database_name': database_name, 'match_mode': 'indexed',
+                                                   'candidate_limit': value},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'Candidate limit must be a whole number' in response.data
+
+
+@pytest.mark.parametrize('mode, uploaded', [
+    ('append', ['acme holdings ltd', 'zenith']),
+    ('delete', ['acme holding', 'zenith marine']),
+    ('replace', ['apex holdings', 'acme corp', 'contoso bank', 'acme holdings inc']),
+    ('replace', CHOICES),
+])
+def test_updated_index_equals_fresh_index(mode, uploaded):
+    from website.database_store import diff_rows
+
+    row_map, added = diff_rows(CHOICES, uploaded, mode)
+    kept = [choice for choice, row in zip(CHOICES, row_map) if row >= 0]
+    choices = kept + added
+    index = NGramIndex(CHOICES).updated(row_map, added, np.arange(len(kept), len(choices)), len(choices))
+
+    fresh = NGramIndex(choices)
+    assert index.size == fresh.size
+    assert np.array_equal(index.gram_counts, fresh.gram_counts)
+    assert index.postings.keys() == fresh.postings.keys()
+    for gram, rows in fresh.postings.items():
+        assert np.array_equal(index.postings[gram], rows), gram
+    assert index.nbytes == fresh.nbytes
@@ -0,0 +1,87 @@
+import io
+import os
+import threading
+
+import pandas as pd
+import pytest
+
+from website import database_store
+
+COMPANIES = pd.DataFrame({'company': ['Acme Holdings', 'Zenith Marine', 'Contoso Bank'],
+                          'city': ['London', 'Leeds', 'York']})
+
+
+def _workbook(df) -> io.BytesIO:
+    data = io.BytesIO()
+    df.to_excel(data, index=False)
+    data.seek(0)
+    return data
+
+
+def _database_path(name: str) -> str:
+    return os.path.join('static', 'databases', name)
+
+
+def test_replace_carries_over_uploaded_columns(make_database):
+    database_name = make_database(COMPANIES)
+    uploaded = pd.DataFrame({'company': ['Acme Holdings', 'Zenith Marine', 'Epsilon SA'],
+                             'city': ['London', 'Hull', 'Paris']})
+    artifact, row_map, n_added = database_store.update_database(
+        _database_path(database_name), uploaded['company'].tolist(), 'replace', {'city': uploaded['city'].tolist()})
+
+    # Zenith Marine moved city, so its old row is replaced by the uploaded one
+    assert row_map.tolist() == [0, -1, -1] and n_added == 2
+    assert artifact['names'].tolist() == ['Acme Holdings', 'Zenith Marine', 'Epsilon SA']
+    assert artifact[database_store.field_column('city')].tolist() == ['London', 'Hull', 'Paris']
+    _, names, fields = database_store.read_table(_database_path(database_name))
+    assert names == ['Acme Holdings', 'Zenith Marine', 'Epsilon SA'] and fields == {'city': ['London', 'Hull', 'Paris']}
+
+
+def test_names_only_upsert_leaves_other_columns_empty(make_database):
+    database_name = make_database(COMPANIES)
+    artifact, _, n_added = database_store.update_database(_database_path(database_name),
+                                                          ['Acme Holdings', 'Epsilon SA'], 'upsert')
+    assert n_added == 1
+    assert artifact[database_store.field_column('city')].tolist() == ['London', 'Leeds', 'York', '']
+
+
+def test_update_rejects_unknown_columns(make_database):
+    database_name = make_database(COMPANIES)
+    with pytest.raises(ValueError, match='postcode'):
+        database_store.update_database(_database_path(database_name), ['Epsilon SA'], 'append',
+                                       {'postcode': ['75001']})
+
+
+def test_admin_update_with_several_columns(client, make_database):
+    database_name = make_database(COMPANIES)
+    uploaded = pd.DataFrame({'company': ['Acme Holdings', 'Epsilon SA'], 'city': ['London', 'Paris']})
+    response = client.post('/admin', data={'database_file': (_workbook(uploaded), 'update.xlsx'),
+                                           'database_name': database_name, 'update_database': 'on',
+                                           'update_mode': 'replace'},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'1 rows added, 2 rows removed' in response.data
+    _, names, fields = database_store.read_table(_database_path(database_name))
+    assert names == ['Acme Holdings', 'Epsilon SA'] and fields == {'city': ['London', 'Paris']}
+
+
+def test_concurrent_artifact_writers_never_share_a_file(workdir):
+    path = os.path.join('static', 'databases', 'reference.xlsx' + database_store.ARTIFACT_SUFFIX)
+    columns = [{'names': [f'name {writer} {row}' for row in range(20000)]} for writer in range(4)]
+    threads = [threading.Thread(target=database_store.write_artifact, args=(path, column)) for column in columns]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert database_store.read_artifact(path)['names'].tolist() in [column['names'] for column in columns]
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+
+
+def test_failed_write_leaves_no_temporary_file(workdir, monkeypatch):
+    def fail(source, destination):
+        raise OSError('disk full')
+
+    monkeypatch.setattr(database_store.os, 'replace', fail)
+    with pytest.raises(OSError):
+        database_store.write_workbook(_database_path('reference.xlsx'), 'company', ['Acme Holdings'])
+    assert os.listdir(os.path.join('static', 'databases')) == []
@@ -0,0 +1,70 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+from rapidfuzz import fuzz
+from rapidfuzz import process
+
+from website import duplicates, jobs
+from website.models import MatchJob
+
+NAMES = ['acme holdings', 'zenith marine', 'acme holding', 'contoso bank', 'zenith marines', 'acme holdngs',
+         'northwind traders']
+
+
+def test_find_pairs_matches_a_full_comparison():
+    left, right, scores, stats = duplicates.find_pairs(NAMES, 85, scorer=fuzz.ratio)
+    expected = process.cdist(NAMES, NAMES, scorer=fuzz.ratio)
+    first, second = np.nonzero(np.triu(expected >= 85, k=1))
+    assert list(zip(left.tolist(), right.tolist())) == list(zip(first.tolist(), second.tolist()))
+    assert np.allclose(scores, expected[first, second])
+    assert stats['skipped_blocks'] == 0
+
+
+def test_find_pairs_without_pairs_and_with_skipped_blocks():
+    left, right, scores, _ = duplicates.find_pairs(['alpha', 'omega'], 90, scorer=fuzz.ratio)
+    assert len(left) == len(right) == len(scores) == 0
+
+    left, _, _, stats = duplicates.find_pairs(NAMES, 85, scorer=fuzz.ratio, max_block_rows=1)
+    assert len(left) == 0 and stats['skipped_blocks'] == stats['blocks'] > 0
+
+
+def test_pairs_are_linked_into_clusters():
+    labels = duplicates.cluster_labels(7, np.array([3, 0, 1]), np.array([5, 3, 2]))
+    assert labels.tolist() == [0, 1, 1, 0, 4, 0, 6]
+
+    clusters_df = duplicates.cluster_table(NAMES, labels)
+    assert clusters_df['cluster'].tolist() == [1, 1, 1, 2, 2]
+    assert clusters_df['size'].tolist() == [3, 3, 3, 2, 2]
+    assert clusters_df['row'].tolist() == [1, 4, 6, 2, 3]
+
+
+def test_tables_without_pairs():
+    empty = np.empty(0, dtype=np.int64)
+    labels = duplicates.cluster_labels(3, empty, empty)
+    assert labels.tolist() == [0, 1, 2]
+    assert len(duplicates.cluster_table(NAMES[:3], labels)) == 0
+    assert len(duplicates.pair_table(NAMES[:3], empty, empty, np.empty(0))) == 0
+
+
+@pytest.mark.parametrize('form', [
+    {'duplicates_database': 'reference.xlsx', 'min_score': '90'},
+    {'delete_database': 'reference.xlsx'},
+])
+def test_admin_actions_need_an_admin(app, make_database, monkeypatch, form):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'acme holding']}))
+    submitted = []
+    monkeypatch.setattr(jobs, 'submit_duplicates_job', lambda *args: submitted.append(args))
+
+    # A user signed up without the admin key
+    client = app.test_client()
+    client.post('/sign-up', data={'email': 'user@example.com', 'password1': 'pw', 'password2': 'pw',
+                                  'adminKey': ''})
+    response = client.post('/admin', data=form, headers={'Accept': 'application/json'})
+    assert response.status_code == 403
+    response = client.post('/admin', data=form, follow_redirects=True)
+    assert b'Only admins can manage the databases' in response.data
+
+    assert submitted == [] and MatchJob.query.count() == 0
+    assert os.path.exists(os.path.join('static', 'databases', database_name))
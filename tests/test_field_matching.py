@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+from rapidfuzz import fuzz
+
+from website import field_matching
+
+
+def test_parse_fields():
+    fields = field_matching.parse_fields('Postcode:block, City=town:token_set_ratio:0.5\nRegion', 'ratio')
+    assert fields == [
+        {'column': 'Postcode', 'field': 'Postcode', 'method': 'block', 'weight': None},
+        {'column': 'City', 'field': 'town', 'method': 'token_set_ratio', 'weight': 0.5},
+        {'column': 'Region', 'field': 'Region', 'method': 'ratio', 'weight': 1.0},
+    ]
+    assert field_matching.parse_fields('', 'ratio') == []
+
+
+@pytest.mark.parametrize('text', ['City:ratio:0', 'City:ratio:x', 'Postcode:block:2', 'City:unknown',
+                                  'City:ratio:1:2', '=:ratio'])
+def test_parse_fields_rejects_malformed_entries(text):
+    with pytest.raises(ValueError):
+        field_matching.parse_fields(text, 'ratio')
+
+
+def test_blocking_restricts_the_candidates():
+    keys = ['acme', 'acme', 'acme ltd', 'zenith']
+    block_index = field_matching.BlockIndex([['SW1A 1AA', 'LS1 4AP', 'sw1a-1aa', 'LS1 4AP']])
+    rows, scores, counts = field_matching.top_matches(
+        ['acme', 'acme', 'acme'], keys, blocking=[['sw1a 1aa', 'ls1 4ap', '']], block_index=block_index,
+        n_matches=3, scorer=fuzz.ratio)
+
+    # Each record keeps only the rows of its block; the record without a postcode is scored against every row
+    assert rows.tolist() == [[0, 2, -1], [1, 3, -1], [0, 1, 2]]
+    assert np.isnan(scores[0, 2]) and scores[0, 0] == 100
+    assert counts == {'pairs': 12, 'scored': 8, 'unblocked': 1}
+
+
+def test_empty_fields_are_left_out_of_the_mean():
+    rows, scores, _ = field_matching.top_matches(
+        ['acme', 'acme'], ['acme', 'acme'], scored=[(['leeds', ''], ['york', 'leeds'], fuzz.ratio, 1.0)],
+        n_matches=2, scorer=fuzz.ratio)
+
+    # The first record prefers the row with its city; the second has no city, so only the names count
+    assert rows[0].tolist() == [1, 0] and scores[0, 0] == 100
+    assert scores[1].tolist() == [100, 100]
+
+
+@pytest.mark.parametrize('name_weight', [0.5, 2.0])
+def test_name_weight_with_blocking_fields_only(name_weight):
+    block_index = field_matching.BlockIndex([['leeds', 'leeds']])
+    rows, scores, _ = field_matching.top_matches(['acme'], ['acme', 'acme ltd'], blocking=[['Leeds']],
+                                                 block_index=block_index, n_matches=2, scorer=fuzz.ratio,
+                                                 name_weight=name_weight)
+    assert rows.tolist() == [[0, 1]]
+    assert scores[0].tolist() == [100, fuzz.ratio('acme', 'acme ltd')]
@@ -0,0 +1,85 @@
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+from website import ingest
+
+
+# Write the rows (header first) as a record file of the extension and return its path
+def _records(tmp_path, extension: str, rows: list) -> str:
+    path = str(tmp_path / f'records{extension}')
+    if extension == '.xlsx':
+        wb = Workbook()
+        for row in rows:
+            wb.active.append(list(row))
+        wb.save(path)
+    elif extension == '.csv':
+        # Excel writes CSV files with a byte order mark, which is not part of the first header
+        lines = (','.join('' if value is None else str(value) for value in row) for row in rows)
+        with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+            f.write(''.join(line + '\r\n' for line in lines))
+    else:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(''.join(f'{row[0]}\n' for row in rows))
+    return path
+
+
+ROWS = [('name', 'city', None), ('ACME Holdings', 'Boston', None), (None, 'Paris', None), ('Zenith Marine', None, None)]
+
+
+@pytest.mark.parametrize('extension', ['.xlsx', '.csv'])
+def test_tabular_readers(tmp_path, extension):
+    path = _records(tmp_path, extension, ROWS)
+    assert ingest.read_header(path) == ['name', 'city']
+    assert ingest.count_records(path) == 3
+    assert list(ingest.iter_batches(path)) == [['acme holdings', 'zenith marine']]
+    assert list(ingest.iter_field_batches(path, [1])) == [(['acme holdings', 'zenith marine'], [['Boston', '']])]
+
+
+def test_csv_cells_are_strings(tmp_path):
+    path = _records(tmp_path, '.csv', [('name', 'zip'), ('acme', '02110')])
+    assert list(ingest.iter_rows(path)) == [('name', 'zip'), ('acme', '02110')]
+
+
+def test_xlsx_cells_keep_their_type(tmp_path):
+    path = _records(tmp_path, '.xlsx', [('name', 'employees'), (42, 12), ('acme', 7)])
+    assert list(ingest.iter_rows(path)) == [('name', 'employees'), (42, 12), ('acme', 7)]
+
+    # Only text names are matched; the values of the other columns are turned into text
+    assert list(ingest.iter_field_batches(path, [1])) == [(['acme'], [['7']])]
+
+
+def test_txt_reader_makes_up_a_header(tmp_path):
+    path = _records(tmp_path, '.txt', [('ACME Holdings',), ('',), ('Zenith Marine',)])
+    assert ingest.read_header(path) == ['name']
+    assert ingest.count_records(path) == 3
+    assert list(ingest.iter_rows(path)) == [('name',), ('ACME Holdings',), ('',), ('Zenith Marine',)]
+    assert list(ingest.iter_batches(path)) == [['acme holdings', 'zenith marine']]
+
+
+def test_header_of_an_empty_file(tmp_path):
+    path = tmp_path / 'records.csv'
+    path.write_text('')
+    assert ingest.read_header(str(path)) == []
+    assert ingest.count_records(str(path)) == 0
+    assert list(ingest.iter_batches(str(path))) == []
+
+
+def test_extension_is_case_insensitive(tmp_path):
+    path = str(tmp_path / 'RECORDS.CSV')
+    pd.DataFrame({'name': ['Acme']}).to_csv(path, index=False)
+    assert list(ingest.iter_batches(path)) == [['acme']]
+
+
+@pytest.mark.parametrize('batch_size, sizes', [(2, [2, 2, 1]), (5, [5]), (10, [5])])
+def test_batches_hold_at_most_batch_size_names(tmp_path, batch_size, sizes):
+    path = _records(tmp_path, '.csv', [('name', 'city')] + [(f'name {i}', f'city {i}') for i in range(5)])
+    assert [len(batch) for batch in ingest.iter_batches(path, batch_size)] == sizes
+    field_batches = list(ingest.iter_field_batches(path, [1], batch_size))
+    assert [len(names) for names, _ in field_batches] == sizes
+    assert [values[0][0] for _, values in field_batches] == [f'city {i}' for i in range(0, 5, batch_size)]
+
+
+def test_field_columns_missing_from_short_rows_are_empty(tmp_path):
+    path = _records(tmp_path, '.csv', [('name', 'city', 'country'), ('acme',), ('zenith', 'Oslo', 'Norway')])
+    assert list(ingest.iter_field_batches(path, [2, 1])) == [(['acme', 'zenith'], [['', 'Norway'], ['', 'Oslo']])]
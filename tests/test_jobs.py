@@ -0,0 +1,40 @@
+import pandas as pd
+
+from website import create_app, db, jobs, warmup
+from website.models import MatchJob
+
+
+def test_job_workers_skip_the_preload(workdir, monkeypatch):
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', f'sqlite:///{workdir / "test.db"}')
+    monkeypatch.setattr(warmup, 'PRELOAD', True)
+    monkeypatch.setattr(jobs, '_worker_app', None)
+    warm_ups = []
+    monkeypatch.setattr(warmup, 'warm_up', lambda: warm_ups.append(True))
+
+    jobs._init_worker()
+    assert jobs._worker_app is not None and warm_ups == []
+    create_app()
+    assert warm_ups == [True]
+
+
+def test_job_pool_spawns_its_workers(monkeypatch):
+    monkeypatch.setattr(jobs, '_executor', None)
+    executor = jobs.get_executor()
+    try:
+        assert jobs.get_executor() is executor
+        assert executor._mp_context.get_start_method() == 'spawn'
+    finally:
+        executor.shutdown()
+
+
+def test_download_of_a_finished_job(client, make_database, match_upload):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}))
+    download_path, _ = match_upload(pd.DataFrame({'name': ['acme holdings']}), database_name)
+    job = MatchJob.query.order_by(MatchJob.id.desc()).first()
+    job.status, job.result_path = 'done', download_path
+    db.session.commit()
+
+    # The result sits in the working directory, not in the package directory
+    response = client.get('/download_file', query_string={'job_id': job.id})
+    assert response.status_code == 200
+    assert response.data == open(download_path, 'rb').read()
@@ -0,0 +1,62 @@
+import pandas as pd
+import pytest
+
+from website import db, match_results
+from website.models import MatchJob, User
+
+# Six records with one match each; the ties at 90 and 80 are ordered by id
+SCORES = [90.0, 80.0, 90.0, 70.0, 80.0, 100.0]
+
+
+@pytest.fixture
+def job_id(client):
+    user = User.query.filter_by(email='admin@example.com').first()
+    job = MatchJob(user_id=user.id, database_name='reference.xlsx', status='done')
+    db.session.add(job)
+    db.session.commit()
+    result_df = pd.DataFrame({'name': [f'record {row}' for row in range(len(SCORES))],
+                              'match': [f'match {row}' for row in range(len(SCORES))], 'match_score': SCORES})
+    assert match_results.store_results(job.id, result_df, None, 'reference.xlsx') == len(SCORES)
+    return job.id
+
+
+def _all_pages(job_id: int, sort: str, limit: int, **filters) -> list:
+    pages, cursor = [], None
+    while True:
+        results, cursor = match_results.page(job_id, sort, cursor, limit, **filters)
+        pages.append([result['row'] for result in results])
+        if cursor is None:
+            return pages
+
+
+@pytest.mark.parametrize('sort, rows', [('row', [1, 2, 3, 4, 5, 6]), ('score', [6, 3, 1, 5, 2, 4]),
+                                        ('score_asc', [4, 2, 5, 1, 3, 6])])
+@pytest.mark.parametrize('limit', [1, 2, 4, 6, 7])
+def test_pages_cover_every_result_once(job_id, sort, rows, limit):
+    pages = _all_pages(job_id, sort, limit)
+    assert [row for page in pages for row in page] == rows
+
+    # A last page that is exactly full has no cursor, rather than an empty page after it
+    assert len(pages) == -(-len(rows) // limit)
+    assert all(len(page) == limit for page in pages[:-1])
+
+
+def test_pages_with_filters(job_id):
+    assert _all_pages(job_id, 'score', 1, min_score=80, below=100) == [[3], [1], [5], [2]]
+    assert _all_pages(job_id, 'row', 10, query='RECORD 4') == [[5]]
+    assert _all_pages(job_id, 'row', 10, min_score=101) == [[]]
+
+
+def test_malformed_cursor_and_sort(job_id):
+    with pytest.raises(ValueError, match='Malformed cursor'):
+        match_results.page(job_id, 'score', 'abc')
+    with pytest.raises(ValueError, match='Unknown sort'):
+        match_results.page(job_id, 'name')
+
+
+def test_api_limit_is_clamped(client, job_id):
+    response = client.get(f'/api/jobs/{job_id}/results', query_string={'limit': '0'})
+    assert len(response.get_json()['results']) == 1
+    response = client.get(f'/api/jobs/{job_id}/results', query_string={'limit': '100000'})
+    assert len(response.get_json()['results']) == len(SCORES) and response.get_json()['next_cursor'] is None
+    assert client.get(f'/api/jobs/{job_id}/results', query_string={'cursor': 'x'}).status_code == 400
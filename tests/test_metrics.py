@@ -0,0 +1,21 @@
+import sys
+
+from conftest import ADMIN_KEY
+from website import metrics
+
+
+def test_cache_samples_are_skipped_until_the_caches_are_loaded(monkeypatch):
+    for module in ('reference_cache', 'match_cache'):
+        monkeypatch.delitem(sys.modules, f'website.{module}', raising=False)
+    assert metrics._reference_cache_samples() == [] and metrics._match_cache_samples() == []
+    assert 'website.reference_cache' not in sys.modules and 'website.match_cache' not in sys.modules
+
+
+def test_metrics_need_an_allowed_address_or_an_admin(app):
+    other = {'REMOTE_ADDR': '203.0.113.5'}
+    client = app.test_client()
+    assert client.get('/metrics', environ_base=other).status_code == 403
+    assert client.get('/metrics').status_code == 200
+    client.post('/sign-up', data={'email': 'admin@example.com', 'password1': 'pw', 'password2': 'pw',
+                                  'adminKey': ADMIN_KEY})
+    assert client.get('/metrics', environ_base=other).status_code == 200
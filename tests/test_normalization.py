@@ -0,0 +1,46 @@
+import pytest
+
+from website import normalization
+
+NAME = '  Société Générale, S.A.  '
+
+
+@pytest.mark.parametrize('pipeline, expected', [
+    ('lower', '  société générale, s.a.  '),
+    ('standard', 'societe generale'),
+    ('token_sorted', 'generale societe'),
+    ('fold_accents,strip_punctuation', 'Societe Generale SA'),
+    ('strip_punctuation,remove_legal_suffixes', 'Société Générale'),
+])
+def test_pipeline_output(pipeline, expected):
+    assert normalization.normalize(NAME, pipeline) == expected
+    assert normalization.normalize_all([NAME, NAME], pipeline) == [expected, expected]
+
+
+@pytest.mark.parametrize('step, text, expected', [
+    ('lower', 'ACME Corp', 'acme corp'),
+    ('fold_accents', 'Ångström Çafé', 'Angstrom Cafe'),
+    ('strip_punctuation', 'acme--holdings_(u.k.)  ltd!', 'acme holdings uk ltd'),
+    ('remove_legal_suffixes', 'acme holdings co. ltd', 'acme holdings'),
+    ('remove_legal_suffixes', 'ltd inc', 'ltd'),
+    ('remove_legal_suffixes', 'limited brands llc', 'limited brands'),
+    ('sort_tokens', 'zenith marine acme', 'acme marine zenith'),
+])
+def test_step_output(step, text, expected):
+    assert normalization.STEPS[step](text) == expected
+
+
+def test_default_pipeline_is_lower():
+    assert normalization.pipeline_key(None) == normalization.pipeline_key('') == 'lower'
+    assert normalization.normalize('ACME Corp') == 'acme corp'
+
+
+def test_step_list_of_a_named_pipeline_shares_its_key():
+    assert normalization.pipeline_key('lower, fold_accents,strip_punctuation,remove_legal_suffixes') == 'standard'
+    assert normalization.pipeline_key('lower,sort_tokens') == 'lower,sort_tokens'
+
+
+@pytest.mark.parametrize('spec', ['unknown', 'lower,unknown', ' , '])
+def test_unknown_steps_are_rejected(spec):
+    with pytest.raises(ValueError):
+        normalization.pipeline_key(spec)
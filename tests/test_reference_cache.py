@@ -0,0 +1,82 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from website import database_store, matching, scorers
+from website.candidate_index import NGramIndex
+from website.match_cache import match_cache
+from website.reference_cache import ReferenceCache, reference_cache
+
+
+def _cache(make_database, budget_for) -> ReferenceCache:
+    make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}), 'first.xlsx')
+    make_database(pd.DataFrame({'company': ['contoso bank', 'northwind traders']}), 'second.xlsx')
+    cache = ReferenceCache(os.path.join('static', 'databases'))
+    cache.get_all()
+    cache.memory_budget = budget_for(cache)
+    return cache
+
+
+def test_combination_is_evicted_before_its_databases(make_database):
+    # The budget holds both databases but not their combination as well
+    cache = _cache(make_database, lambda cache: cache.nbytes + 1)
+    merged = cache.get_merged()
+    assert len(merged) == 4
+    stats = cache.stats()
+    assert stats['entries'] == 2 and not stats['merged'] and stats['evictions'] == 1
+
+    # The databases stay resident, so the next lookups are answered from memory
+    hits = cache.hits
+    cache.get_all()
+    assert cache.hits == hits + 2
+
+
+def test_combination_within_budget_stays_resident(make_database):
+    cache = _cache(make_database, lambda cache: 10 * cache.nbytes)
+    assert cache.get_merged() is cache.get_merged()
+    assert cache.stats()['evictions'] == 0
+
+
+@pytest.mark.parametrize('mode, uploaded', [
+    ('append', ['acme holdings ltd', 'zenith marine co']),
+    ('delete', ['acme holding']),
+    ('replace', ['zenith marine', 'acme corp', 'acme holdings group', 'contoso bank']),
+])
+def test_update_carries_index_and_cached_results_over(make_database, mode, uploaded):
+    names = ['acme holdings', 'acme holding', 'acme corp', 'apex holdings', 'zenith marine']
+    queries = ['acme holdings', 'acme holding ltd', 'zenith', 'apex', 'contoso']
+    database_name = make_database(pd.DataFrame({'company': names}))
+    scorer = scorers.get_scorer('ratio')
+
+    # Cache the results of the current version and build its candidate index
+    reference = reference_cache.get(database_name)
+    reference.candidate_index('lower')
+    old_rows, _ = matching.top_matches(queries, reference.normalized('lower'), scorer=scorer,
+                                       cache=match_cache.view(reference.version, 'lower', scorer, 3))
+
+    artifact, row_map, n_added = database_store.update_database(
+        os.path.join('static', 'databases', database_name), uploaded, mode)
+    reference_cache.apply_update(database_name, artifact, row_map, n_added)
+    updated = reference_cache.get(database_name)
+    assert updated is not reference
+
+    # The carried-over index is the one a fresh load builds
+    index, fresh = updated.candidate_index('lower'), NGramIndex(updated.normalized('lower'))
+    assert np.array_equal(index.gram_counts, fresh.gram_counts)
+    assert index.postings.keys() == fresh.postings.keys()
+    assert all(np.array_equal(index.postings[gram], rows) for gram, rows in fresh.postings.items())
+
+    # Cached results are renumbered, lose the removed rows and take the added names in; they equal a recompute
+    keys = updated.normalized('lower')
+    hits = match_cache.hits
+    cached_rows, cached_scores = matching.top_matches(queries, keys, scorer=scorer,
+                                                      cache=match_cache.view(updated.version, 'lower', scorer, 3))
+    rows, scores = matching.top_matches(queries, keys, scorer=scorer)
+    assert np.array_equal(cached_rows, rows)
+    np.testing.assert_allclose(cached_scores, scores, equal_nan=True)
+
+    # Results that matched a removed row are rescored, the others are answered from the cache
+    removed = set(np.flatnonzero(row_map < 0).tolist())
+    assert match_cache.hits - hits == sum(not removed & set(row_matches.tolist()) for row_matches in old_rows)
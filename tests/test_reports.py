@@ -0,0 +1,52 @@
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+from website import reports
+
+
+def _widths(df):
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet()
+    reports._fit_columns(sheet, df)
+    return {letter: dimension.width for letter, dimension in sheet.column_dimensions.items()}
+
+
+def test_fit_columns_with_empty_match_columns():
+    df = pd.DataFrame({'name': ['acme holdings', 'zenith'], 'match1': [None, None],
+                       'match_score1': [np.nan, np.nan], 'match1 city': ['Springfield', None]})
+    widths = _widths(df)
+    assert widths['A'] == len('acme holdings')
+    assert widths['B'] == len('match1')
+    assert widths['C'] == len('match_score1')
+    assert widths['D'] == len('match1 city')
+
+
+def test_fit_columns_without_rows():
+    assert _widths(pd.DataFrame({'name': []}))['A'] == len('name')
+
+
+def test_multi_field_job_with_empty_blocks(make_database, match_upload):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine', 'apex', 'vertex'],
+                                                'city': ['Springfield', 'Shelbyville', 'Springfield', 'Capital']}))
+    records = pd.DataFrame({'name': ['acme holdings', 'zenith marine'], 'city': ['Ogdenville', 'Shelbyville']})
+    fields = [{'column': 'city', 'field': 'city', 'method': 'block', 'weight': None, 'position': 1}]
+    download_path, (rows, n_results, _, blocking) = match_upload(records, database_name, fields=fields)
+    assert rows == 2 and n_results == 1
+    results = pd.read_excel(download_path, sheet_name='Results')
+    assert results['match1'].tolist()[-1] == 'zenith marine'
+
+
+def test_results_beyond_the_sheet_limit_continue_in_more_sheets(workdir, monkeypatch):
+    monkeypatch.setattr(reports, 'MAX_SHEET_ROWS', 2)
+    result_df = pd.DataFrame({'name': ['a', 'b', 'c', 'd', 'e'], 'match': ['a', 'b', 'c', 'd', 'e'],
+                              'match_score': [100.0, 95.0, 90.0, 85.0, 80.0]})
+    reports.write_report(result_df, None, 'results.xlsx')
+
+    sheets = pd.read_excel('results.xlsx', sheet_name=None, header=None)
+    assert list(sheets) == ['Results', 'Results 2', 'Results 3', 'Summary']
+    assert pd.concat([sheets[title].iloc[1:] for title in ('Results', 'Results 2', 'Results 3')])[0].tolist() == \
+        ['a', 'b', 'c', 'd', 'e']
+    summary = sheets['Summary'].set_index(0)[1]
+    assert summary['Result rows'] == 5
+    assert summary['Result sheets (at most 2 rows each)'] == 'Results, Results 2, Results 3'
@@ -0,0 +1,85 @@
+import os
+
+import pandas as pd
+import pytest
+
+from website import db, jobs, result_store
+from website.models import MatchJob, MatchResult
+
+OPTIONS = {'match_mode': 'full', 'candidate_limit': 200, 'rerank': False, 'min_score': 90.0, 'normalizer': 'lower',
+           'scorer': 'ratio', 'output_format': 'xlsx', 'charts': False, 'profile': False, 'fields': [],
+           'name_weight': 1.0}
+
+
+# Run upload jobs in this process, counting the ones that had to match the records
+@pytest.fixture
+def run_job(app, monkeypatch):
+    monkeypatch.setattr(jobs, '_worker_app', app)
+    matched = []
+    match_upload = jobs._match_upload
+
+    def counting_match_upload(job_id, *args):
+        matched.append(job_id)
+        return match_upload(job_id, *args)
+    monkeypatch.setattr(jobs, '_match_upload', counting_match_upload)
+
+    def run_job(records, database_name: str, **options) -> tuple:
+        job = MatchJob(user_id=1, database_name=database_name)
+        db.session.add(job)
+        db.session.commit()
+        job_id = job.id
+        file_path = os.path.join('static', 'records', f'records_{job_id}.csv')
+        records.to_csv(file_path, index=False)
+        result = jobs.run_match_job(job_id, file_path, 'user@example.com',
+                                    dict(OPTIONS, database_name=database_name, **options))
+        assert result['status'] == 'done'
+        return result, job_id in matched
+    return run_job
+
+
+RECORDS = pd.DataFrame({'name': ['acme holdings', 'zenith marin']})
+
+
+def _first_matches(job_id: int) -> list:
+    results = MatchResult.query.filter_by(job_id=job_id, rank=1).order_by(MatchResult.id).all()
+    return [result.match for result in results]
+
+
+def test_same_upload_and_database_reuse_the_result(make_database, run_job):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}))
+    first, first_matched = run_job(RECORDS, database_name)
+    second, second_matched = run_job(RECORDS, database_name)
+    assert first_matched and not first['reused']
+    assert second['reused'] and not second_matched
+    assert second['rows'] == first['rows'] == 2
+
+    # The reusing job gets the workbook and the browsable results of the first one
+    first_job, second_job = MatchJob.query.get(first['job_id']), MatchJob.query.get(second['job_id'])
+    assert second_job.status == 'done' and second_job.result_path != first_job.result_path
+    pd.testing.assert_frame_equal(pd.read_excel(second_job.result_path), pd.read_excel(first_job.result_path))
+    assert _first_matches(second['job_id']) == _first_matches(first['job_id']) == ['acme holdings', 'zenith marine']
+
+
+def test_changed_options_are_matched_again(make_database, run_job):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}))
+    run_job(RECORDS, database_name)
+    result, matched = run_job(RECORDS, database_name, scorer='WRatio')
+    assert matched and not result['reused']
+
+
+def test_changed_database_is_matched_again(make_database, run_job):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}))
+    first, _ = run_job(RECORDS, database_name)
+
+    # A new version of the database, with a later modification time
+    database_path = os.path.join('static', 'databases', database_name)
+    make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marin']}), database_name)
+    mtime = os.path.getmtime(database_path) + 10
+    os.utime(database_path, (mtime, mtime))
+
+    second, matched = run_job(RECORDS, database_name)
+    assert matched and not second['reused']
+    assert _first_matches(second['job_id']) == ['acme holdings', 'zenith marin']
+
+    # Both versions keep their own stored result
+    assert len([name for name in os.listdir(result_store.RESULT_DIR) if name.endswith('.json')]) == 2
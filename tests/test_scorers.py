@@ -0,0 +1,50 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from website import scorers, threshold_matching
+
+
+# Short strings over a small alphabet, with prefixes and repeats of each other so that high scores between strings
+# of different lengths (the cases the length bound prunes) are common
+def _strings() -> list:
+    generator = random.Random(7)
+    strings = {''.join(generator.choice('abc') for _ in range(generator.randint(1, 10))) for _ in range(150)}
+    for base in list(strings)[:40]:
+        strings.update({base * 2, base + 'a', base[:-1] or base, 'a' + base})
+    strings.update('a' * length for length in range(1, 13))
+    return sorted(strings)
+
+
+@pytest.mark.parametrize('scorer_name', ['ratio', 'jaro_winkler'])
+@pytest.mark.parametrize('min_score', [50, 70, 85, 90, 95, 100])
+def test_length_bound_never_prunes_a_match(scorer_name, min_score):
+    scorer = scorers.get_scorer(scorer_name)
+    ratio = scorers.min_length_ratio(scorer, min_score)
+    for left, right in itertools.combinations(_strings(), 2):
+        score = scorer(left, right) * scorers.score_scale(scorer)
+        if score >= min_score:
+            low, high = threshold_matching.length_window(len(left), ratio)
+            assert low <= len(right) <= high, (left, right, score)
+
+
+@pytest.mark.parametrize('scorer_name', ['ratio', 'jaro_winkler'])
+@pytest.mark.parametrize('min_score', [85, 90])
+def test_threshold_matches_equal_an_unpruned_scan(scorer_name, min_score):
+    scorer = scorers.get_scorer(scorer_name)
+    strings = _strings()
+    names, choices = strings[::3], strings
+    positions, rows, scores, stats = threshold_matching.threshold_matches(names, choices, min_score, scorer=scorer)
+    assert stats['pruned'] > 0
+
+    expected = {(position, row) for position, name in enumerate(names) for row, choice in enumerate(choices)
+                if scorer(name, choice) * scorers.score_scale(scorer) >= min_score}
+    assert set(zip(positions.tolist(), rows.tolist())) == expected
+    assert np.all(scores >= min_score)
+
+
+@pytest.mark.parametrize('scorer_name', ['token_set_ratio', 'WRatio'])
+def test_unbounded_scorers_are_not_pruned(scorer_name):
+    assert scorers.min_length_ratio(scorers.get_scorer(scorer_name), 90) == 0
@@ -0,0 +1,39 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from website import database_store, sharded_matching
+
+
+def test_merge_top_matches_orders_by_score_then_row():
+    rows, scores = sharded_matching.merge_top_matches(
+        [np.array([[0, 1]]), np.array([[2, -1]])], [np.array([[90.0, 80.0]]), np.array([[90.0, np.nan]])], 3)
+    assert rows.tolist() == [[0, 2, 1]]
+    assert scores.tolist() == [[90.0, 90.0, 80.0]]
+
+
+def test_merge_top_matches_leaves_missing_matches_empty():
+    rows, scores = sharded_matching.merge_top_matches([np.array([[4, -1]]), np.array([[-1, -1]])],
+                                                      [np.array([[70.0, np.nan]]), np.full((1, 2), np.nan)], 2)
+    assert rows.tolist() == [[4, -1]] and np.isnan(scores[0, 1])
+
+
+def test_decoded_segments_are_bounded(make_database, monkeypatch):
+    database_name = make_database(pd.DataFrame({'company': ['acme', 'zenith', 'contoso', 'northwind']}))
+    artifact = database_store.load_database(os.path.join('static', 'databases', database_name))
+    monkeypatch.setattr(sharded_matching, '_segments', OrderedDict())
+    monkeypatch.setattr(sharded_matching, 'SEGMENT_CACHE_ENTRIES', 2)
+
+    for start in range(3):
+        sharded_matching._load_segment(artifact.path, artifact.mtime, 'choices', start, start + 1)
+    sharded_matching._load_segment(artifact.path, artifact.mtime, 'choices', 1, 2)
+    sharded_matching._load_segment(artifact.path, artifact.mtime, 'choices', 3, 4)
+    assert [key[3:] for key in sharded_matching._segments] == [(1, 2), (3, 4)]
+
+
+def test_job_workers_connect_to_the_shard_workers_of_their_parent(monkeypatch):
+    monkeypatch.setattr(sharded_matching, '_executor', None)
+    sharded_matching.connect(([('127.0.0.1', 6001), ('127.0.0.1', 6002)], b'key', 2))
+    assert sharded_matching.connection_info() == ([('127.0.0.1', 6001), ('127.0.0.1', 6002)], b'key', 2)
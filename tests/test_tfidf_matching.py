@@ -0,0 +1,67 @@
+import random
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from website import matching, tfidf_matching
+
+CHOICES = ['acme holdings', 'zenith marine', 'northwind traders', 'contoso bank']
+
+
+def test_result_frame_pads_missing_matches():
+    result_df = matching.result_frame(['acme'], np.array([[0]]), np.array([[80.0]]), CHOICES, n_matches=3)
+    assert list(result_df.columns) == ['name', 'match1', 'match_score1', 'match2', 'match_score2', 'match3',
+                                       'match_score3']
+    assert result_df['match1'].tolist() == ['acme holdings']
+    assert result_df['match2'].isna().all() and result_df['match_score3'].isna().all()
+
+
+def test_rerank_job_keeps_records_with_few_candidates(make_database, match_upload):
+    database_name = make_database(pd.DataFrame({'company': CHOICES}))
+    records = pd.DataFrame({'name': ['acme holdings', 'qqqq']})
+    download_path, (rows, n_results, _, _) = match_upload(records, database_name, match_mode='tfidf', rerank=True,
+                                                          candidate_limit=1)
+    assert rows == 2
+    results = pd.read_excel(download_path, sheet_name='Results')
+    assert results['name'].tolist() == ['acme holdings', 'qqqq']
+    assert results['match1'].tolist()[0] == 'acme holdings'
+    assert results['match2'].isna().all() and results['match1'].isna().tolist() == [False, True]
+    assert n_results == 1
+
+
+def test_job_against_database_smaller_than_matches(make_database, match_upload):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings']}))
+    download_path, (rows, n_results, _, _) = match_upload(pd.DataFrame({'name': ['acme']}), database_name)
+    results = pd.read_excel(download_path, sheet_name='Results')
+    assert rows == 1 and n_results == 1
+    assert 'match_score3' in results.columns and results['match_score3'].isna().all()
+
+
+@pytest.mark.parametrize('n_matches', [1, 3, 50])
+def test_similar_equals_a_dense_search(n_matches):
+    generator = random.Random(3)
+    words = ['acme', 'holdings', 'zenith', 'marine', 'north', 'wind', 'traders', 'bank', 'group', 'contoso']
+    keys = sorted({' '.join(generator.sample(words, generator.randint(1, 3))) for _ in range(40)})
+    queries = [' '.join(generator.sample(words, generator.randint(1, 2))) for _ in range(30)] + ['qqqq', '']
+    index = tfidf_matching.TfidfIndex(keys)
+
+    # Small chunks, so the records are matched over several chunks and threads
+    rows, scores = index.similar(queries, n_matches, workers=2, chunk_bytes=len(keys) * 12 * 4)
+    similarities = (index.vectorize(queries) @ index.matrix).toarray().astype(np.float64)
+    n_matches = min(n_matches, len(keys))
+    assert rows.shape == scores.shape == (len(queries), n_matches)
+    for row_matches, row_scores, row_similarities in zip(rows, scores, similarities):
+        # Every name with a similarity, best first and ties by row
+        order = np.lexsort((np.arange(len(keys)), -row_similarities))
+        expected = [row for row in order if row_similarities[row] > 0][:n_matches]
+        found = row_matches >= 0
+        assert found.sum() == len(expected) and found[:len(expected)].all()
+        np.testing.assert_allclose(row_scores[found], np.minimum(row_similarities[expected], 1) * 100, rtol=1e-6)
+        assert np.isnan(row_scores[~found]).all()
+
+        # The rows reported are the expected ones, up to ties at the last kept place
+        last = row_similarities[expected[-1]] if expected else 0
+        strict = row_similarities[expected] > last
+        assert row_matches[:len(expected)][strict].tolist() == np.array(expected)[strict].tolist()
+        np.testing.assert_allclose(row_similarities[row_matches[found]], row_similarities[expected])
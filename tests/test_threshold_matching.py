@@ -0,0 +1,54 @@
+import io
+
+import pandas as pd
+from rapidfuzz import fuzz
+
+from website import reports, threshold_matching
+
+CHOICES = ['acme holdings', 'acme holding', 'acme corp', 'zenith marine']
+
+
+def test_threshold_batch_finds_every_match_above_the_minimum():
+    index = threshold_matching.LengthIndex(CHOICES)
+    result_df, pruning = threshold_matching.threshold_batch(['acme holdings'], CHOICES, 90, scorer=fuzz.ratio,
+                                                            length_index=index)
+    assert result_df['match'].tolist() == ['acme holdings', 'acme holding']
+    assert (result_df['match_score'] >= 90).all()
+    assert pruning['scored'] + pruning['pruned'] == pruning['pairs']
+
+
+def test_summary_of_empty_threshold_result():
+    result_df = pd.DataFrame({'name': [], 'match': [], 'match_score': []})
+    summary = reports.summarize_scores(result_df, None)
+    assert summary['rows'] == 0
+    assert summary['all']['count'].tolist() == [0]
+    assert pd.isna(summary['all']['min'][0]) and pd.isna(summary['all']['max'][0])
+
+
+def test_threshold_job_without_matches_writes_empty_results(make_database, match_upload):
+    database_name = make_database(pd.DataFrame({'company': CHOICES}))
+    records = pd.DataFrame({'name': ['qwerty', 'uiop asdf']})
+    download_path, (rows, n_results, pruning, _) = match_upload(records, database_name, match_mode='threshold',
+                                                                min_score=99.0)
+    assert rows == 2 and n_results == 0
+    sheets = pd.read_excel(download_path, sheet_name=None)
+    assert len(sheets['Results']) == 0
+    assert list(sheets['Results'].columns) == ['name', 'match', 'match_score']
+
+
+def test_upload_rejects_low_threshold_minimum(client, make_database):
+    database_name = make_database(pd.DataFrame({'company': CHOICES}))
+    response = client.post('/uploadRecords', data={'record_file': (io.BytesIO(b'name\nacme\n'), 'records.csv'),
+                                                   'database_name': database_name, 'match_mode': 'threshold',
+                                                   'min_score': '0'},
+                           content_type='multipart/form-data', follow_redirects=True)
+    assert b'Minimum score must be at least 50' in response.data
+
+
+def test_api_rejects_low_threshold_minimum(client, make_database):
+    database_name = make_database(pd.DataFrame({'company': CHOICES}))
+    response = client.get('/api/match', query_string={'q': 'acme', 'db': database_name, 'min_score': '10'})
+    assert response.status_code == 400
+    response = client.get('/api/match', query_string={'q': 'acme holdings', 'db': database_name, 'min_score': '90'})
+    assert response.status_code == 200
+    assert [match['name'] for match in response.get_json()['matches']] == ['acme holdings', 'acme holding']
@@ -0,0 +1,46 @@
+import io
+import os
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from website import db, jobs
+from website.models import MatchJob, User
+
+EMAIL = 'admin@example.com'
+
+
+def test_uploads_with_the_same_name_keep_their_own_records(client, make_database, monkeypatch):
+    database_name = make_database(pd.DataFrame({'company': ['acme holdings', 'zenith marine']}))
+    submitted = []
+    monkeypatch.setattr(jobs, 'submit_match_job', lambda job, file_path, *args: submitted.append(file_path))
+    for records in (b'name\nacme\n', b'name\nzenith\n'):
+        client.post('/uploadRecords', data={'record_file': (io.BytesIO(records), 'records.csv'),
+                                            'database_name': database_name},
+                    content_type='multipart/form-data')
+
+    assert submitted == [f'static/records/{EMAIL}_1_records.csv', f'static/records/{EMAIL}_2_records.csv']
+    assert [open(path, 'rb').read() for path in submitted] == [b'name\nacme\n', b'name\nzenith\n']
+    assert sorted(os.listdir('static/records')) == [f'{EMAIL}_1_records.csv', f'{EMAIL}_2_records.csv']
+
+
+def test_user_close_keeps_the_files_of_current_jobs(client):
+    user = User.query.filter_by(email=EMAIL).first()
+    now = datetime.utcnow()
+    states = [('queued', None), ('running', None), ('done', now - timedelta(minutes=5)),
+              ('done', now - timedelta(days=2)), ('failed', now - timedelta(days=2))]
+    for status, finished_at in states:
+        db.session.add(MatchJob(user_id=user.id, database_name='reference.xlsx', status=status,
+                                finished_at=finished_at))
+    db.session.commit()
+    for job_id in range(1, len(states) + 1):
+        open(f'static/records/{EMAIL}_{job_id}_records.csv', 'w').close()
+        open(f'static/matches/{EMAIL}_{job_id}_match.xlsx', 'w').close()
+    open(f'static/matches/other{EMAIL}_4_match.xlsx', 'w').close()
+
+    response = client.post('/log_user_close', json={'user_id': user.id})
+    assert response.status_code == 200
+    assert sorted(os.listdir('static/records')) == [f'{EMAIL}_{job_id}_records.csv' for job_id in (1, 2, 3)]
+    assert sorted(os.listdir('static/matches')) == sorted([f'{EMAIL}_{job_id}_match.xlsx' for job_id in (1, 2, 3)]
+                                                          + [f'other{EMAIL}_4_match.xlsx'])
+    assert client.post('/log_user_close', json={'user_id': 999}).status_code == 200
@@ -0,0 +1,173 @@
+# TF-IDF matching: names and database keys as sparse vectors of character n-gram weights, matched by cosine
+# similarity
+#
+# The database keys are vectorized once per database (see ReferenceDatabase.tfidf_index). An upload is vectorized
+# as a whole and multiplied with the database matrix a chunk of records at a time; the sparse product only does work
+# for the database names sharing an n-gram with a record. N-grams that are rare across the database weigh the most,
+# and word order barely matters, which suits long names whose words come in another order. The top candidates of
+# every record can be re-ranked with a rapidfuzz scorer, so the reported scores are those of the other modes
+# (scipy is only imported by this module, when the TF-IDF mode is used)
+
+# Import required modules
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from rapidfuzz import process as rapidfuzz_process
+from scipy import sparse
+
+from .candidate_index import NGRAM_SIZE
+from .matching import DEFAULT_CHUNK_BYTES, PROGRESS_INTERVAL
+from .scorers import score_scale
+
+
+# Count the character n-grams of every key as a sparse matrix with one row per key and one column per n-gram,
+# padding with spaces so word boundaries form n-grams too (like candidate_index.ngrams)
+# With 'grow', n-grams missing from the vocabulary are added to it; otherwise they are left out
+def _count_matrix(keys: list, vocabulary: dict, n: int, grow: bool) -> sparse.csr_matrix:
+    indptr = [0]
+    indices = []
+    for key in keys:
+        padded = f' {key} '
+        for start in range(max(1, len(padded) - n + 1)):
+            gram = padded[start:start + n]
+            column = vocabulary.get(gram)
+            if column is None:
+                if not grow:
+                    continue
+                column = vocabulary[gram] = len(vocabulary)
+            indices.append(column)
+        indptr.append(len(indices))
+
+    # Repeated n-grams of a key are summed into their count
+    counts = sparse.csr_matrix((np.ones(len(indices), dtype=np.float32), np.array(indices, dtype=np.int32),
+                                np.array(indptr, dtype=np.int64)), shape=(len(keys), len(vocabulary)))
+    counts.sum_duplicates()
+    return counts
+
+
+# Row of every stored entry of a sparse matrix
+def _entry_rows(matrix: sparse.csr_matrix) -> np.ndarray:
+    return np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+
+# Weigh the n-gram counts by their inverse document frequency and scale every row to unit length, in place
+def _weigh(counts: sparse.csr_matrix, idf: np.ndarray) -> sparse.csr_matrix:
+    counts.data *= idf[counts.indices]
+    rows = _entry_rows(counts)
+    norms = np.sqrt(np.bincount(rows, weights=counts.data.astype(np.float64) ** 2, minlength=counts.shape[0]))
+    counts.data /= norms[rows].astype(np.float32)
+    return counts
+
+
+# Keep the 'n_matches' best columns of every row of a chunk of sparse similarities, best first and ties by column
+# Only the stored similarities of a row are searched, since names without a shared n-gram have no similarity at all
+# Returns the columns (-1 where a row has fewer similar names) and similarities (NaN there); ties at the last kept
+# place are broken arbitrarily, which only matters for names with identical keys
+def _top_n(similarities: sparse.csr_matrix, n_matches: int) -> tuple:
+    columns = np.full((similarities.shape[0], n_matches), -1, dtype=np.int64)
+    selected = np.full((similarities.shape[0], n_matches), np.nan, dtype=np.float64)
+    for row in range(similarities.shape[0]):
+        start, end = similarities.indptr[row], similarities.indptr[row + 1]
+        values, row_columns = similarities.data[start:end], similarities.indices[start:end]
+        found = values > 0
+        if not found.all():
+            values, row_columns = values[found], row_columns[found]
+        if len(values) > n_matches:
+            top = np.argpartition(-values, n_matches - 1)[:n_matches]
+            values, row_columns = values[top], row_columns[top]
+        order = np.lexsort((row_columns, -values))
+        columns[row, :len(order)] = row_columns[order]
+        selected[row, :len(order)] = np.minimum(values[order], 1.0) * 100
+    return columns, selected
+
+
+# TF-IDF vectors of the keys of a reference database
+class TfidfIndex:
+    def __init__(self, keys: list, n: int = NGRAM_SIZE):
+        self.n = n
+        self.size = len(keys)
+
+        # Column of every n-gram, and its inverse document frequency (smoothed, so no weight is zero)
+        self.vocabulary = {}
+        counts = _count_matrix(keys, self.vocabulary, n, grow=True)
+        document_frequency = np.bincount(counts.indices, minlength=len(self.vocabulary))
+        self.idf = (np.log((1 + self.size) / (1 + document_frequency)) + 1).astype(np.float32)
+
+        # Stored transposed, one row per n-gram listing the names that hold it: a chunk of records multiplies with
+        # it directly, and its row lengths are the document frequencies
+        self.matrix = _weigh(counts, self.idf).T.tocsr()
+
+        # Approximate memory footprint, counted against the reference cache budget
+        self.nbytes = (self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+                       + self.idf.nbytes + 100 * len(self.vocabulary))
+
+    # Vectorize records with the vocabulary and weights of the database; n-grams the database lacks are left out
+    def vectorize(self, queries: list) -> sparse.csr_matrix:
+        return _weigh(_count_matrix(queries, self.vocabulary, self.n, grow=False), self.idf)
+
+    # Find the 'n_matches' database rows most similar to every record by cosine similarity
+    # Returns the rows (-1 where fewer names share an n-gram with the record) and similarities between 0 and 100
+    # (NaN there). Records are multiplied in chunks whose similarities stay within 'chunk_bytes'; the chunks run on
+    # 'workers' threads (-1 for every core), since the sparse products release the GIL. 'progress' is called with
+    # the number of records done
+    def similar(self, queries: list, n_matches: int, workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                progress=None) -> tuple:
+        n_matches = min(n_matches, self.size)
+        rows = np.full((len(queries), n_matches), -1, dtype=np.int64)
+        scores = np.full((len(queries), n_matches), np.nan, dtype=np.float64)
+        if not queries or n_matches == 0:
+            return rows, scores
+
+        # A chunk holds at most a similarity (value and column) per database name for each record, with the work
+        # arrays of the sparse product
+        vectors = self.vectorize(queries)
+        chunk_rows = max(1, chunk_bytes // (self.size * 12))
+        starts = range(0, len(queries), chunk_rows)
+
+        def match_chunk(start: int) -> int:
+            end = min(start + chunk_rows, len(queries))
+            rows[start:end], scores[start:end] = _top_n((vectors[start:end] @ self.matrix).tocsr(), n_matches)
+            return end
+
+        # A single chunk (e.g. one record) is matched in the calling thread
+        if workers < 1:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(starts))
+        executor = ThreadPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            for end in (executor.map if executor is not None else map)(match_chunk, starts):
+                if progress is not None:
+                    progress(end)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return rows, scores
+
+    # Find the top matches of every record among the keys the index was built from
+    # With a 'candidate_limit', that many TF-IDF candidates of every record are re-ranked with the scorer and the
+    # scorer's scores are reported; without, the cosine similarities are. Returns the same arrays as
+    # matching.top_matches
+    def top_matches(self, queries: list, keys: list, n_matches: int, scorer=None, candidate_limit: int = None,
+                    progress=None, workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES) -> tuple:
+        n_matches = min(n_matches, self.size)
+        if candidate_limit is None:
+            return self.similar(queries, n_matches, workers, chunk_bytes, progress)
+
+        candidates, _ = self.similar(queries, max(candidate_limit, n_matches), workers, chunk_bytes)
+        scale = score_scale(scorer)
+        rows = np.full((len(queries), n_matches), -1, dtype=np.int64)
+        scores = np.full((len(queries), n_matches), np.nan, dtype=np.float64)
+        for row, (query, query_candidates) in enumerate(zip(queries, candidates)):
+            # Candidates in database row order, so that ties are ordered by row like a full scan
+            query_candidates = np.sort(query_candidates[query_candidates >= 0])
+            matches = rapidfuzz_process.extract(query, [keys[candidate] for candidate in query_candidates.tolist()],
+                                                scorer=scorer, limit=n_matches)
+            for i, (_, score, position) in enumerate(matches):
+                rows[row, i] = query_candidates[position]
+                scores[row, i] = score * scale
+            if progress is not None and (row + 1) % PROGRESS_INTERVAL == 0:
+                progress(row + 1)
+        if progress is not None:
+            progress(len(queries))
+        return rows, scores
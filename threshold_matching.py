@@ -0,0 +1,149 @@
+# Threshold matching: every database key scoring at least a minimum score against a name, instead of the top few
+#
+# Keys are kept sorted by length, and a scorer whose score is bounded by the lengths of the two strings (see
+# scorers.min_length_ratio) only scores the range of keys whose length can still reach the minimum score.
+# The scored pairs use the minimum score as rapidfuzz score_cutoff, so each comparison stops as soon as the
+# minimum cannot be reached
+
+# Import required modules
+import sys
+
+import numpy as np
+import pandas as pd
+from rapidfuzz import fuzz as rapidfuzz
+from rapidfuzz import process as rapidfuzz_process
+
+from .matching import DEFAULT_CHUNK_BYTES
+from .scorers import min_length_ratio, score_scale
+
+# Lowest minimum score accepted from uploads and the API: below it the length bounds prune almost nothing and nearly
+# every pair of a name and a database key is a match, which can exhaust memory on large databases
+MIN_SCORE = 50
+
+# Slack on the length bounds and on the score cutoff handed to rapidfuzz, so floating-point rounding never drops
+# a key scoring exactly the minimum score (rapidfuzz can reject such keys under a cutoff)
+_LENGTH_TOLERANCE = 1e-9
+_CUTOFF_TOLERANCE = 1e-6
+
+
+# Database keys sorted by length, so the keys within a length range are one contiguous slice
+class LengthIndex:
+    def __init__(self, choices: list):
+        lengths = np.fromiter((len(choice) for choice in choices), dtype=np.int64, count=len(choices))
+
+        # Row of the database of every sorted position, and the sorted keys and lengths
+        self.order = np.argsort(lengths, kind='stable')
+        self.lengths = lengths[self.order]
+        self.choices = [choices[row] for row in self.order.tolist()]
+
+        # Approximate memory footprint (the keys themselves are shared with the unsorted list)
+        self.nbytes = sys.getsizeof(self.choices) + self.order.nbytes + self.lengths.nbytes
+
+    def __len__(self):
+        return len(self.choices)
+
+    # Sorted positions start to end holding the keys whose length lies between two bounds (inclusive)
+    def range(self, min_length: int, max_length: int) -> tuple:
+        return (int(np.searchsorted(self.lengths, min_length, side='left')),
+                int(np.searchsorted(self.lengths, max_length, side='right')))
+
+
+# Lengths of the keys that can reach the minimum score against a name of the given length
+def length_window(length: int, ratio: float) -> tuple:
+    if ratio <= 0:
+        return 0, sys.maxsize
+    return int(np.ceil(length * ratio - _LENGTH_TOLERANCE)), int(np.floor(length / ratio + _LENGTH_TOLERANCE))
+
+
+# Find every key of 'choices' scoring at least 'min_score' (0-100) against each name
+# Returns four values: the position in 'names' of every match, its row of 'choices', its score, and the pruning
+# counts {'pairs', 'scored', 'pruned'} over the distinct names. Matches are grouped by name in the order of 'names',
+# best score first and ties by row. 'progress' is called with the number of names matched so far
+def threshold_matches(names: list, choices: list, min_score: float, scorer=rapidfuzz.ratio,
+                      length_index: LengthIndex = None, workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                      progress=None) -> tuple:
+    n_rows = len(names)
+    scale = score_scale(scorer)
+    cutoff = min_score / scale
+    ratio = min_length_ratio(scorer, min_score)
+    if length_index is None:
+        length_index = LengthIndex(choices)
+
+    # Collapse repeated names: 'inverse' maps every name to its position in 'unique'
+    positions = {}
+    inverse = np.fromiter((positions.setdefault(name, len(positions)) for name in names), dtype=np.int64,
+                          count=n_rows)
+    unique = list(positions)
+    unique_lengths = np.fromiter((len(name) for name in unique), dtype=np.int64, count=len(unique))
+
+    # Score the names of one length together, against the keys within their length window
+    by_length = np.argsort(unique_lengths, kind='stable')
+    lengths, starts = np.unique(unique_lengths[by_length], return_index=True)
+    found_names, found_rows, found_scores = [], [], []
+    stats = {'pairs': len(unique) * len(choices), 'scored': 0, 'pruned': 0}
+    done = 0
+    for length, group in zip(lengths.tolist(), np.split(by_length, starts[1:])):
+        start, end = length_index.range(*length_window(length, ratio))
+        stats['scored'] += len(group) * (end - start)
+        stats['pruned'] += len(group) * (len(choices) - (end - start))
+
+        if end > start:
+            # Number of names per chunk so that one score matrix stays within the memory bound
+            chunk_rows = max(1, chunk_bytes // ((end - start) * np.dtype(np.float64).itemsize))
+            window = length_index.choices[start:end]
+            for chunk_start in range(0, len(group), chunk_rows):
+                chunk = group[chunk_start:chunk_start + chunk_rows]
+                chunk_scores = rapidfuzz_process.cdist([unique[position] for position in chunk], window,
+                                                       scorer=scorer, dtype=np.float64, workers=workers,
+                                                       score_cutoff=max(0.0, cutoff - _CUTOFF_TOLERANCE))
+
+                # cdist reports scores below the cutoff as 0; the pairs kept are those whose reported (0-100) score
+                # reaches the minimum, as in top matching
+                chunk_scores *= scale
+                hit_names, hit_columns = np.nonzero(chunk_scores >= min_score)
+                found_names.append(chunk[hit_names])
+                found_rows.append(length_index.order[start + hit_columns])
+                found_scores.append(chunk_scores[hit_names, hit_columns])
+
+        done += len(group)
+        if progress is not None:
+            progress(done * n_rows // len(unique))
+
+    if found_names:
+        found_names = np.concatenate(found_names)
+        found_rows = np.concatenate(found_rows)
+        found_scores = np.concatenate(found_scores)
+    else:
+        found_names = found_rows = np.empty(0, dtype=np.int64)
+        found_scores = np.empty(0, dtype=np.float64)
+
+    # Group the matches by name, best score first and ties by row
+    order = np.lexsort((found_rows, -found_scores, found_names))
+    found_rows, found_scores = found_rows[order], found_scores[order]
+    counts = np.bincount(found_names, minlength=len(unique))
+    first = np.cumsum(counts) - counts
+
+    # Fan the matches back out to every occurrence of each name
+    name_counts = counts[inverse]
+    match_names = np.repeat(np.arange(n_rows), name_counts)
+    offsets = np.arange(len(match_names)) - np.repeat(np.cumsum(name_counts) - name_counts, name_counts)
+    source = first[inverse][match_names] + offsets
+    return match_names, found_rows[source], found_scores[source], stats
+
+
+# Match a list of names against the database choices and return every match scoring at least 'min_score' as a
+# DataFrame with the columns name, match and match_score (one row per match, indexed by the position of its name
+# in 'names'), with the pruning counts
+# 'queries' are the (normalized) strings scored for the names, and 'labels' the values reported for the matched
+# choices; both default to the names and choices themselves
+def threshold_batch(names: list, choices: list, min_score: float, scorer=rapidfuzz.ratio,
+                    length_index: LengthIndex = None, workers: int = -1, chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+                    progress=None, queries: list = None, labels: list = None) -> tuple:
+    match_names, rows, scores, stats = threshold_matches(names if queries is None else queries, choices, min_score,
+                                                         scorer=scorer, length_index=length_index, workers=workers,
+                                                         chunk_bytes=chunk_bytes, progress=progress)
+    name_array = np.array(names, dtype=object)
+    choice_array = np.array(list(choices if labels is None else labels), dtype=object)
+    result_df = pd.DataFrame({'name': name_array[match_names], 'match': choice_array[rows], 'match_score': scores},
+                             index=match_names)
+    return result_df, stats
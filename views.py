@@ -1,7 +1,7 @@
 # Import required modules and classes
 from flask import Blueprint, render_template
 from flask_login import login_required, current_user
-import os
+from .database_store import list_databases
 
 # Create a Blueprint named 'views'
 views = Blueprint('views', __name__)
@@ -20,7 +20,7 @@ def home():
 @login_required  # Requires the user to be logged in to access this view
 def admin():
     # List all files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
     # Render the 'admin.html' template with the current user
     return render_template("admin.html", user=current_user, database_files=db_files)
 
@@ -30,7 +30,7 @@ def admin():
 @login_required  # Requires the user to be logged in to access this view
 def uploadRecords():
     # List all files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
 
     # Render the 'uploadRecords.html' template with the current user, database files, and a flag to hide the progress
     return render_template("uploadRecords.html", user=current_user, database_files=db_files)
@@ -41,6 +41,6 @@ def uploadRecords():
 @login_required  # Requires the user to be logged in to access this view
 def singleMatchAnalysis():
     # List all files in the 'static/databases/' directory
-    db_files = os.listdir('static/databases/')
+    db_files = list_databases()
     # Render the 'singleMatchAnalysis.html' template with the current user
     return render_template("singleMatchAnalysis.html", user=current_user, database_files=db_files)
@@ -0,0 +1,79 @@
+# Warm-up of the matching engine before serving
+#
+# The routes import the matching engine on first use, so a worker that only serves login pages never loads it.
+# With MATCH_PRELOAD set, create_app instead imports it up front, loads every reference database with its
+# normalized keys, candidate index and length index, and starts the local shard workers. Under gunicorn with
+# preload_app (see gunicorn.conf.py) this runs once in the master process before the workers are forked; the workers
+# share those pages copy-on-write (and the shard workers) and their first match request is not a cold one
+
+# Import required modules
+import importlib
+import logging
+import os
+
+from . import metrics
+from . import normalization
+from .database_store import list_databases
+
+logger = logging.getLogger(__name__)
+
+# Load the matching engine and the reference databases when the app is created
+PRELOAD = os.environ.get('MATCH_PRELOAD', '').lower() in ('1', 'true', 'yes')
+
+# Normalization pipelines whose keys and indexes are built by the warm-up (comma-separated names)
+PRELOAD_PIPELINES = os.environ.get('MATCH_PRELOAD_PIPELINES', normalization.DEFAULT_PIPELINE)
+
+# Modules of the matching engine imported by the warm-up (the ones the routes and the jobs import on first use)
+ENGINE_MODULES = ('candidate_index', 'duplicates', 'field_matching', 'ingest', 'jobs', 'match_cache', 'matching',
+                  'reference_cache', 'reports', 'scorers', 'sharded_matching', 'tfidf_matching', 'threshold_matching')
+
+
+# Import the matching engine and build the reference databases and their indexes for the given pipelines
+# Returns the stage timings and what was loaded; a database that cannot be loaded is logged and left cold
+def warm_up(pipelines: list = None) -> dict:
+    if pipelines is None:
+        pipelines = [pipeline.strip() for pipeline in PRELOAD_PIPELINES.split(',') if pipeline.strip()]
+    pipelines = [normalization.pipeline_key(pipeline) for pipeline in pipelines]
+    timer = metrics.StageTimer()
+
+    with timer.stage('import'):
+        for module in ENGINE_MODULES:
+            importlib.import_module(f'.{module}', __package__)
+        from .matching import default_mode
+        from .reference_cache import reference_cache
+
+    # The combination of every database (the 'All' selection) is only built when every database loaded
+    references = []
+    with timer.stage('load_databases'):
+        names = list_databases(reference_cache.directory)
+        for name in names:
+            try:
+                references.append(reference_cache.get(name))
+            except Exception as e:
+                logger.warning('Cannot preload database %s: %s', name, e)
+        if references and len(references) == len(names):
+            references.append(reference_cache.get_merged())
+
+    # Start the local shard workers here, so that under gunicorn they are started once, in the master, and shared
+    # by the forked workers
+    with timer.stage('start_shards'):
+        from .sharded_matching import get_executor
+        get_executor()
+
+    # The TF-IDF vectors are only built for the databases matched in the TF-IDF mode by default
+    with timer.stage('build_indexes'):
+        for reference in references:
+            for pipeline in pipelines:
+                reference.normalized(pipeline)
+                reference.candidate_index(pipeline)
+                reference.length_index(pipeline)
+                if default_mode(reference.name) == 'tfidf':
+                    reference.tfidf_index(pipeline)
+
+    for stage_name, seconds in timer.stages.items():
+        metrics.record_stage(stage_name, seconds, route='warm_up')
+    summary = {'databases': [reference.name for reference in references], 'pipelines': pipelines,
+               'nbytes': reference_cache.nbytes, 'stages': {name: round(seconds, 6)
+                                                            for name, seconds in timer.stages.items()}}
+    metrics.log_event('warm_up', **summary)
+    return summary